@@ -1,5 +1,9 @@
-from util.agent import LMModel, State
-from util.agent import parse_output
+from util.agent import LMModel, State, command_groups
+from util.action_dag import uses_dag, SKIPPED
+from util.output_parser import parse_with_repair
+from util.tracing import span
+from util.memory import Memory
+from util.trajectory import TrajectoryStore, TrajectorySession
 from util.webdriver import chrome_new_webdriver
 from agents.compiler1.prompt import get_prompt
 from dotenv import load_dotenv
@@ -15,24 +19,56 @@ Executor executes every action. If successful with no message, nothing is return
 Otherwise, return message.
 """
 
+# what a reply must look like, see util/output_parser.py
+OUTPUT_SCHEMA = {'fields': {'page': str, 'thought': str, 'action': list},
+                 'required': ['action'],
+                 'commands': {'click': {'idx': int},
+                              'type': {'idx': int, 'content': str},
+                              'scroll': {'idx': (int, {'WINDOW'}), 'dir': {'up', 'down'}},
+                              'wait': {},
+                              'askuser': {},
+                              'goback': {},
+                              'restart': {},
+                              'answer': {'content': str},
+                              'open': {'idx': int, 'tab': str},
+                              'extract': {'tab': str},
+                              'switch': {'tab': str},
+                              'close': {'tab': str}}}
+
+
 class Agent:
-    def __init__(self, task, start_site="https://www.google.com/"):
+    def __init__(self, task, start_site="https://www.google.com/", driver=None, model=None, memory=None,
+                 max_repairs=1, backend='markpage', viewport_first=False, trajectories=None):
+        """
+        memory: Memory of past steps, a default one if not given
+        max_repairs: text-only re-prompts to fix a reply that can't be parsed, before giving up on the step
+        backend: how the State finds elements to label, see util.agent.OBSERVATION_BACKENDS
+        viewport_first: only label what's in view, see State
+        trajectories: TrajectoryStore to replay matching runs from and record this one in (configured with
+        TRAJECTORY_MODE if not given, see util/trajectory.py). Call self.trajectory.finish(answer, success) to save the run.
+        """
         self.task = task
         self.past_observation_summary = ''
-        self.past_thoughts = []
+        self.memory = memory if memory is not None else Memory()
         self.ans = None
 
         self.command_results = []
         
         # State
-        driver = chrome_new_webdriver()
-        self.state = State(driver, start_site=start_site)
+        driver = driver if driver is not None else chrome_new_webdriver()
+        self.state = State(driver, start_site=start_site, backend=backend, viewport_first=viewport_first)
 
         # Model
-        self.model = LMModel()
+        self.model = model if model is not None else LMModel()
 
         self.last_parsed_output = None
+        self.last_error = None  # why the last reply couldn't be used
         self._last_response = None  # Debug
+        self.max_repairs = max_repairs
+        self.parse_stats = {}  # ok/reprompted/failed replies, and replayed steps
+        self.trajectory = TrajectorySession('compiler1', task,
+                                            trajectories if trajectories is not None else TrajectoryStore.from_env())
+        self._replayed = None  # recorded output for the current step, instead of asking the LLM
 
         self.args_dict = {'click': self.state.click,
                           'type': self.state.type,
@@ -41,6 +77,10 @@ class Agent:
                           'askuser': self.state.ask_user,
                           'goback': self.state.go_back,
                           'restart': self.state.restart,
+                          'open': self.state.open_tab,
+                          'extract': self.state.extract,
+                          'switch': self.state.focus_tab,
+                          'close': self.state.close_tab,
                           'answer': self._answer}
 
     def create_prompt(self):
@@ -48,16 +88,28 @@ class Agent:
         Take screenshot, get bboxes, and create prompt for next WebVoyager iteration
         """
         self.state.prep_browser_variables()
+        if self.state.is_stuck():
+            # trying something different didn't help, start over
+            self.state.restart(None)
+            self.state.prep_browser_variables()
+        past_outputs = '\n'.join(x for x in [self.past_observation_summary, self.state.stuck_hint()] if x)
         prompt = get_prompt(bboxes=self.state.elements, task=self.task,
-                            img=self.state.img, past_outputs=self.past_observation_summary)
+                            img=self.state.img, past_outputs=past_outputs, bbox_stats=self.state.bbox_stats,
+                            outline=self.state.outline, tabs=self.state.other_tabs())
+        self._replayed = self.trajectory.observe('agent', self.state)
         return prompt
 
     def get_response(self, prompt):
         """
-        Prompt the LLM and parse the output
+        Prompt the LLM and parse the output, unless a recorded trajectory already knows what to do here
         """
+        if self._replayed is not None:
+            self.last_parsed_output, self.last_error = self._replayed, None
+            self.parse_stats['replayed'] = self.parse_stats.get('replayed', 0) + 1
+            return
         self._last_response = self.model(prompt)
-        self.last_parsed_output = parse_output(self._last_response)
+        self.last_parsed_output, self._last_response, self.last_error = parse_with_repair(
+            self.model, self._last_response, OUTPUT_SCHEMA, self.parse_stats, self.max_repairs)
 
     def execute_commands(self):
         """
@@ -65,31 +117,50 @@ class Agent:
         and update past observation with previous thoughts, etc.
         """
         if not isinstance(self.last_parsed_output, dict) or 'action' not in self.last_parsed_output:
+            # let the model know why the step was wasted
+            self.command_results = [('invalid output', self.last_error)]
+            self.memory.add_step(None, self.command_results)
+            self.past_observation_summary = self.memory.render()
             return 'You provided invalid output. Please format using the JSON guidelines given to you.'
 
-        # update thought
-        if 'thought' in self.last_parsed_output:
-            self.past_thoughts.append(self.last_parsed_output["thought"])
-        
         # Execute commands and update command_results
         self.command_results = []
+        outcomes = []  # (exit_state, response) per command
+        failed = []
         execution_error = False
-        for command in self.last_parsed_output['action']:
-            if not execution_error:
-                exit_state, response = self._execute_command(command)
+        actions = self.last_parsed_output['action']
+        if uses_dag(actions):
+            # deps/tabs given, independent branches run together and only what depends on a failure is skipped
+            for command, (exit_state, response) in zip(actions, self.state.run_plan(actions, self._execute_command)):
+                self.command_results.append((command, response if response is not None else 'executed'))
+                outcomes.append((exit_state, response))
+                if not exit_state and response != SKIPPED:
+                    failed.append((command, response))
+            actions = []
+        for batched, group in command_groups(actions):
+            results = [] if execution_error else \
+                self._execute_batch(group) if batched else [self._execute_command(group[0])]
+            for command, (exit_state, response) in zip(group, results):
                 if response is not None:
                     self.command_results.append((command, response))
                 else:
                     self.command_results.append((command, 'executed'))
+                outcomes.append((exit_state, response))
+                if not exit_state:
+                    failed.append((command, response))
                 execution_error = execution_error or not exit_state
-            else:
+            # the batch also stops early once the page navigated, the rest would act on the old page
+            execution_error = execution_error or len(results) < len(group)
+            for command in group[len(results):]:
                 # Halt execution after making one execution error
                 self.command_results.append((command, 'Execution halted before reaching this'))
+                outcomes.append((False, SKIPPED))
 
+        self.trajectory.record('agent', self.last_parsed_output, outcomes)
         # Update observation
-        past_thoughts_formatted = '\n'.join([f'{i} - {thought}' for i, thought in enumerate(self.past_thoughts)])
-        command_results_str = [f'{c} - {res}' for c, res in self.command_results] # format as string
-        self.past_observation_summary = f'Previous Steps:\n{past_thoughts_formatted}\nActions from last step:\n{"\n".join(command_results_str) if command_results_str else "No Commands Executed"}'
+        self.memory.add_step(self.last_parsed_output.get('thought'), self.command_results, failed,
+                             url=self.state.driver.current_url)
+        self.past_observation_summary = self.memory.render()
 
     def _execute_command(self, data):
         command_str = data['command'] if isinstance(data, dict) else None
@@ -97,8 +168,20 @@ class Agent:
             command_str, None) if command_str is not None else None
         if command is None:
             return False, 'No command given. Make sure to include a "command" key!'
-        return command(data)
+        with span('command', command=command_str) as s:
+            exit_state, response = command(data)
+            s.set(ok=exit_state)
+        return exit_state, response
     
+    def _execute_batch(self, commands):
+        """
+        click/type/scroll commands, run in the page in one go
+        """
+        with span('command_batch', commands=[c['command'] for c in commands]) as s:
+            results = self.state.execute_batch(commands)
+            s.set(ok=all(ok for ok, _ in results))
+        return results
+
     def _answer(self, args):
         content = args.get('content', None)
         if content is None:
@@ -1,10 +1,7 @@
 from selenium_tools.web_util import mark_page
-
-from langchain.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain_core.prompts.image import ImagePromptTemplate
-from langchain_core.messages.system import SystemMessage
-from langchain_core.messages.human import HumanMessage
+from util.tracing import span
+from util.bbox_format import serialize_bboxes, format_outline, format_tabs, BBOX_TOKEN_BUDGET
+from util.prompt_layout import build_prompt
 
 # based on https://smith.langchain.com/hub/wfh/web-voyager
 SYSTEM_PROMPT_STR = """
@@ -23,10 +20,19 @@ The command descriptions and signatures are given below:
 6. Back 1 Page - goback
 7. Restart, if you're getting nowhere - restart
 8. Answer, and finish execution - answer: content(string)
+9. Open a link in a new background tab, and name the tab - open: idx(int), tab(string)
+10. Read the text of a tab's page (the first tab is "main"), optionally only the parts about query - extract: tab(string), query(string)
+11. Look at another tab from the next step on - switch: tab(string)
+12. Close a tab - close: tab(string)
 
 Each command call must STRICTLY be in json format, contain a 'command' key specifying the command, and respective keys for each argument. 
 eg. {{"command": "click", "idx": 3}}
 
+Commands run in order. Independent work can run in parallel instead: add a "deps" key listing the indices of the earlier commands it needs.
+eg. to compare several results, open each in its own tab, then extract from each, all in one reply:
+[{{"command": "open", "idx": 4, "tab": "r1"}}, {{"command": "open", "idx": 7, "tab": "r2"}}, {{"command": "extract", "tab": "r1", "query": "price", "deps": [0]}}, {{"command": "extract", "tab": "r2", "query": "price", "deps": [1]}}]
+Extracted text is shown to you in the next step. Commands without a "tab" run in the tab you are looking at.
+
 * Web Browsing Guidelines *
 0) Don't interact with Signins/irrelevant services unless the problem tells you to
 1) Each interaction should get you closer to the end goal.
@@ -44,38 +50,25 @@ Example:
 "action": [{"command": "search", ...}, {"command": "click", ...}, {"command": "answer", "content": "Done."}]}
 """
 
-TEMPLATE = ChatPromptTemplate(messages=[
-    SystemMessage(SYSTEM_PROMPT_STR.strip()),
-    MessagesPlaceholder("past_outputs"),
-    ('user', [{"type": "image_url", "image_url": {
-     # low detail for now?
-     "url": "data:image/jpeg;base64,{img}", "detail": "low"}}]),
-    ('user', '{formatted_bboxes}'),
-    ('user', "TASK: {task}")
-])
+# stable to volatile, see util/prompt_layout.py: system, task, past outputs, bboxes, screenshot (low detail for now?)
+SYSTEM_PROMPT = SYSTEM_PROMPT_STR.strip()
 
 
-def format_bboxes(bboxes):
+def get_prompt(bboxes, img, task, past_outputs, bbox_stats=None, bbox_token_budget=BBOX_TOKEN_BUDGET,
+               outline=None, tabs=()):
     """
-    bboxes: should be returned by mark_page
+    bbox_stats: optional BboxStats to record the bounding box tokens in
+    outline: what's off-screen, from viewport-first marking
+    tabs: the other open tabs (util.agent.Tab), listed with their own labels
     """
-    if not bboxes:
-        return '\nBounding Boxes: None\n'
-    ret_str = '\nBounding Boxes:\n'
-    for i, bbox in enumerate(bboxes):
-        text = bbox.get('ariaLabel') or ""
-        if not text.strip():
-            text = bbox['text']
-        ret_str += f'{i} (<{bbox.get('type')}>): {text}\n'
-    return ret_str
-
-
-def get_prompt(bboxes, img, task, past_outputs):
-    past_outputs = [] if past_outputs is None or past_outputs == '' else [
-        HumanMessage(past_outputs)]
-    state = {
-        'formatted_bboxes': format_bboxes(bboxes),
-        'img': img, 'task': task, 'past_outputs': past_outputs}
-    return TEMPLATE.invoke(state)
+    with span('get_prompt', n_bboxes=len(bboxes)) as s:
+        formatted_bboxes, stats = serialize_bboxes(bboxes, task, bbox_token_budget)
+        if bbox_stats is not None:
+            bbox_stats.record(stats)
+        formatted_bboxes += format_outline(outline)
+        formatted_tabs = format_tabs(tabs, task)
+        s.set(bbox_chars=len(formatted_bboxes), img_chars=len(img), bbox_tokens=stats['tokens'],
+              bbox_tokens_saved=stats['tokens_saved'])
+        return build_prompt(SYSTEM_PROMPT, task, [past_outputs, formatted_tabs, formatted_bboxes], img, s)
 
 # TODO maybe do an "Extract Info" prompt that feeds JUST the screenshot to try to answer the question.
@@ -1,11 +1,38 @@
 import json
-import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from selenium_tools.web_util import mark_page, unmark_page, take_screenshot
-from util.agent import State, LMModel, parse_output
+from selenium_tools.web_util import unmark_page, wait_for_settle
+from util.agent import State, LMModel, command_groups
+from util.action_dag import uses_dag, SKIPPED
+from util.output_parser import parse, validate, parse_with_repair
+from util.tracing import span
+from util.memory import Memory
+from util.trajectory import TrajectoryStore, TrajectorySession
+from util.json_stream import ActionStream
 from agents.compiler2_multiagent.prompt import get_executor_prompt, get_validator_prompt
 
+# Validator scores that decide what the outer loop does
+PROGRESS_THRESHOLD = 90
+PROGRESS_LOWER_THRESHOLD = 80
+RESTART_THRESHOLD = 80
+
+# what replies must look like, see util/output_parser.py
+EXECUTOR_SCHEMA = {'fields': {'thought': str, 'action': list},
+                   'required': ['action'],
+                   'commands': {'click': {'idx': int},
+                                'type': {'idx': int, 'content': str},
+                                'scroll': {'idx': (int, {'WINDOW'}), 'dir': {'up', 'down'}},
+                                'open': {'idx': int, 'tab': str},
+                                'extract': {'tab': str},
+                                'switch': {'tab': str},
+                                'close': {'tab': str},
+                                'finish': {}}}
+VALIDATOR_SCHEMA = {'fields': {'description': str, 'completioncriteria': (list, str), 'feedback': str,
+                               'progress': int, 'shouldrestart': int, 'answer': str},
+                    'required': ['progress', 'shouldrestart'],
+                    'ranges': {'progress': (0, 100), 'shouldrestart': (0, 100)}}
+
 def format_action(x):
     if 'command' not in x:
         return f'\tINVALID COMMAND: {x}'
@@ -41,67 +68,166 @@ def get_evaluation(validator_data):
 
 
 class MultiAgentState(State):
-    def __init__(self, driver, start_site):
-        super().__init__(driver, start_site)
+    def __init__(self, driver, start_site, **kwargs):
+        super().__init__(driver, start_site, **kwargs)
 
     def prep_browser_variables(self, **kwargs):
         mark = kwargs.get('mark', True)
         if mark:
-            self.elements = mark_page(self.driver)
+            # the Validator only looks at the focused tab
+            self.observe_tabs()
+        wait_for_settle(self.driver)
+        if mark:
+            self.elements, self.outline = self.mark_page()
         else:
             unmark_page(self.driver)
             self.elements = []
-        self.img = take_screenshot(self.driver, remove=False)
+            self.outline = None
+        self._take_screenshot()
+        self._record_observation(marked=mark)
 
 
 class Executor:
-    def __init__(self, lm_model: LMModel, state: MultiAgentState):
+    def __init__(self, lm_model: LMModel, state: MultiAgentState, memory: Memory = None, streaming=False,
+                 max_repairs=1):
         """
         Executor agent, much like in compiler1. However, LLM and state objects are now shared between many agents.
+        memory: Memory of past steps, a default one if not given
+        streaming: in run_one_iter, stream the response and run each action as soon as it's generated
+        max_repairs: text-only re-prompts to fix a reply that can't be parsed, before giving up on the step
         """
 
         self.model = lm_model
         self._last_response = None
         self.last_parsed_output = None
+        self.last_error = None  # why the last reply couldn't be used
+        self.max_repairs = max_repairs
+        self.parse_stats = {}  # ok/reprompted/failed replies, and replayed steps
         self.done = False
-        self.past_thoughts = []
+        self.memory = memory if memory is not None else Memory()
         self.command_results = []
         self.past_observation_summary = ''
         self.task = ''
+        self.tip = ''  # latest Validator feedback
+        self.streaming = streaming
+        self.trajectory = TrajectorySession('compiler2', '')  # the Validator's, which knows the task
+        self._replayed = None  # recorded output for the current step, instead of asking the LLM
 
         self.state = state
         self.args_dict = {'click': self.state.click,
                           'type': self.state.type,
                           'scroll': self.state.scroll,
+                          'open': self.state.open_tab,
+                          'extract': self.state.extract,
+                          'switch': self.state.focus_tab,
+                          'close': self.state.close_tab,
                           'finish': self._finish}
     
     def run_one_iter(self):
         """
         Runs one iteration of creating/responding to a prompt, then executing appropriate commands
         """
+        if self.streaming:
+            yield from self.plan_and_act()
+            return
+        yield from self.plan()
+        yield from self.act()
+
+    def plan_and_act(self):
+        """
+        Like plan() then act(), but each action is executed as soon as the LLM finishes generating it,
+        while the rest of the response is still streaming in.
+        """
+        prompt = self._create_prompt()
+        if self._replayed is not None:
+            # nothing to stream
+            self._get_response(prompt)
+            yield format_output_dict_as_string(self.last_parsed_output)
+            yield from self.act()
+            return
+        parser = ActionStream()
+        self._start_commands()
+        # the plan has deps/tabs, or an action couldn't be parsed on its own: run the rest once the reply is complete
+        deferred = False
+        ran = 0  # actions run while streaming, always the first ones of the plan
+        for chunk in self.model.stream(prompt):
+            for kind, key, value in parser.feed(chunk):
+                if kind == 'field':
+                    if value:
+                        yield f'{key.capitalize()}: {value}'
+                elif kind == 'invalid' or deferred or uses_dag([value]):
+                    deferred = True
+                else:
+                    action, errors = validate({'action': [value]}, EXECUTOR_SCHEMA)
+                    yield self._run_command(action['action'][0], ' '.join(errors) or None)
+                    ran += 1
+        self._last_response = parser.text
+        # no re-prompt here, some actions have already run
+        self.last_parsed_output, self.last_error = parse(parser.text, EXECUTOR_SCHEMA)
+        if not isinstance(self.last_parsed_output, dict) or 'action' not in self.last_parsed_output:
+            self.parse_stats['failed'] = self.parse_stats.get('failed', 0) + 1
+            yield f'Data from LLM was badly formatted: {self.last_error}'
+            if not parser.actions:
+                self.last_parsed_output = None
+                self._execute_commands()
+                return
+            # keep what was already done
+            self.last_parsed_output = {'thought': parser.fields.get('thought'), 'action': parser.actions}
+        else:
+            self.parse_stats['ok'] = self.parse_stats.get('ok', 0) + 1
+        actions = self.last_parsed_output['action']
+        if deferred or uses_dag(actions):
+            yield from self._run_plan(actions)
+        else:
+            # anything that wasn't run on the way
+            for command in actions[ran:]:
+                yield self._run_command(command)
+        self._end_commands()
+
+    def plan(self):
+        """
+        Observe the page and ask the LLM what to do, without doing it yet
+        """
         prompt = self._create_prompt()
         self._get_response(prompt)
         yield format_output_dict_as_string(self.last_parsed_output)
+
+    def act(self):
+        """
+        Execute the commands from the last plan()
+        """
         yield '\nExecuting Commands...'
         self._execute_commands()
         yield '\n'.join([f'{format_action(c)} - {r}' for c, r in self.command_results]) if self.command_results else '\tNone'
-        time.sleep(2)
+
+    def discard_plan(self):
+        self.last_parsed_output = None
+        self.command_results = []
 
     def _create_prompt(self):
         """
         Take screenshot, get bboxes, and create prompt for next WebVoyager iteration
         """
         self.state.prep_browser_variables(mark=True)
+        past_outputs = '\n'.join(x for x in [self.past_observation_summary, self.state.stuck_hint(marked=True)] if x)
         prompt = get_executor_prompt(bboxes=self.state.elements, task=self.task,
-                                     img=self.state.img, past_outputs=self.past_observation_summary)
+                                     img=self.state.img, past_outputs=past_outputs,
+                                     bbox_stats=self.state.bbox_stats, outline=self.state.outline, tip=self.tip,
+                                     tabs=self.state.other_tabs())
+        self._replayed = self.trajectory.observe('executor', self.state)
         return prompt
     
     def _get_response(self, prompt):
         """
-        Prompt the LLM and parse the output
+        Prompt the LLM and parse the output, unless a recorded trajectory already knows what to do here
         """
+        if self._replayed is not None:
+            self.last_parsed_output, self.last_error = self._replayed, None
+            self.parse_stats['replayed'] = self.parse_stats.get('replayed', 0) + 1
+            return
         self._last_response = self.model(prompt)
-        self.last_parsed_output = parse_output(self._last_response)
+        self.last_parsed_output, self._last_response, self.last_error = parse_with_repair(
+            self.model, self._last_response, EXECUTOR_SCHEMA, self.parse_stats, self.max_repairs)
 
 
     def _execute_commands(self):
@@ -110,31 +236,82 @@ class Executor:
         and update past observation with previous thoughts, etc.
         """
         if not isinstance(self.last_parsed_output, dict) or 'action' not in self.last_parsed_output:
+            # let the model know why the step was wasted
+            self.command_results = [('invalid output', self.last_error)]
+            self.memory.add_step(None, self.command_results)
+            self.past_observation_summary = self.memory.render()
             return 'You provided invalid output. Please format using the JSON guidelines given to you.'
 
-        # update thought
-        if 'thought' in self.last_parsed_output:
-            self.past_thoughts.append(self.last_parsed_output["thought"])
-        
         # Execute commands and update command_results
+        self._start_commands()
+        actions = self.last_parsed_output['action']
+        if uses_dag(actions):
+            for _ in self._run_plan(actions):
+                pass
+            actions = []
+        for batched, group in command_groups(actions):
+            if batched and not self._execution_error:
+                with span('command_batch', commands=[c['command'] for c in group]) as s:
+                    results = self.state.execute_batch(group)
+                    s.set(ok=all(ok for ok, _ in results))
+                for command, (exit_state, response) in zip(group, results):
+                    self._record(command, exit_state, response)
+                # the batch also stops early once the page navigated, the rest would act on the old page
+                self._execution_error = self._execution_error or len(results) < len(group)
+                group = group[len(results):]
+            for command in group:
+                self._run_command(command)
+        self._end_commands()
+
+    def _start_commands(self):
         self.command_results = []
-        execution_error = False
-        for command in self.last_parsed_output['action']:
-            if not execution_error:
-                exit_state, response = self._execute_command(command)
-                if response is not None:
-                    self.command_results.append((command, response))
-                else:
-                    self.command_results.append((command, 'executed'))
-                execution_error = execution_error or not exit_state
+        self._outcomes = []  # (exit_state, response) per command in command_results
+        self._failed = []
+        self._execution_error = False
+
+    def _run_plan(self, actions):
+        """
+        Runs the actions that haven't run yet as a dependency graph (see util/action_dag.py), each in its tab,
+        and yields their formatted results
+        """
+        done = len(self._outcomes)
+        results = self.state.run_plan(actions, self._execute_command, self._outcomes)
+        for command, (exit_state, response) in zip(actions[done:], results[done:]):
+            if response == SKIPPED:
+                # not a failure of its own
+                self.command_results.append((command, SKIPPED))
+                self._outcomes.append((exit_state, response))
             else:
-                # Halt execution after making one execution error
-                self.command_results.append((command, 'Execution halted before reaching this'))
+                self._record(command, exit_state, response)
+            yield f'{format_action(command)} - {self.command_results[-1][1]}'
+
+    def _run_command(self, command, error=None):
+        """
+        Executes one command of the plan, and returns its formatted result.
+        error: why the command is invalid, it's then reported as failed without running it
+        """
+        if not self._execution_error:
+            exit_state, response = (False, error) if error is not None else self._execute_command(command)
+            self._record(command, exit_state, response)
+        else:
+            # Halt execution after making one execution error
+            self.command_results.append((command, SKIPPED))
+            self._outcomes.append((False, SKIPPED))
+        return f'{format_action(command)} - {self.command_results[-1][1]}'
 
+    def _record(self, command, exit_state, response):
+        self.command_results.append((command, response if response is not None else 'executed'))
+        self._outcomes.append((exit_state, response))
+        if not exit_state:
+            self._failed.append((command, response))
+        self._execution_error = not exit_state
+
+    def _end_commands(self):
+        self.trajectory.record('executor', self.last_parsed_output, self._outcomes)
         # Update observation
-        past_thoughts_formatted = '\n'.join([f'{i} - {thought}' for i, thought in enumerate(self.past_thoughts)])
-        command_results_str = [f'{c} - {res}' for c, res in self.command_results] # format as string
-        self.past_observation_summary = f'Previous Steps:\n{past_thoughts_formatted}\nActions from last step:\n{"\n".join(command_results_str) if command_results_str else "No Commands Executed"}'
+        self.memory.add_step(self.last_parsed_output.get('thought'), self.command_results, self._failed,
+                             url=self.state.driver.current_url)
+        self.past_observation_summary = self.memory.render()
     
     # def _execute_commands(self):
     #     """
@@ -177,14 +354,27 @@ class Executor:
             command_str, None) if command_str is not None else None
         if command is None:
             return False, 'No command given. Make sure to include a "command" key!'
-        return command(data)
+        with span('command', command=command_str) as s:
+            exit_state, response = command(data)
+            s.set(ok=exit_state)
+        return exit_state, response
 
     def _finish(self, args):
         self.done = True
         return True, None
 
 class Validator:
-    def __init__(self, task: str, state: MultiAgentState, lm_model: LMModel, executor: Executor, loops_before_validate=2):
+    def __init__(self, task: str, state: MultiAgentState, lm_model: LMModel, executor: Executor, loops_before_validate=2,
+                 pipelined=False, progress_threshold=PROGRESS_THRESHOLD, restart_threshold=RESTART_THRESHOLD,
+                 max_repairs=1, trajectories=None):
+        """
+        pipelined: evaluate the page in the background while the executor plans its last step of the iteration.
+        If the evaluation's progress/shouldrestart pass the thresholds, the planned actions are dropped.
+        max_repairs: text-only re-prompts to fix a reply that can't be parsed
+        trajectories: TrajectoryStore to replay matching runs from and record this one in (configured with
+        TRAJECTORY_MODE if not given, see util/trajectory.py). Shared with the executor. Call
+        self.trajectory.finish(answer, success) to save the run.
+        """
         self.task = task
         self.state = state
         self.steps = []
@@ -194,8 +384,21 @@ class Validator:
         self.executor = executor
         self.executor.task = self.task
         self.loops_before_validate = loops_before_validate
+        self.skipped_evaluations = 0
+        self.pipelined = pipelined
+        self.progress_threshold = progress_threshold
+        self.restart_threshold = restart_threshold
+        self.max_repairs = max_repairs
+        self.parse_stats = {}  # ok/reprompted/failed replies, and replayed evaluations
+        self.last_error = None
+        self.trajectory = TrajectorySession('compiler2', task,
+                                            trajectories if trajectories is not None else TrajectoryStore.from_env())
+        self.executor.trajectory = self.trajectory
+        self._replayed = None  # recorded evaluation for the current snapshot, instead of asking the LLM
+        self._pool = ThreadPoolExecutor(max_workers=1) if pipelined else None
 
         self._last_response, self.last_parsed_output = None, None
+        self._last_feedback = None  # manual_feedback used for the last evaluation
 
     def run_one_iter(self):
         """
@@ -204,6 +407,9 @@ class Validator:
         Runs the executor self.loops_before_validate times, or until a 'finish' command is issued.
         Then, validates the outputs, storing self.last_parsed_output
         """
+        if self.pipelined:
+            yield from self._run_one_iter_pipelined()
+            return
         self.executor.done = False
         for i in range(self.loops_before_validate):
             yield from self.executor.run_one_iter()
@@ -212,17 +418,73 @@ class Validator:
                 break
         yield from self.evaluate()
 
+    def _run_one_iter_pipelined(self):
+        """
+        Like run_one_iter, but the validator looks at the page before the executor's last step,
+        and its LLM call runs while the executor plans that step.
+        """
+        self.executor.done = False
+        for i in range(self.loops_before_validate - 1):
+            yield from self.executor.run_one_iter()
+            if self.executor.done:
+                yield '\nFinish command issued, breaking loop...\n'
+                break
+
+        prompt = self._snapshot()
+        future = self._pool.submit(self._get_response, prompt) if prompt is not None else None
+        if not self.executor.done:
+            yield from self.executor.plan()
+        if future is None:
+            yield 'Page unchanged since last evaluation, skipping validator call...'
+        else:
+            future.result()
+        yield get_evaluation(self.last_parsed_output)
+
+        if self.executor.done:
+            return
+        if self._should_stop():
+            yield '\nValidator wants to finish or restart, dropping the planned actions...'
+            self.executor.discard_plan()
+        else:
+            yield from self.executor.act()
+
+    def _should_stop(self):
+        data = self.last_parsed_output
+        if not isinstance(data, dict):
+            return False
+        try:
+            return int(data.get('progress', 0)) >= self.progress_threshold or \
+                int(data.get('shouldrestart', 0)) >= self.restart_threshold
+        except (TypeError, ValueError):
+            return False
+
     def evaluate(self):
-        prompt = self._create_prompt()
-        self._get_response(prompt)
+        prompt = self._snapshot()
+        if prompt is None:
+            yield 'Page unchanged since last evaluation, skipping validator call...'
+        else:
+            self._get_response(prompt)
         yield get_evaluation(self.last_parsed_output)
 
+    def _snapshot(self):
+        """
+        Screenshot the page and create the validator prompt, or None if the last evaluation still holds
+        """
+        self.state.prep_browser_variables(mark=False)
+        if self.last_parsed_output is not None and not self.state.page_changed(marked=False) \
+                and self.manual_feedback == self._last_feedback:
+            # nothing new to look at
+            self.skipped_evaluations += 1
+            return None
+        self._last_feedback = self.manual_feedback
+        self._replayed = self.trajectory.observe('validator', self.state) if not self.manual_feedback else None
+        return self._create_prompt()
+
 
     def _create_prompt(self):
         """
-        Take screenshot
+        Create prompt from the screenshot taken in _snapshot()
         """
-        self.state.prep_browser_variables(mark=False)
         # log = '\n'.join([f'{i}. {item}' for i, item in enumerate(self.executor.past_thoughts)])
         log = f'HUMAN FEEDBACK, FOLLOW CLOSELY: {self.manual_feedback}' # don't add past steps, it can reinforce the reasoning of the validator which is bad
         prompt = get_validator_prompt(img=self.state.img, log=log, task=self.task)
@@ -230,7 +492,13 @@ class Validator:
     
     def _get_response(self, prompt):
         """
-        Prompt the LLM and parse the output
+        Prompt the LLM and parse the output, unless a recorded trajectory already has this evaluation
         """
-        self._last_response = self.model(prompt)
-        self.last_parsed_output = parse_output(self._last_response)
+        if self._replayed is not None:
+            self.last_parsed_output, self.last_error = self._replayed, None
+            self.parse_stats['replayed'] = self.parse_stats.get('replayed', 0) + 1
+        else:
+            self._last_response = self.model(prompt)
+            self.last_parsed_output, self._last_response, self.last_error = parse_with_repair(
+                self.model, self._last_response, VALIDATOR_SCHEMA, self.parse_stats, self.max_repairs)
+        self.trajectory.record('validator', self.last_parsed_output)
@@ -1,10 +1,7 @@
 from selenium_tools.web_util import mark_page
-
-from langchain.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain_core.prompts.image import ImagePromptTemplate
-from langchain_core.messages.system import SystemMessage
-from langchain_core.messages.human import HumanMessage
+from util.tracing import span
+from util.bbox_format import serialize_bboxes, format_outline, format_tabs, BBOX_TOKEN_BUDGET
+from util.prompt_layout import build_prompt
 
 # Manager, Executor
 
@@ -24,11 +21,20 @@ The command descriptions and signatures are given below:
 1. Click a Web Element - click: idx(int)
 2. Delete existing content in a textbox, type content, then press ENTER - type: idx(int), content(string)
 3. Scroll - idx(int or WINDOW) dir(up or down)
-4. Finish - finish
+4. Open a link in a new background tab, and name the tab - open: idx(int), tab(string)
+5. Read the text of a tab's page (the first tab is "main"), optionally only the parts about query - extract: tab(string), query(string)
+6. Look at another tab from the next step on - switch: tab(string)
+7. Close a tab - close: tab(string)
+8. Finish - finish
 
 Each command call must STRICTLY be in json format, contain a 'command' key specifying the command, and respective keys for each argument. 
 eg. {{"command": "click", "idx": 3}}
 
+Commands run in order. Independent work can run in parallel instead: add a "deps" key listing the indices of the earlier commands it needs.
+eg. to compare several results, open each in its own tab, then extract from each, all in one reply:
+[{{"command": "open", "idx": 4, "tab": "r1"}}, {{"command": "open", "idx": 7, "tab": "r2"}}, {{"command": "extract", "tab": "r1", "query": "price", "deps": [0]}}, {{"command": "extract", "tab": "r2", "query": "price", "deps": [1]}}]
+Extracted text is shown to you in the next step. Commands without a "tab" run in the tab you are looking at.
+
 Your reply should be in a JSON, with no additional comments/text, and have the following keys:
 thought(string): {{Reason about what this page is. Summarize what you need to do now, IF ANYTHING.}}
 action(list of json objects): {{one object for each action to perform, each should have a "reason" key, a "command" key, and relevant keys for arguments.}}
@@ -105,13 +111,9 @@ shouldrestart(int): is the user completely off track and should restart? grade o
 answer(string): if the task is a question, try to answer the question. If it's a task, just leave this blank.
 """
 
-EXECUTOR_TEMPLATE = ChatPromptTemplate(messages=[
-    SystemMessage(EXECUTOR_PROMPT_STR.strip()),
-    MessagesPlaceholder("past_outputs"),
-    ('user', [{"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{img}", "detail": "low"}}]), # low detail for now?
-    ('user', '{formatted_bboxes}'),
-    ('user', "TASK: {task}")
-])
+# stable to volatile, see util/prompt_layout.py: system, task, past outputs/log, bboxes, screenshot (low detail for now?)
+EXECUTOR_PROMPT = EXECUTOR_PROMPT_STR.strip()
+VALIDATOR_PROMPT = VALIDATOR_PROMPT_STRING.strip()
 
 # MANAGER_TEMPLATE = ChatPromptTemplate(messages=[
 #     SystemMessage(MANAGER_PROMPT_STR.strip()),
@@ -120,37 +122,30 @@ EXECUTOR_TEMPLATE = ChatPromptTemplate(messages=[
 #     ('user', "TASK: {task}")
 # ])
 
-VALIDATOR_TEMPLATE = ChatPromptTemplate(messages=[
-    SystemMessage(VALIDATOR_PROMPT_STRING.strip()),
-    ('user', [{"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{img}", "detail": "low"}}]),
-    ('user', '{log}'),
-    ('user', 'TASK: {task}')
-])
 
-def format_bboxes(bboxes):
+def get_executor_prompt(bboxes, img, task, past_outputs, bbox_stats=None, bbox_token_budget=BBOX_TOKEN_BUDGET,
+                        outline=None, tip='', tabs=()):
     """
-    bboxes: should be returned by mark_page
+    bbox_stats: optional BboxStats to record the bounding box tokens in
+    outline: what's off-screen, from viewport-first marking
+    tabs: the other open tabs (util.agent.Tab), listed with their own labels
+    tip: the Validator's latest feedback, kept out of the task so the cached prefix survives it
     """
-    if not bboxes:
-        return '\nBounding Boxes: None\n'
-    ret_str = '\nBounding Boxes:\n'
-    for i, bbox in enumerate(bboxes):
-        text = bbox.get('ariaLabel') or ""
-        if not text.strip():
-            text = bbox['text']
-        ret_str += f'{i} (<{bbox.get('type')}>): {text}\n'
-    return ret_str
-
-def get_executor_prompt(bboxes, img, task, past_outputs):
-    past_outputs = [] if past_outputs is None or past_outputs == '' else [HumanMessage(past_outputs)]
-    
-    state = {'formatted_bboxes': format_bboxes(bboxes), 'img': img, 'task': task, 'past_outputs': past_outputs}
-    return EXECUTOR_TEMPLATE.invoke(state)
+    tip = f"Tip: {tip}" if tip else ''
+    with span('get_executor_prompt', n_bboxes=len(bboxes)) as s:
+        formatted_bboxes, stats = serialize_bboxes(bboxes, f"{task} {tip}", bbox_token_budget)
+        if bbox_stats is not None:
+            bbox_stats.record(stats)
+        formatted_bboxes += format_outline(outline)
+        formatted_tabs = format_tabs(tabs, task)
+        s.set(bbox_chars=len(formatted_bboxes), img_chars=len(img), bbox_tokens=stats['tokens'],
+              bbox_tokens_saved=stats['tokens_saved'])
+        return build_prompt(EXECUTOR_PROMPT, task, [tip, past_outputs, formatted_tabs, formatted_bboxes], img, s)
 
 # def get_manager_prompt(img, past_thoughts, task):
 #     state = {'img': img, 'past_thoughts': past_thoughts, 'task': task}
 #     return MANAGER_TEMPLATE.invoke(state)
 
 def get_validator_prompt(img, log, task):
-    state = {'img': img, 'log': log, 'task': task}
-    return VALIDATOR_TEMPLATE.invoke(state)
\ No newline at end of file
+    with span('get_validator_prompt', img_chars=len(img)) as s:
+        return build_prompt(VALIDATOR_PROMPT, task, [log], img, s)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+"""
+Serves bench/fixtures on localhost, so agents can be run without a network.
+
+with FixtureServer() as server:
+    driver.get(server.url('search.html'))
+"""
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer:
+    def __init__(self, directory=FIXTURES_DIR, port=0):
+        """
+        port=0 picks a free port
+        """
+        handler = partial(_QuietHandler, directory=directory)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def url(self, path=''):
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
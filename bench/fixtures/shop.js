@@ -0,0 +1,23 @@
+// Deterministic fake product catalog shared by the shop pages
+var COLORS = ["Red", "Blue", "Green", "Black", "White"];
+var KINDS = ["Widget", "Gadget", "Keyboard", "Mouse", "Lamp"];
+
+function product(id) {
+  return {
+    id: id,
+    name: COLORS[id % COLORS.length] + " " + KINDS[Math.floor(id / COLORS.length) % KINDS.length] + " #" + id,
+    price: (5 + ((id * 37) % 95) + 0.99).toFixed(2),
+  };
+}
+
+function search(query, limit) {
+  var words = query.toLowerCase().split(/\s+/).filter(Boolean);
+  var out = [];
+  for (var id = 0; id < 200 && out.length < limit; id++) {
+    var p = product(id);
+    if (words.every((w) => p.name.toLowerCase().includes(w))) {
+      out.push(p);
+    }
+  }
+  return out;
+}
@@ -0,0 +1,47 @@
+import sys
+import time
+
+from util.webdriver import chrome_new_webdriver
+from selenium_tools.web_util import mark_page, unmark_page, mark_page_script, _install_script, _mark_page_call
+
+"""
+Micro-benchmark: sending mark_page.js on every call vs installing it once per document.
+
+Run from the repo root: python -m bench.mark_page_install [url] [n_calls]
+"""
+
+url = sys.argv[1] if len(sys.argv) > 1 else "https://www.google.com"
+n_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+driver = chrome_new_webdriver()
+driver.get(url)
+time.sleep(2)
+
+
+def old_mark_page():
+    # what mark_page/unmark_page used to do, the whole script before every call
+    driver.execute_script(mark_page_script)
+    return driver.execute_script("return window.markPage();")
+
+
+def bench(fn):
+    fn()  # warm up, also installs the script for the new path
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        fn()
+    return (time.perf_counter() - start) / n_calls
+
+
+old_s = bench(old_mark_page)
+new_s = bench(lambda: mark_page(driver, incremental=False))
+unmark_page(driver)
+
+old_bytes = len(mark_page_script.encode('utf-8')) + len("return window.markPage();")
+new_bytes = len(_mark_page_call.encode('utf-8'))
+print(f"URL: {url} ({n_calls} calls each)")
+print(f"Script sent every call: {old_s * 1000:.1f} ms/call, {old_bytes} bytes/call sent")
+print(f"Installed once:         {new_s * 1000:.1f} ms/call, {new_bytes} bytes/call sent "
+      f"(+{len(_install_script.encode('utf-8'))} bytes once per document)")
+print(f"Saved: {(old_s - new_s) * 1000:.1f} ms/call, {old_bytes - new_bytes} bytes/call")
+
+driver.quit()
@@ -0,0 +1,44 @@
+import sys
+import time
+
+from util.webdriver import chrome_new_webdriver
+from util.rate_limiter import count_tokens
+from util.bbox_format import serialize_bboxes, format_outline
+from selenium_tools.web_util import mark_page_with_outline, unmark_page, wait_for_settle
+
+"""
+Micro-benchmark: marking the whole page vs viewport-first marking (in-view elements plus an off-screen outline).
+Compares marking time and the bounding box tokens that go in the prompt.
+
+Run from the repo root: python -m bench.mark_page_viewport [url] [n_calls]
+"""
+
+url = sys.argv[1] if len(sys.argv) > 1 else "https://en.wikipedia.org/wiki/Web_browser"
+n_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+driver = chrome_new_webdriver()
+driver.get(url)
+wait_for_settle(driver)
+
+
+def bench(viewport):
+    mark_page_with_outline(driver, incremental=False, viewport=viewport)  # warm up
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        items, outline = mark_page_with_outline(driver, incremental=False, viewport=viewport)
+    elapsed = (time.perf_counter() - start) / n_calls
+    # no budget, to compare the full serialized size
+    text = serialize_bboxes(items, token_budget=10 ** 9)[0] + format_outline(outline)
+    return elapsed, len(items), count_tokens(text)
+
+
+full_s, full_n, full_tokens = bench(False)
+view_s, view_n, view_tokens = bench(True)
+unmark_page(driver)
+
+print(f"URL: {url} ({n_calls} calls each)")
+print(f"Whole page:     {full_s * 1000:.1f} ms/call, {full_n} elements, ~{full_tokens} tokens")
+print(f"Viewport-first: {view_s * 1000:.1f} ms/call, {view_n} elements, ~{view_tokens} tokens (with outline)")
+print(f"Saved: {(full_s - view_s) * 1000:.1f} ms/call, ~{full_tokens - view_tokens} tokens/iteration")
+
+driver.quit()
@@ -0,0 +1,160 @@
+import re
+import json
+import time
+import asyncio
+import threading
+
+from util.rate_limiter import estimate_tokens
+from util.prompt_layout import prefix_hash
+
+"""
+Drop-in stand-in for LMModel that never touches the network, for offline benchmarks/regression runs.
+
+The model follows a script: one response per Agent/Executor call, e.g.
+[{"thought": "search", "action": [{"command": "type", "target": "Search products", "content": "blue widget"}]},
+ {"thought": "done", "action": [{"command": "answer", "content": "$42.99"}]}]
+
+- "target" is resolved to the idx of the first bounding box in the prompt whose text contains it (case-insensitive).
+  If it's not on the page yet, the model scrolls down and retries the same step on the next call.
+- "answer" becomes "finish" for the Executor, which has no answer command. The answer is then reported by the
+  Validator, which gives progress 100 once the script is done and 50 before that.
+- metadata['cached_tokens'] mimics a provider-side prompt cache (OpenAI's: prefixes of 1024+ tokens, in 128 token
+  steps), at message granularity, so prompt layout changes can be measured offline.
+"""
+
+BBOX_PATTERN = re.compile(r'^(\d+) \(<(\w+)>\): (.*)$', re.MULTILINE)
+# share of the latency spent before the first streamed chunk
+FIRST_CHUNK_LATENCY = 0.3
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+
+def _text(message):
+    if isinstance(message.content, str):
+        return message.content
+    return '\n'.join(part.get('text', '') for part in message.content if isinstance(part, dict))
+
+
+class ScriptedLMModel:
+    def __init__(self, script, model_name='scripted', latency=0):
+        """
+        latency: seconds to sleep per call, to mimic an API round-trip
+        """
+        self.script = script
+        self.model_name = model_name
+        self.latency = latency
+        self.cache = None
+        self.metadata = {'input_tokens': 0,
+                         'output_tokens': 0, 'total_tokens': 0, 'cached_tokens': 0}
+        self._seen_prefixes = set()
+        self.step = 0
+        self.answer = None
+        self.n_calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prompt_kind(messages):
+        system = '\n'.join(_text(m) for m in messages if m.type == 'system').lower()
+        if 'grading' in system:
+            return 'validator'
+        if '- finish' in system:
+            return 'executor'
+        return 'agent'
+
+    @staticmethod
+    def bboxes(messages):
+        """
+        [(idx, type, text)] parsed from the formatted bounding boxes in the prompt
+        """
+        text = '\n'.join(_text(m) for m in messages if m.type != 'system')
+        return [(int(i), t, s) for i, t, s in BBOX_PATTERN.findall(text)]
+
+    def _resolve(self, action, bboxes):
+        """
+        Replace "target" with an idx, or return None if it isn't on the page
+        """
+        action = dict(action)
+        target = action.pop('target', None)
+        if target is None:
+            return action
+        for idx, _, text in bboxes:
+            if target.lower() in text.lower():
+                return {**action, 'idx': idx}
+        return None
+
+    def _respond(self, messages):
+        kind = self.prompt_kind(messages)
+        if kind == 'validator':
+            if self.step >= len(self.script):
+                return {'description': 'Script finished', 'completioncriteria': [], 'feedback': '',
+                        'progress': 100, 'shouldrestart': 0, 'answer': self.answer or 'Done.'}
+            return {'description': 'Script in progress', 'completioncriteria': [], 'feedback': 'Keep going',
+                    'progress': 50, 'shouldrestart': 0, 'answer': ''}
+
+        if self.step >= len(self.script):
+            done = {'command': 'finish'} if kind == 'executor' else {'command': 'answer', 'content': self.answer or 'Done.'}
+            return {'page': 'done', 'thought': 'Script finished', 'action': [done]}
+
+        step = self.script[self.step]
+        bboxes = self.bboxes(messages)
+        actions = []
+        for action in step.get('action', []):
+            resolved = self._resolve(action, bboxes)
+            if resolved is None:
+                return {'page': 'target not found', 'thought': f'Looking for {action["target"]}',
+                        'action': [{'command': 'scroll', 'idx': 'WINDOW', 'dir': 'down'}]}
+            if resolved.get('command') == 'answer':
+                self.answer = resolved.get('content')
+                if kind == 'executor':
+                    resolved = {'command': 'finish'}
+            actions.append(resolved)
+        self.step += 1
+        return {'page': step.get('page', ''), 'thought': step.get('thought', ''), 'action': actions}
+
+    def _cached_tokens(self, messages):
+        """
+        Tokens in the longest run of leading messages that an earlier call already sent
+        """
+        cached = 0
+        for i in range(1, len(messages) + 1):
+            key = prefix_hash(messages[:i])
+            if key in self._seen_prefixes:
+                cached = estimate_tokens(messages[:i])
+            self._seen_prefixes.add(key)
+        if cached < CACHE_MIN_TOKENS:
+            return 0
+        return cached // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+    def _call(self, messages):
+        with self._lock:
+            self.n_calls += 1
+            content = json.dumps(self._respond(messages))
+            input_tokens, output_tokens = estimate_tokens(messages), len(content) // 4
+            self.metadata['cached_tokens'] += self._cached_tokens(messages)
+            self.metadata['input_tokens'] += input_tokens
+            self.metadata['output_tokens'] += output_tokens
+            self.metadata['total_tokens'] += input_tokens + output_tokens
+        return content
+
+    def __call__(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._call(prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt)
+
+    def stream(self, prompt, chunk_chars=16):
+        """
+        Yields the response a few characters at a time, with the latency split between the first chunk and the rest
+        """
+        if self.latency:
+            time.sleep(self.latency * FIRST_CHUNK_LATENCY)
+        content = self._call(prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt)
+        chunks = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+        for chunk in chunks:
+            yield chunk
+            if self.latency:
+                time.sleep(self.latency * (1 - FIRST_CHUNK_LATENCY) / len(chunks))
+
+    async def acall(self, prompt):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._call(prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt)
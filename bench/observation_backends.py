@@ -0,0 +1,66 @@
+import sys
+import time
+
+from util.webdriver import chrome_new_webdriver
+from util.rate_limiter import count_tokens
+from util.bbox_format import serialize_bboxes, format_outline
+from selenium_tools.web_util import mark_page_with_outline, unmark_page, wait_for_settle
+from selenium_tools.ax_tree import ax_mark_page
+from bench.fixture_server import FixtureServer
+
+"""
+Micro-benchmark: the two observation backends, mark_page.js vs the accessibility tree (State(backend='axtree')).
+Compares extraction time (labels included), element count and the bounding box tokens that go in the prompt.
+
+Run from the repo root: python -m bench.observation_backends [url ...] [n_calls]
+Without urls, runs on the fixture pages.
+"""
+
+FIXTURE_PAGES = ['index.html', 'search.html', 'results.html', 'product.html', 'big.html']
+
+args = sys.argv[1:]
+n_calls = int(args.pop()) if args and args[-1].isdigit() else 20
+
+server = None if args else FixtureServer().start()
+urls = args or [server.url(page) for page in FIXTURE_PAGES]
+
+BACKENDS = {
+    'markpage': lambda driver: mark_page_with_outline(driver, incremental=False, viewport=True),
+    'axtree': lambda driver: ax_mark_page(driver, viewport=True),
+}
+
+driver = chrome_new_webdriver()
+
+
+def bench(observe):
+    observe(driver)  # warm up
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        items, outline = observe(driver)
+    elapsed = (time.perf_counter() - start) / n_calls
+    # no budget, to compare the full serialized size
+    text = serialize_bboxes(items, token_budget=10 ** 9)[0] + format_outline(outline)
+    return elapsed, len(items), count_tokens(text)
+
+
+print(f"{n_calls} calls each, viewport-first")
+totals = {name: [0, 0, 0] for name in BACKENDS}
+for url in urls:
+    driver.get(url)
+    wait_for_settle(driver)
+    print(url)
+    for name, observe in BACKENDS.items():
+        s, n, tokens = bench(observe)
+        print(f"  {name:<9} {s * 1000:7.1f} ms/call, {n:4d} elements, ~{tokens} tokens")
+        for i, v in enumerate((s, n, tokens)):
+            totals[name][i] += v
+    unmark_page(driver)
+
+if len(urls) > 1:
+    print("Total")
+    for name, (s, n, tokens) in totals.items():
+        print(f"  {name:<9} {s * 1000:7.1f} ms/call, {n:4d} elements, ~{tokens} tokens")
+
+driver.quit()
+if server:
+    server.stop()
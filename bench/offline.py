@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+from bench.runner import load_tasks, run_suite, Budget, AGENTS
+from bench.fixture_server import FixtureServer, FIXTURES_DIR
+from bench.mock_model import ScriptedLMModel
+from util.tracing import tracer
+from util.trajectory import TrajectoryStore
+
+"""
+Runs the fixture tasks end-to-end against the local fixture server with a scripted model, no network needed.
+Measures the agent's own overhead (browser, marking, screenshots, prompts) and fails if any answer is wrong.
+
+Run from the repo root: python -m bench.offline --agent compiler2 --browsers 2
+
+--repeat 2 runs the suite twice, the second time replaying the trajectories recorded by the first
+(see util/trajectory.py), to show what repeated tasks cost.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--agent', choices=list(AGENTS), default='compiler1')
+parser.add_argument('--browsers', type=int, default=2)
+parser.add_argument('--tasks', default=os.path.join(FIXTURES_DIR, 'tasks.jsonl'))
+parser.add_argument('--latency', type=float, default=0, help='simulated seconds per LLM call')
+parser.add_argument('--out', default=os.path.join('results', 'offline'))
+parser.add_argument('--trace', action='store_true', help='write trace.jsonl and trace.json (Chrome trace format) to --out')
+parser.add_argument('--viewport-first', action='store_true', help='only label what is in view, with an off-screen outline')
+parser.add_argument('--repeat', type=int, default=1, help='runs of the suite, the later ones replay trajectories')
+parser.add_argument('--trajectories', help='trajectory store, a temporary one if --repeat is given')
+args = parser.parse_args()
+if args.trace:
+    tracer.enable()
+
+trajectories = None
+if args.trajectories or args.repeat > 1:
+    # recorded URLs include the fixture server's port, so only runs of the same process can replay each other
+    path = args.trajectories or os.path.join(tempfile.mkdtemp(), 'trajectories.sqlite')
+    trajectories = TrajectoryStore(mode='replay', path=path)
+
+with FixtureServer() as server:
+    tasks = load_tasks(args.tasks)
+    for task in tasks:
+        task['start_site'] = task['start_site'].replace('{base}', server.base_url)
+
+    for n in range(args.repeat):
+        results = run_suite(tasks, args.out, agent=args.agent, n_browsers=args.browsers,
+                            budget=Budget(max_loops=25, max_seconds=120, max_tokens=10_000_000),
+                            model_factory=lambda spec: ScriptedLMModel(spec['script'], latency=args.latency),
+                            trajectories=trajectories, viewport_first=args.viewport_first)
+        if trajectories is not None:
+            replies = sum(sum(v for k, v in r['replies'].items() if k != 'replayed') for r in results)
+            replayed = sum(r['replies'].get('replayed', 0) for r in results)
+            print(f"Run {n + 1}: {replies} LLM replies, {replayed} steps replayed, "
+                  f"{sum(r['wall_seconds'] for r in results):.2f}s\n")
+
+print("\n###############################################################\n")
+phases = {}
+for r in results:
+    for phase, seconds in r['phase_seconds'].items():
+        phases[phase] = phases.get(phase, 0) + seconds
+print(f"Wall time: {sum(r['wall_seconds'] for r in results):.2f}s over {sum(r['iterations'] for r in results)} iterations")
+print(f"Phases: {json.dumps({k: round(v, 3) for k, v in phases.items()})}")
+input_tokens = sum(r['input_tokens'] for r in results)
+print(f"Input tokens: {input_tokens}, {sum(r['cached_tokens'] for r in results)} from the (simulated) prompt cache")
+if args.trace:
+    print(f"Spans: {json.dumps(tracer.summary())}")
+    tracer.export_jsonl(os.path.join(args.out, 'trace.jsonl'))
+    tracer.export_chrome_trace(os.path.join(args.out, 'trace.json'))
+
+failed = [r for r in results if not r['correct']]
+for r in failed:
+    print(f"FAILED [{r['id']}] answer={r['answer']!r} expected={r['expected']!r} "
+          f"stop={r['stop_reason']} error={r['error']}")
+print(f"{len(results) - len(failed)}/{len(results)} passed")
+sys.exit(1 if failed else 0)
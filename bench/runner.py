@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import inspect
+import threading
+from functools import partial
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from util.agent import LMModel
+from util.tracing import span
+from util.webdriver import BrowserPool
+from agents.compiler1.agent import Agent
+from agents.compiler2_multiagent.agent import MultiAgentState, Executor, Validator
+from agents.compiler2_multiagent.agent import PROGRESS_THRESHOLD, RESTART_THRESHOLD
+
+"""
+Non-interactive benchmark runner. Runs a suite of tasks with either agent across several headless browsers,
+and writes one results file per task.
+
+Task files are JSONL, one task per line:
+{"id": "yt-1", "task": "play ma meilleure ennemi youtube video", "start_site": "https://www.google.com", "expected": "..."}
+Only "task" is required.
+"""
+
+# $ per token
+# cached_input: input tokens served from the provider's prompt cache
+PRICING = {'gpt-4o-mini': {'input': 0.15 / 1_000_000, 'cached_input': 0.075 / 1_000_000, 'output': 0.6 / 1_000_000}}
+DEFAULT_START_SITE = 'https://www.google.com'
+
+
+class Budget:
+    def __init__(self, max_loops=10, max_seconds=300, max_tokens=200_000):
+        self.max_loops = max_loops
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+
+    def exceeded(self, n_loops, start, model):
+        """
+        Returns the reason the budget was exceeded, or None
+        """
+        if n_loops >= self.max_loops:
+            return 'loops'
+        if time.perf_counter() - start >= self.max_seconds:
+            return 'time'
+        if model.metadata['total_tokens'] >= self.max_tokens:
+            return 'tokens'
+        return None
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time per phase. Each phase is also a tracing span. A phase entered again while it's running
+    (e.g. a timed method calling another one of the same phase) is only counted once.
+    Also holds the agents' parse_stats, to count iterations wasted on replies that couldn't be used.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.parse_stats = []
+        self._active = threading.local()  # phases running in this thread
+
+    def parse_totals(self):
+        totals = defaultdict(int)
+        for stats in self.parse_stats:
+            for outcome, n in stats.items():
+                totals[outcome] += n
+        return dict(totals)
+
+    def _enter(self, phase):
+        active = self._active.__dict__.setdefault('phases', set())
+        if phase in active:
+            return False
+        active.add(phase)
+        return True
+
+    def time(self, phase, fn, *args, **kwargs):
+        if not self._enter(phase):
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            with span(phase):
+                return fn(*args, **kwargs)
+        finally:
+            self.seconds[phase] += time.perf_counter() - start
+            self._active.phases.discard(phase)
+
+    def time_iter(self, phase, iterator):
+        """
+        Yields from iterator, timing only the time spent producing each item, not the caller's time in between
+        """
+        iterator, done = iter(iterator), object()
+        while (item := self.time(phase, next, iterator, done)) is not done:
+            yield item
+
+    def wrap(self, obj, method, phase):
+        """
+        Times every call of obj.method as phase, for agents whose loop runs their own methods
+        """
+        fn = getattr(obj, method)
+        if inspect.isgeneratorfunction(fn):
+            def timed(*args, **kwargs):
+                yield from self.time_iter(phase, fn(*args, **kwargs))
+        else:
+            def timed(*args, **kwargs):
+                return self.time(phase, fn, *args, **kwargs)
+        setattr(obj, method, timed)
+
+
+def load_tasks(path):
+    with open(path) as f:
+        tasks = [json.loads(line) for line in f if line.strip()]
+    for i, task in enumerate(tasks):
+        task.setdefault('id', str(i))
+        task.setdefault('start_site', DEFAULT_START_SITE)
+    return tasks
+
+
+def is_correct(spec, answer):
+    expected = spec.get('expected')
+    return None if expected is None or answer is None else expected.lower() in str(answer).lower()
+
+
+def save_trajectory(session, spec, answer):
+    # ungraded answers are kept, wrong ones aren't worth replaying
+    session.finish(answer, success=is_correct(spec, answer) is not False)
+
+
+def run_compiler1_task(spec, driver, model, budget, timer, trajectories=None, viewport_first=False):
+    """
+    Same loop as run_compiler1.py, without input(). Returns (answer, n_loops, stop reason)
+    """
+    agent = Agent(task=spec['task'], start_site=spec['start_site'], driver=driver, model=model,
+                  trajectories=trajectories, viewport_first=viewport_first)
+    agent.state.interactive = False
+    timer.parse_stats.append(agent.parse_stats)
+    start = time.perf_counter()
+    n_loops = 0
+    while not agent.ans:
+        if reason := budget.exceeded(n_loops, start, model):
+            return agent.ans, n_loops, reason
+        n_loops += 1
+        prompt = timer.time('observe', agent.create_prompt)
+        timer.time('llm', agent.get_response, prompt)
+        timer.time('execute', agent.execute_commands)
+    save_trajectory(agent.trajectory, spec, agent.ans)
+    return agent.ans, n_loops, 'answered'
+
+
+def run_compiler2_task(spec, driver, model, budget, timer, loops_before_validate=3, pipelined=False, streaming=False,
+                       trajectories=None, viewport_first=False):
+    """
+    Same loop as run_compiler2_multiagent.py, without input(). Returns (answer, n_loops, stop reason)
+    """
+    state = MultiAgentState(driver, spec['start_site'], interactive=False, viewport_first=viewport_first)
+    executor = Executor(model, state=state, streaming=streaming)
+    validator = Validator(task=spec['task'], state=state, lm_model=model, executor=executor,
+                          loops_before_validate=loops_before_validate, pipelined=pipelined, trajectories=trajectories)
+    timer.parse_stats += [executor.parse_stats, validator.parse_stats]
+    # same phases as compiler1, plus the Validator's (which overlaps the Executor's when pipelined)
+    timer.wrap(executor, '_create_prompt', 'observe')
+    timer.wrap(executor, '_get_response', 'llm')
+    timer.wrap(model, 'stream', 'llm')
+    for method in ('_execute_commands', '_run_command', '_run_plan'):
+        timer.wrap(executor, method, 'execute')
+    timer.wrap(validator, '_snapshot', 'validate')
+    timer.wrap(validator, '_get_response', 'validate')
+    start = time.perf_counter()
+    list(validator.evaluate())
+    n_loops = 0
+    while not validator.answer:
+        if reason := budget.exceeded(n_loops, start, model):
+            return validator.answer, n_loops, reason
+        n_loops += 1
+        list(validator.run_one_iter())
+
+        data = validator.last_parsed_output
+        if isinstance(data, dict):
+            if data.get("progress", 0) >= PROGRESS_THRESHOLD:
+                validator.answer = data.get("answer", "Done(No Response)")
+                break
+            elif data.get("shouldrestart", 0) >= RESTART_THRESHOLD:
+                state.restart(None)
+            executor.tip = data.get('feedback', 'None')
+        if state.is_stuck(marked=True):
+            state.restart(None)
+    save_trajectory(validator.trajectory, spec, validator.answer)
+    return validator.answer, n_loops, 'answered'
+
+
+AGENTS = {'compiler1': run_compiler1_task, 'compiler2': run_compiler2_task,
+          'compiler2-pipelined': partial(run_compiler2_task, pipelined=True),
+          'compiler2-stream': partial(run_compiler2_task, streaming=True)}
+
+
+def cost(model):
+    prices = PRICING.get(model.model_name)
+    if prices is None:
+        return None
+    cached = model.metadata.get('cached_tokens', 0)
+    return ((model.metadata['input_tokens'] - cached) * prices['input'] + cached * prices['cached_input']
+            + model.metadata['output_tokens'] * prices['output'])
+
+
+def default_model_factory(spec):
+    return LMModel()
+
+
+def run_task(spec, driver, agent='compiler1', budget=None, model_factory=default_model_factory, trajectories=None,
+             viewport_first=False):
+    """
+    Runs one task, returns the result dict. model_factory(spec) creates the model for the task.
+    trajectories: TrajectoryStore to replay from and save correct runs in, see util/trajectory.py
+    viewport_first: only label what's in view (see State). Changes what the agent can click, so only compare runs
+    with the same setting
+    """
+    budget = budget or Budget()
+    model = model_factory(spec)
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    answer, n_loops, reason, error = None, 0, None, None
+    try:
+        with span('task', id=spec['id'], agent=agent):
+            answer, n_loops, reason = AGENTS[agent](spec, driver, model, budget, timer, trajectories=trajectories,
+                                                  viewport_first=viewport_first)
+    except Exception as e:
+        reason, error = 'error', f'{type(e).__name__}: {e}'
+
+    return {'id': spec['id'], 'task': spec['task'], 'agent': agent, 'viewport_first': viewport_first,
+            'answer': answer, 'expected': spec.get('expected'), 'correct': is_correct(spec, answer),
+            'stop_reason': reason, 'error': error,
+            'wall_seconds': time.perf_counter() - start, 'iterations': n_loops,
+            'input_tokens': model.metadata['input_tokens'], 'output_tokens': model.metadata['output_tokens'],
+            'cached_tokens': model.metadata.get('cached_tokens', 0),
+            'cost': cost(model), 'phase_seconds': dict(timer.seconds), 'replies': timer.parse_totals()}
+
+
+def run_suite(tasks, results_dir, agent='compiler1', n_browsers=4, budget=None, model_factory=default_model_factory,
+              pool=None, trajectories=None, viewport_first=False):
+    """
+    Runs every task, n_browsers at a time, on browsers from a BrowserPool (a new headless one unless given).
+    Writes results_dir/<id>.json per task and returns the list of results.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    if not tasks:
+        return []
+    own_pool = pool is None
+    if own_pool:
+        pool = BrowserPool(size=min(n_browsers, len(tasks)))
+
+    def worker(spec):
+        with pool.checkout() as driver:
+            result = run_task(spec, driver, agent=agent, budget=budget, model_factory=model_factory,
+                              trajectories=trajectories, viewport_first=viewport_first)
+        with open(os.path.join(results_dir, f"{spec['id']}.json"), 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"[{result['id']}] {result['stop_reason']} in {result['iterations']} loops, "
+              f"{result['wall_seconds']:.1f}s, answer: {result['answer']}")
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as workers:
+            results = list(workers.map(worker, tasks))
+    finally:
+        if own_pool:
+            pool.close()
+    return results
@@ -1,11 +1,11 @@
-import time
 from util.webdriver import chrome_new_webdriver, chrome_remote_debug_webdriver
-from selenium_tools.web_util import mark_page, unmark_page, type_text, take_screenshot, scroll_window
+from selenium_tools.web_util import mark_page, unmark_page, type_text, take_screenshot, scroll_window, get_marked_element
+from selenium_tools.web_util import wait_for_settle
 
 driver = chrome_new_webdriver()
 
 def get_element(out, idx):
-    return out[idx]['element']
+    return get_marked_element(driver, out[idx])
 
 # Fetch a page
 driver.get("https://www.youtube.com")
@@ -14,10 +14,10 @@ driver.get("https://www.youtube.com")
 out = mark_page(driver)
 search_bar = get_element(out, 2)
 type_text(search_bar, 'ma meilleur ennemi')
-time.sleep(1)
+wait_for_settle(driver)
 search_button = get_element(out, 3)
 search_button.click()
-time.sleep(1)
+wait_for_settle(driver)
 
 # Look for correct video in the search results.
 out = mark_page(driver)
@@ -25,7 +25,7 @@ video = None
 for element in out:
     # aria-label helps screen-readers attach a label to HTML elements, these are often descriptive
     if "Ma Meilleure Ennemie" in element['ariaLabel'] and 'Riot Games Music' in element['ariaLabel']:
-        video = element['element']
+        video = get_marked_element(driver, element)
         break
 if video is None:
     print("Could not find video.")
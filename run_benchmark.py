@@ -0,0 +1,64 @@
+import os
+import json
+import argparse
+
+from bench.runner import load_tasks, run_suite, Budget, AGENTS
+from util.tracing import tracer
+from util.trajectory import TrajectoryStore
+
+"""
+Runs a suite of tasks headlessly, without any user input.
+
+python run_benchmark.py bench/tasks.jsonl --agent compiler2 --browsers 4 --out results/
+
+Writes one JSON file per task (wall time, iterations, tokens, cost, per-phase timings, answer) and a summary.json.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('tasks', help='JSONL task file')
+parser.add_argument('--agent', choices=list(AGENTS), default='compiler1')
+parser.add_argument('--browsers', type=int, default=4, help='number of headless browsers to run tasks on')
+parser.add_argument('--out', default='results', help='results directory')
+parser.add_argument('--max-loops', type=int, default=10)
+parser.add_argument('--max-seconds', type=float, default=300)
+parser.add_argument('--max-tokens', type=int, default=200_000)
+parser.add_argument('--trace', action='store_true', help='write trace.jsonl and trace.json (Chrome trace format) to --out')
+parser.add_argument('--viewport-first', action='store_true', help='only label what is in view, with an off-screen outline')
+parser.add_argument('--trajectories', help='replay matching runs from this trajectory store, and save correct runs to it')
+args = parser.parse_args()
+if args.trace:
+    tracer.enable()
+
+tasks = load_tasks(args.tasks)
+budget = Budget(max_loops=args.max_loops, max_seconds=args.max_seconds, max_tokens=args.max_tokens)
+print(f'Running {len(tasks)} tasks with {args.agent} on {args.browsers} browsers...\n')
+trajectories = TrajectoryStore(mode='replay', path=args.trajectories) if args.trajectories else None
+results = run_suite(tasks, args.out, agent=args.agent, n_browsers=args.browsers, budget=budget,
+                    trajectories=trajectories, viewport_first=args.viewport_first)
+
+costs = [r['cost'] for r in results if r['cost'] is not None]
+graded = [r['correct'] for r in results if r['correct'] is not None]
+summary = {'agent': args.agent, 'viewport_first': args.viewport_first, 'n_tasks': len(results),
+           'answered': sum(r['stop_reason'] == 'answered' for r in results),
+           'correct': f'{sum(graded)}/{len(graded)}' if graded else None,
+           'total_wall_seconds': sum(r['wall_seconds'] for r in results),
+           'total_iterations': sum(r['iterations'] for r in results),
+           'input_tokens': sum(r['input_tokens'] for r in results),
+           'output_tokens': sum(r['output_tokens'] for r in results),
+           # input tokens billed at the provider's discounted cached rate
+           'cached_tokens': sum(r['cached_tokens'] for r in results),
+           'cost': sum(costs) if costs else None,
+           # replies that couldn't be used even after a repair re-prompt, i.e. wasted iterations
+           'failed_replies_per_task': sum(r['replies'].get('failed', 0) for r in results) / max(len(results), 1),
+           'reprompted_replies': sum(r['replies'].get('reprompted', 0) for r in results),
+           # steps served from recorded trajectories instead of the LLM
+           'replayed_steps': sum(r['replies'].get('replayed', 0) for r in results)}
+if args.trace:
+    summary['spans'] = tracer.summary()
+    tracer.export_jsonl(os.path.join(args.out, 'trace.jsonl'))
+    tracer.export_chrome_trace(os.path.join(args.out, 'trace.json'))
+with open(os.path.join(args.out, 'summary.json'), 'w') as f:
+    json.dump(summary, f, indent=2)
+
+print("\n###############################################################\n")
+print(json.dumps(summary, indent=2))
@@ -10,6 +10,8 @@ This consists of a single agent that runs in a modified ReAct loop, inspired by
 In each iteration, the model can pick multiple commands to execute, based on the provided context.
 """
 
+VIEWPORT_FIRST = False  # opt-in: only label what's in view, plus an outline of the rest of the page
+
 def format_action(x):
     if 'command' not in x:
         return f'\tINVALID COMMAND: {x}'
@@ -28,7 +30,7 @@ task = input('Enter a Task: ')
 if task == '':
     raise ValueError('Please provide a task.')
 
-agent = Agent(task=task)
+agent = Agent(task=task, viewport_first=VIEWPORT_FIRST)
 print(f"Starting...\n\n")
 time.sleep(2)
 
@@ -42,6 +44,8 @@ while not agent.ans and should_continue:
     prompt = agent.create_prompt()
     agent.get_response(prompt)
     print(format_output_dict_as_string(agent.last_parsed_output), '\n')
+    print(f'Screenshot: {agent.state.img_bytes} bytes')
+    print(f'Bounding boxes: {agent.state.bbox_stats}\n')
     
     # Execute the commands
     should_continue = input('Continue After this iteration?(y/n)?') != "n"
@@ -54,6 +58,15 @@ while not agent.ans and should_continue:
 print("\n###############################################################\n")
 print("ANSWER: ", agent.ans)
 print(f'Performed {n_loops} loops')
+# saved if TRAJECTORY_MODE is set and the answer is right, so the next run of this kind of task can replay it
+if agent.trajectory.store is not None and agent.ans:
+    agent.trajectory.finish(agent.ans, success=input('Was the answer correct (y/n)? ') == 'y')
+print(f"Replayed steps: {agent.parse_stats.get('replayed', 0)}"
+      f"{f' (stopped: {agent.trajectory.divergence})' if agent.trajectory.divergence else ''}")
 print(f"LLM Info: {agent.model.metadata}")
-cost_4o_mini = agent.model.metadata['input_tokens'] * (0.15/1000000) + agent.model.metadata['output_tokens'] * (0.6/1000000)
+print(f"Screenshots: {agent.state.total_img_bytes} bytes total")
+print(f"Bounding boxes: {agent.state.bbox_stats.tokens} tokens total, saved {agent.state.bbox_stats.tokens_saved}")
+print(f"Prompt cache: {agent.model.metadata['cached_tokens']} of {agent.model.metadata['input_tokens']} input tokens")
+cached = agent.model.metadata['cached_tokens']
+cost_4o_mini = (agent.model.metadata['input_tokens'] - cached) * (0.15/1000000) + cached * (0.075/1000000) + agent.model.metadata['output_tokens'] * (0.6/1000000)
 print(f"GPT-4o-mini cost: {cost_4o_mini}")
@@ -1,4 +1,5 @@
 from agents.compiler2_multiagent.agent import MultiAgentState, Executor, Validator
+from agents.compiler2_multiagent.agent import PROGRESS_THRESHOLD, PROGRESS_LOWER_THRESHOLD, RESTART_THRESHOLD
 from util.webdriver import chrome_new_webdriver
 from util.agent import LMModel
 
@@ -6,9 +7,11 @@ import time
 import json
 # Always run from this file, or else imports get tricky
 
-PROGRESS_THRESHOLD = 90
-PROGRESS_LOWER_THRESHOLD = 80
-RESTART_THRESHOLD = 80
+# opt-in: validates while the executor plans its last step, saving ~1 LLM round-trip per iteration, but grades the
+# page as it was before that step
+PIPELINED = False
+STREAMING = False  # opt-in: start executing each action as soon as the LLM has generated it
+VIEWPORT_FIRST = False  # opt-in: only label what's in view, plus an outline of the rest of the page
 
 # basic starting points
 SITES = {'amazon': 'https://www.amazon.com',
@@ -19,9 +22,10 @@ task = input('Enter a Task: ')
 
 # Get necessary objects
 lm_model = LMModel()
-state = MultiAgentState(chrome_new_webdriver(), SITES['google'])
-executor = Executor(lm_model, state=state)
-validator = Validator(task=task, state=state, lm_model=lm_model, executor=executor, loops_before_validate=3)
+state = MultiAgentState(chrome_new_webdriver(), SITES['google'], viewport_first=VIEWPORT_FIRST)
+executor = Executor(lm_model, state=state, streaming=STREAMING)
+validator = Validator(task=task, state=state, lm_model=lm_model, executor=executor, loops_before_validate=3,
+                      pipelined=PIPELINED, progress_threshold=PROGRESS_THRESHOLD, restart_threshold=RESTART_THRESHOLD)
 
 print('Starting...\n\n')
 time.sleep(2)
@@ -40,8 +44,11 @@ while not validator.answer and should_continue:
     print(f"ITERATION {n_loops} ##########################################")
     
     # Run executor/validator loop
+    img_bytes_before = state.total_img_bytes
     for item in validator.run_one_iter():
         print(item)
+    print(f'\nScreenshots this iteration: {state.total_img_bytes - img_bytes_before} bytes')
+    print(f'Bounding boxes: {state.bbox_stats}')
     
     data = validator.last_parsed_output
 
@@ -60,14 +67,28 @@ while not validator.answer and should_continue:
         elif n_above_lower_threshold >= 2:
             # manual intervention
             validator.manual_feedback = input('Give Feedback To the Validator: ')
-        executor.task = f"{task}\nTip: {data.get("feedback", "None")}"
+        executor.tip = data.get("feedback", "None")
+
+    if state.is_stuck(marked=True):
+        print("\nRestarting, the page hasn't changed in a while...")
+        state.restart(None)
 
     should_continue = input('Continue(y/n)? ') != "n"
 
 
 print("ANSWER: ", validator.answer)
 print(f'Performed {n_loops} loops')
+# saved if TRAJECTORY_MODE is set and the answer is right, so the next run of this kind of task can replay it
+if validator.trajectory.store is not None and validator.answer:
+    validator.trajectory.finish(validator.answer, success=input('Was the answer correct (y/n)? ') == 'y')
+print(f"Replayed steps: {executor.parse_stats.get('replayed', 0) + validator.parse_stats.get('replayed', 0)}"
+      f"{f' (stopped: {validator.trajectory.divergence})' if validator.trajectory.divergence else ''}")
 print(f"LLM Info: {lm_model.metadata}")
+print(f"Screenshots: {state.total_img_bytes} bytes total")
+print(f"Bounding boxes: {state.bbox_stats.tokens} tokens total, saved {state.bbox_stats.tokens_saved}")
+print(f"Skipped validator calls: {validator.skipped_evaluations}")
 
-cost_4o_mini = lm_model.metadata['input_tokens'] * (0.15/1000000) + lm_model.metadata['output_tokens'] * (0.6/1000000)
+print(f"Prompt cache: {lm_model.metadata['cached_tokens']} of {lm_model.metadata['input_tokens']} input tokens")
+cached = lm_model.metadata['cached_tokens']
+cost_4o_mini = (lm_model.metadata['input_tokens'] - cached) * (0.15/1000000) + cached * (0.075/1000000) + lm_model.metadata['output_tokens'] * (0.6/1000000)
 print(f"GPT-4o-mini cost: ${cost_4o_mini}")
\ No newline at end of file
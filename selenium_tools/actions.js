@@ -0,0 +1,142 @@
+// Runs a list of click/type/scroll ops on elements marked by mark_page.js, in a single execute_script call.
+// arguments[0]: [{op, id, content, dx, dy}]
+// Returns one result per op run: {ok, error, native, navigates}. Stops after the first op that fails, needs
+// a native (trusted) WebDriver action, or may have started a navigation.
+const ops = arguments[0];
+const results = [];
+
+const TEXT_INPUTS = new Set(["", "text", "search", "email", "url", "tel", "password", "number"]);
+
+function find(id) {
+  return document.querySelector(`[data-llmweb-id="${id}"]`);
+}
+
+function centerOf(element) {
+  let rect = element.getBoundingClientRect();
+  const vw = window.innerWidth || document.documentElement.clientWidth;
+  const vh = window.innerHeight || document.documentElement.clientHeight;
+  if (rect.bottom < 0 || rect.top > vh || rect.right < 0 || rect.left > vw) {
+    element.scrollIntoView({ block: "center", inline: "center" });
+    rect = element.getBoundingClientRect();
+  }
+  return { x: rect.left + rect.width / 2, y: rect.top + rect.height / 2 };
+}
+
+function covered(element, x, y) {
+  const top = document.elementFromPoint(x, y);
+  return top !== null && top !== element && !element.contains(top) && !top.contains(element);
+}
+
+function mayNavigate(element) {
+  const link = element.closest("a[href]");
+  if (link && !link.getAttribute("href").startsWith("#")) return true;
+  return !!(element.form && (element.type === "submit" || element.type === "image"));
+}
+
+function click(op) {
+  const element = find(op.id);
+  if (!element) return { ok: false, error: "Element is no longer on the page." };
+  const link = element.closest("a[href]");
+  if (link && link.target === "_blank") return { ok: false, native: true }; // popups need a trusted click
+  const { x, y } = centerOf(element);
+  if (covered(element, x, y)) return { ok: false, native: true }; // let WebDriver decide what gets the click
+  const init = { bubbles: true, cancelable: true, composed: true, clientX: x, clientY: y, button: 0, view: window };
+  element.dispatchEvent(new PointerEvent("pointerdown", init));
+  element.dispatchEvent(new MouseEvent("mousedown", init));
+  if (element.focus) element.focus();
+  element.dispatchEvent(new PointerEvent("pointerup", init));
+  element.dispatchEvent(new MouseEvent("mouseup", init));
+  element.click();
+  return { ok: true, navigates: mayNavigate(element) };
+}
+
+// the form's default button (its first submit button), or null
+function defaultButton(form) {
+  for (const field of form.elements) {
+    if ((field instanceof HTMLButtonElement || field instanceof HTMLInputElement) &&
+        (field.type === "submit" || field.type === "image")) return field;
+  }
+  return null;
+}
+
+// whether Enter in a field of this form submits it: it has a default button, or only one text field
+function submitsImplicitly(form) {
+  if (defaultButton(form)) return true;
+  const fields = Array.from(form.elements).filter(
+    (field) => field instanceof HTMLInputElement && TEXT_INPUTS.has(field.type));
+  return fields.length === 1;
+}
+
+function type(op) {
+  const element = find(op.id);
+  if (!element) return { ok: false, error: "Element is no longer on the page." };
+  const isInput = element instanceof HTMLInputElement && TEXT_INPUTS.has(element.type);
+  if (!isInput && !(element instanceof HTMLTextAreaElement)) return { ok: false, native: true };
+  // what Enter does in a form that doesn't submit implicitly is up to the page, leave it to a real key press
+  if (isInput && element.form && !submitsImplicitly(element.form)) return { ok: false, native: true };
+  centerOf(element);
+  element.focus();
+  // the prototype's setter, so frameworks that track the value (React) see the change
+  const proto = isInput ? HTMLInputElement.prototype : HTMLTextAreaElement.prototype;
+  const setValue = Object.getOwnPropertyDescriptor(proto, "value").set;
+  setValue.call(element, "");
+  element.dispatchEvent(new InputEvent("input", { bubbles: true, inputType: "deleteContentBackward" }));
+  setValue.call(element, op.content);
+  element.dispatchEvent(new InputEvent("input", { bubbles: true, inputType: "insertText", data: op.content }));
+  element.dispatchEvent(new Event("change", { bubbles: true }));
+
+  // a listener may submit or navigate on Enter by itself, without cancelling it
+  let started = false;
+  const onStart = () => { started = true; };
+  window.addEventListener("submit", onStart, true);
+  window.addEventListener("beforeunload", onStart, true);
+  const key = { key: "Enter", code: "Enter", keyCode: 13, which: 13, bubbles: true, cancelable: true };
+  let handled;
+  try {
+    handled = !element.dispatchEvent(new KeyboardEvent("keydown", key));
+    element.dispatchEvent(new KeyboardEvent("keypress", key));
+    element.dispatchEvent(new KeyboardEvent("keyup", key));
+  } finally {
+    window.removeEventListener("submit", onStart, true);
+    window.removeEventListener("beforeunload", onStart, true);
+  }
+  if (started || handled) return { ok: true, navigates: true };
+  // a synthetic Enter doesn't submit forms by itself, do what the browser's implicit submission would
+  if (isInput && element.form) {
+    const button = defaultButton(element.form);
+    if (button) {
+      if (button.disabled) return { ok: true, navigates: false };
+      button.click();
+    } else if (element.form.requestSubmit) {
+      element.form.requestSubmit();
+    } else {
+      element.form.submit();
+    }
+    return { ok: true, navigates: true };
+  }
+  return { ok: true, navigates: false };
+}
+
+function scroll(op) {
+  if (op.id === null) {
+    window.scrollBy(op.dx, op.dy);
+    return { ok: true };
+  }
+  const element = find(op.id);
+  if (!element) return { ok: false, error: "Element is no longer on the page." };
+  element.scrollBy(op.dx, op.dy);
+  return { ok: true };
+}
+
+const handlers = { click: click, type: type, scroll: scroll };
+for (const op of ops) {
+  let result;
+  try {
+    result = handlers[op.op](op);
+  } catch (e) {
+    result = { ok: false, native: true };
+  }
+  results.push(result);
+  if (!result.ok || result.navigates) break;
+}
+return results;
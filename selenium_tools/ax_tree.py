@@ -0,0 +1,147 @@
+from selenium.common.exceptions import WebDriverException
+
+from util.tracing import span
+from selenium_tools.web_util import init_mark_page, MARK_PAGE_VERSION
+
+"""
+Observation backend built on Chrome's accessibility tree, an alternative to mark_page.js (State(backend='axtree')).
+
+mark_page.js decides what's interactive from tag names, onclick and cursor: pointer, calling getComputedStyle on
+every node it walks. Here Chrome has already done that work:
+- Accessibility.getFullAXTree: role and accessible name of every node, in one call
+- DOMSnapshot.captureSnapshot: layout boxes of every node, by backend node id, in one call
+- Page.getLayoutMetrics: the viewport
+
+Elements with an interactive role and a box in the viewport come back in the same shape as mark_page's:
+{left, top, width, height, type, text, ariaLabel, id}, plus backendNodeId. type is the AX role. There's no hit
+test, so elements under an overlay are still listed.
+
+Elements aren't touched while observing. Right before an action, tag_element resolves the backend node id and sets
+data-llmweb-id on it, so actions.js and get_marked_element work on it like on a mark_page element.
+"""
+
+INTERACTIVE_ROLES = {'button', 'link', 'textbox', 'searchbox', 'combobox', 'listbox', 'checkbox', 'radio', 'switch',
+                     'slider', 'spinbutton', 'menuitem', 'menuitemcheckbox', 'menuitemradio', 'option', 'tab',
+                     'treeitem'}
+# headings and landmarks that say what's off-screen, like pageOutline() in mark_page.js
+LANDMARK_ROLES = {'heading', 'navigation', 'main', 'form', 'search', 'region'}
+MIN_AREA = 20
+
+_draw_labels_call = """
+if (window.__markPageVersion !== arguments[0]) return false;
+window.unmarkPage();
+window.drawLabels(arguments[1]);
+return true;
+"""
+
+
+def _layout_boxes(snapshot):
+    """
+    backend node id -> [x, y, width, height] in document coordinates, for the top document
+    """
+    document = snapshot['documents'][0]
+    backend_ids = document['nodes']['backendNodeId']
+    layout = document['layout']
+    return {backend_ids[node]: bounds for node, bounds in zip(layout['nodeIndex'], layout['bounds'])}
+
+
+def _property(node, name):
+    for p in node.get('properties', []):
+        if p.get('name') == name:
+            return p.get('value', {}).get('value')
+    return None
+
+
+def _outline(landmarks, counts, max_landmarks=5):
+    outline = {'above': {'count': counts['above'], 'landmarks': []},
+               'below': {'count': counts['below'], 'landmarks': []}}
+    for where, text in landmarks:
+        outline[where]['landmarks'].append(text)
+    # document order puts the closest "above" landmarks last
+    outline['above']['landmarks'] = outline['above']['landmarks'][::-1][:max_landmarks]
+    outline['below']['landmarks'] = outline['below']['landmarks'][:max_landmarks]
+    return outline
+
+
+def ax_elements(driver, viewport=True):
+    """
+    Returns (elements, outline) for the current page, see the module docstring.
+    viewport: like mark_page's viewport-first mode, only elements mostly in view, plus an outline of the rest
+    """
+    with span('ax_elements', viewport=viewport) as s:
+        nodes = driver.execute_cdp_cmd('Accessibility.getFullAXTree', {})['nodes']
+        snapshot = driver.execute_cdp_cmd('DOMSnapshot.captureSnapshot', {'computedStyles': []})
+        metrics = driver.execute_cdp_cmd('Page.getLayoutMetrics', {})['cssLayoutViewport']
+        boxes = _layout_boxes(snapshot)
+        scroll_x, scroll_y = metrics['pageX'], metrics['pageY']
+        vw, vh = metrics['clientWidth'], metrics['clientHeight']
+
+        elements, landmarks = [], []
+        counts = {'above': 0, 'below': 0}
+        for node in nodes:
+            role = (node.get('role') or {}).get('value')
+            if node.get('ignored') or (role not in INTERACTIVE_ROLES and role not in LANDMARK_ROLES):
+                continue
+            box = boxes.get(node.get('backendDOMNodeId'))
+            if box is None or box[2] * box[3] < MIN_AREA:
+                continue
+            name = ' '.join(str((node.get('name') or {}).get('value') or '').split())
+            left, top, width, height = box[0] - scroll_x, box[1] - scroll_y, box[2], box[3]
+            where = 'above' if top + height <= 0 else 'below' if top >= vh else None
+            if role in LANDMARK_ROLES:
+                if where:
+                    level = _property(node, 'level')
+                    landmarks.append((where, f"{f'h{level}' if level else role}: {name[:60]}" if name else role))
+                continue
+            if where:
+                counts[where] += 1
+                continue
+            # clamp to the viewport
+            right, bottom = min(left + width, vw), min(top + height, vh)
+            clamped = [max(left, 0), max(top, 0)]
+            clamped += [right - clamped[0], bottom - clamped[1]]
+            if clamped[2] <= 0 or clamped[3] <= 0 or clamped[2] * clamped[3] < MIN_AREA:
+                continue
+            if viewport and clamped[2] * clamped[3] < 0.5 * width * height and clamped[3] < 0.5 * vh:
+                continue  # only peeking into the viewport
+            elements.append({'left': round(clamped[0]), 'top': round(clamped[1]),
+                              'width': round(clamped[2]), 'height': round(clamped[3]),
+                              'type': role, 'text': name, 'ariaLabel': '',
+                              'id': f"ax{node['backendDOMNodeId']}", 'backendNodeId': node['backendDOMNodeId']})
+        s.set(n_nodes=len(nodes), n_elements=len(elements))
+    return elements, _outline(landmarks, counts) if viewport else None
+
+
+def draw_labels(driver, elements):
+    """
+    Numbered boxes over the elements for the screenshot, same as mark_page draws
+    """
+    rects = [{k: e[k] for k in ('left', 'top', 'width', 'height')} for e in elements]
+    if not driver.execute_script(_draw_labels_call, MARK_PAGE_VERSION, rects):
+        init_mark_page(driver)
+        driver.execute_script(_draw_labels_call, MARK_PAGE_VERSION, rects)
+
+
+def ax_mark_page(driver, viewport=True):
+    """
+    The axtree backend's mark_page_with_outline: elements from the accessibility tree, labelled on the page
+    """
+    elements, outline = ax_elements(driver, viewport)
+    draw_labels(driver, elements)
+    return elements, outline
+
+
+def tag_element(driver, item):
+    """
+    Sets data-llmweb-id on the element behind an ax_elements item, so it can be found like a mark_page element.
+    Returns False if it's no longer on the page.
+    """
+    try:
+        obj = driver.execute_cdp_cmd('DOM.resolveNode', {'backendNodeId': item['backendNodeId']})['object']
+        driver.execute_cdp_cmd('Runtime.callFunctionOn', {
+            'objectId': obj['objectId'],
+            'functionDeclaration': 'function(id) { this.setAttribute("data-llmweb-id", id); }',
+            'arguments': [{'value': item['id']}]})
+        return True
+    except (KeyError, WebDriverException):
+        return False
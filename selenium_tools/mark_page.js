@@ -1,7 +1,8 @@
 // ADAPTED FROM https://github.com/langchain-ai/langgraph/blob/main/docs/docs/tutorials/web-navigation/web_voyager.ipynb
 // - change to window.[var] for Selenium
-// - return elements
+// - return elements (now data-llmweb-id handles, see getMarkId)
 // - fix repeated declaration with var
+// - single TreeWalker pass instead of querySelectorAll("*") + O(n^2) nesting filter
 
 // Set scrollbar CSS
 if (!window.customCSS) {
@@ -37,90 +38,433 @@ window.unmarkPage = () => {
   window.labels = [];
 };
 
-window.markPage = () => {
-  window.unmarkPage();
+// Tags that are always interactive, checked before any style/layout work
+window.interactiveTags = new Set([
+  "INPUT",
+  "TEXTAREA",
+  "SELECT",
+  "BUTTON",
+  "A",
+  "IFRAME",
+  "VIDEO",
+]);
+
+// Subtrees that never render anything we could label
+window.skippedTags = new Set([
+  "HEAD",
+  "SCRIPT",
+  "STYLE",
+  "NOSCRIPT",
+  "TEMPLATE",
+  "LINK",
+  "META",
+]);
+
+// Whether the element's own hit test points land on it (or inside it), i.e. nothing covers it.
+// Viewport-first mode (window.markIndex.strict) samples 5 points of the visible part and wants 3 of them,
+// otherwise only the center of the full rect is checked.
+window.isUnobscured = (element, bb, rect) => {
+  const hits = (x, y) => {
+    var elAtPoint = document.elementFromPoint(x, y);
+    return elAtPoint === element || element.contains(elAtPoint);
+  };
+  if (!window.markIndex.strict) {
+    return hits(bb.left + bb.width / 2, bb.top + bb.height / 2);
+  }
+  var points = [
+    [0.5, 0.5],
+    [0.25, 0.25],
+    [0.75, 0.25],
+    [0.25, 0.75],
+    [0.75, 0.75],
+  ];
+  var n = 0;
+  for (const [fx, fy] of points) {
+    n += hits(rect.left + rect.width * fx, rect.top + rect.height * fy);
+  }
+  return n >= 3;
+};
+
+// Visible rects of an element, clamped to the viewport, along with their total area.
+// Cheap checks first: clamped area of the on-screen rects is an upper bound on the
+// area left after hit testing, so we only call elementFromPoint when it could matter.
+// In viewport-first mode, rects that are mostly outside the viewport are dropped too.
+window.getVisibleRects = (element, vw, vh) => {
+  var clamped = [];
+  var upperBound = 0;
+  for (const bb of element.getClientRects()) {
+    const rect = {
+      left: Math.max(0, bb.left),
+      top: Math.max(0, bb.top),
+      right: Math.min(vw, bb.right),
+      bottom: Math.min(vh, bb.bottom),
+    };
+    rect.width = rect.right - rect.left;
+    rect.height = rect.bottom - rect.top;
+    // entirely outside the viewport, its center can never hit the element
+    if (rect.width < 0 || rect.height < 0) {
+      continue;
+    }
+    // only peeking into the viewport (unless it's bigger than the viewport)
+    if (
+      window.markIndex.strict &&
+      rect.width * rect.height < 0.5 * bb.width * bb.height &&
+      rect.height < 0.5 * vh &&
+      rect.width < 0.5 * vw
+    ) {
+      continue;
+    }
+    upperBound += rect.width * rect.height;
+    clamped.push([bb, rect]);
+  }
+  if (upperBound < 20) {
+    return { rects: [], area: upperBound };
+  }
+
+  // filterout boxes not containing the element, using elementFromPoint
+  var rects = clamped
+    .filter(([bb, rect]) => window.isUnobscured(element, bb, rect))
+    .map(([, rect]) => rect);
+
+  var area = rects.reduce((acc, rect) => acc + rect.width * rect.height, 0);
+  return { rects, area };
+};
+
+// Whether the element counts as interactive. Tag and onclick checks are free,
+// getComputedStyle is only called when those fail.
+// Results are cached in window.markIndex until a mutation touches the element.
+window.isInteractive = (element) => {
+  var cached = window.markIndex.interactive.get(element);
+  if (cached === undefined) {
+    cached =
+      window.interactiveTags.has(element.tagName) ||
+      element.onclick != null ||
+      window.getComputedStyle(element).cursor == "pointer";
+    window.markIndex.interactive.set(element, cached);
+  }
+  return cached;
+};
+
+// width and height of the WINDOW(root element)
+window.viewportSize = () => [
+  Math.max(document.documentElement.clientWidth || 0, window.innerWidth || 0),
+  Math.max(document.documentElement.clientHeight || 0, window.innerHeight || 0),
+];
+
+// Single pass over the DOM with a TreeWalker.
+// Each element is checked for interactiveness and visible area when it is entered,
+// and resolved when it is left: an element is only kept if none of its
+// descendants qualified, so we end up with the innermost interactive elements
+// without comparing every pair of items.
+window.collectItems = (root) => {
+  var [vw, vh] = window.viewportSize();
+
+  var walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT, {
+    acceptNode: (node) =>
+      window.skippedTags.has(node.tagName)
+        ? NodeFilter.FILTER_REJECT
+        : NodeFilter.FILTER_ACCEPT,
+  });
 
-  var bodyRect = document.body.getBoundingClientRect();
-
-  // 1. call slice to copy the list
-  // 2. select every element on the page
-  var items = Array.prototype.slice
-    .call(document.querySelectorAll("*"))
-    .map(function (element) {
-      // width and height of the WINDOW(root element)
-      var vw = Math.max(
-        document.documentElement.clientWidth || 0,
-        window.innerWidth || 0
-      );
-      var vh = Math.max(
-        document.documentElement.clientHeight || 0,
-        window.innerHeight || 0
-      );
-
-      // Get text content, with multiple whitespace > " "
-      var textualContent = element.textContent.trim().replace(/\s{2,}/g, " ");
-      var elementType = element.tagName.toLowerCase();
-
-      // aria-label is a text label for elements for accessibility
-      var ariaLabel = element.getAttribute("aria-label") || "";
-
-      // DOMrect, indicates bounding boxes. most elements should have only 1
-      // filterout boxes not containing the element, using elementFromPoint
-      // return data in a different format, along with width and height, for remaining rects
-      var rects = [...element.getClientRects()]
-        .filter((bb) => {
-          var center_x = bb.left + bb.width / 2;
-          var center_y = bb.top + bb.height / 2;
-          var elAtCenter = document.elementFromPoint(center_x, center_y);
-
-          return elAtCenter === element || element.contains(elAtCenter);
-        })
-        .map((bb) => {
-          const rect = {
-            left: Math.max(0, bb.left),
-            top: Math.max(0, bb.top),
-            right: Math.min(vw, bb.right),
-            bottom: Math.min(vh, bb.bottom),
-          };
-          return {
-            ...rect,
-            width: rect.right - rect.left,
-            height: rect.bottom - rect.top,
-          };
-        });
-
-      // total area of all the rectangles
-      var area = rects.reduce((acc, rect) => acc + rect.width * rect.height, 0);
-
-      // Return elements that should be included, area, rects, etc.
-      // Filter down to only elements to include, and items with large enough area
-      return {
+  var items = [];
+  // frame = [element, rects or null if it doesn't qualify, a descendant qualified]
+  var stack = [];
+
+  // getComputedStyle is the expensive part of isInteractive, and an element whose
+  // bounding box is off-screen can't have visible rects anyway
+  const offscreen = (element) => {
+    var bb = element.getBoundingClientRect();
+    return bb.bottom < 0 || bb.top > vh || bb.right < 0 || bb.left > vw;
+  };
+
+  const enter = (element) => {
+    var rects = null;
+    if (
+      (window.interactiveTags.has(element.tagName) ||
+        element.onclick != null ||
+        !offscreen(element)) &&
+      window.isInteractive(element)
+    ) {
+      var visible = window.getVisibleRects(element, vw, vh);
+      if (visible.area >= 20) {
+        rects = visible.rects;
+      }
+    }
+    stack.push([element, rects, false]);
+  };
+
+  const leave = () => {
+    const [element, rects, descendantQualified] = stack.pop();
+    if (rects !== null && !descendantQualified) {
+      items.push({
         element: element,
-        include:
-          element.tagName === "INPUT" ||
-          element.tagName === "TEXTAREA" ||
-          element.tagName === "SELECT" ||
-          element.tagName === "BUTTON" ||
-          element.tagName === "A" ||
-          element.onclick != null ||
-          window.getComputedStyle(element).cursor == "pointer" ||
-          element.tagName === "IFRAME" ||
-          element.tagName === "VIDEO",
-        area,
-        rects,
-        text: textualContent,
-        type: elementType,
-        ariaLabel: ariaLabel,
-      };
-    })
-    .filter((item) => item.include && item.area >= 20);
-
-  // Only keep inner clickable items
-  // remove items that are nested in other items, take the innermost child
-  items = items.filter(
-    (x) => !items.some((y) => x.element.contains(y.element) && !(x == y))
+        rects: rects,
+        // Get text content, with multiple whitespace > " ". Only done for kept elements.
+        text: element.textContent.trim().replace(/\s{2,}/g, " "),
+        type: element.tagName.toLowerCase(),
+        // aria-label is a text label for elements for accessibility
+        ariaLabel: element.getAttribute("aria-label") || "",
+      });
+    }
+    if (stack.length && (rects !== null || descendantQualified)) {
+      stack[stack.length - 1][2] = true;
+    }
+  };
+
+  // iterative depth first walk, siblings/parents are only visited once all children are resolved
+  var node = root;
+  while (node) {
+    enter(node);
+    walker.currentNode = node;
+    var next = walker.firstChild();
+    while (!next && stack.length) {
+      var current = stack[stack.length - 1][0];
+      leave();
+      if (current === root) {
+        break;
+      }
+      walker.currentNode = current;
+      next = walker.nextSibling();
+    }
+    node = next;
+  }
+
+  return items;
+};
+
+// Persistent index of interactive elements, kept up to date by a MutationObserver
+// and scroll/resize listeners so incremental calls only rescan what changed.
+// A new document gets a fresh window, so navigation always starts from a full scan.
+if (!window.markIndex) {
+  window.markIndex = {
+    url: null, // location.href of the last scan, SPA navigations trigger a full scan
+    items: null, // items from the last scan, in document order
+    interactive: new WeakMap(), // element -> isInteractive result
+    dirtyRoots: new Set(), // elements whose subtree changed since the last scan
+    viewportDirty: true, // window scrolled/resized since the last scan
+    lastScan: null, // {mode, rescanned} for debugging
+    ids: new Map(), // data-llmweb-id -> WeakRef(element)
+    nextId: 0,
+    // random per document, so ids handed out before a navigation never match an element of the new page
+    idPrefix: (window.crypto?.randomUUID?.() ?? Math.random().toString(36).slice(2)).slice(0, 8),
+    strict: false, // viewport-first mode, see isUnobscured/getVisibleRects
+  };
+
+  window.markObserver = new MutationObserver((records) =>
+    window.recordMutations(records)
+  );
+  window.markObserver.observe(document.documentElement, {
+    subtree: true,
+    childList: true,
+    attributes: true,
+    characterData: true,
+  });
+
+  window.addEventListener(
+    "scroll",
+    (e) => {
+      if (e.target === document || e.target === document.documentElement) {
+        window.markIndex.viewportDirty = true;
+      } else if (e.target.nodeType === Node.ELEMENT_NODE) {
+        // scrolling a container only moves its own subtree
+        window.markIndex.dirtyRoots.add(e.target);
+      }
+    },
+    { capture: true, passive: true }
+  );
+  window.addEventListener(
+    "resize",
+    () => {
+      window.markIndex.viewportDirty = true;
+    },
+    { passive: true }
+  );
+}
+
+// Turn mutation records into dirty subtree roots, ignoring our own labels
+window.recordMutations = (records) => {
+  var dirtyRoots = window.markIndex.dirtyRoots;
+  for (const record of records) {
+    if (record.type === "childList") {
+      const nodes = [...record.addedNodes, ...record.removedNodes];
+      if (nodes.length && nodes.every((node) => node.__markLabel)) {
+        continue;
+      }
+      dirtyRoots.add(record.target);
+    } else if (record.type === "attributes") {
+      if (
+        !record.target.__markLabel &&
+        record.attributeName !== "data-llmweb-id"
+      ) {
+        dirtyRoots.add(record.target);
+      }
+    } else if (record.target.parentElement) {
+      // characterData
+      dirtyRoots.add(record.target.parentElement);
+    }
+  }
+};
+
+// Topmost interactive ancestor of a dirty root (or the root itself).
+// Anything above it can't be an item, so rescanning from here keeps innermost-ness
+// correct: kept items above the change are dropped/restored as needed.
+window.rescanRoot = (root) => {
+  var top = root;
+  for (var node = root.parentElement; node; node = node.parentElement) {
+    if (window.isInteractive(node)) {
+      top = node;
+    }
+  }
+  return top;
+};
+
+// Rescan only the dirty subtrees and merge them into the cached items
+window.rescanDirty = (index) => {
+  var roots = [...index.dirtyRoots]
+    .filter(
+      (root) =>
+        root.isConnected &&
+        !root.closest("head, script, style, noscript, template")
+    )
+    .map(window.rescanRoot);
+  roots = roots.filter(
+    (root) => !roots.some((other) => other !== root && other.contains(root))
   );
 
+  // cached items outside the dirty subtrees are kept, with rects refreshed since layout may have shifted
+  var [vw, vh] = window.viewportSize();
+  var kept = [];
+  for (const item of index.items) {
+    if (
+      !item.element.isConnected ||
+      roots.some((root) => root.contains(item.element))
+    ) {
+      continue;
+    }
+    var visible = window.getVisibleRects(item.element, vw, vh);
+    if (visible.area >= 20) {
+      kept.push({ ...item, rects: visible.rects });
+    }
+  }
+
+  var rescanned = roots.flatMap((root) => window.collectItems(root));
+  index.lastScan = { mode: "incremental", rescanned: rescanned.length };
+
+  // merge back in document order
+  return kept
+    .concat(rescanned)
+    .sort((a, b) =>
+      a.element.compareDocumentPosition(b.element) &
+      Node.DOCUMENT_POSITION_FOLLOWING
+        ? -1
+        : 1
+    );
+};
+
+// Stable data-llmweb-id for an element, so python can find it again with a single lookup.
+// Ids that were copied onto another element (e.g. cloneNode) are replaced.
+// Ids look like "<idPrefix>-<n>", so a stale id from another document doesn't resolve.
+window.getMarkId = (element) => {
+  var index = window.markIndex;
+  var id = element.getAttribute("data-llmweb-id");
+  if (id === null || index.ids.get(id)?.deref() !== element) {
+    id = `${index.idPrefix}-${index.nextId++}`;
+    element.setAttribute("data-llmweb-id", id);
+    index.ids.set(id, new WeakRef(element));
+  }
+  return id;
+};
+
+// Bring window.markIndex up to date and return its items.
+// incremental=false (or a navigation, or switching viewport-first mode) always does a full scan, like before.
+window.updateItems = (incremental, strict = false) => {
+  var index = window.markIndex;
+  window.recordMutations(window.markObserver.takeRecords());
+
+  var items;
+  if (
+    !incremental ||
+    index.items === null ||
+    index.url !== location.href ||
+    index.strict !== strict
+  ) {
+    index.strict = strict;
+    index.interactive = new WeakMap();
+    items = window.collectItems(document.documentElement);
+    index.lastScan = { mode: "full", rescanned: items.length };
+  } else {
+    // cached interactiveness inside changed subtrees is stale
+    for (const root of index.dirtyRoots) {
+      index.interactive.delete(root);
+      for (const element of root.querySelectorAll("*")) {
+        index.interactive.delete(element);
+      }
+    }
+    if (index.viewportDirty) {
+      // everything moved, walk the whole page again but reuse cached style checks
+      items = window.collectItems(document.documentElement);
+      index.lastScan = { mode: "viewport", rescanned: items.length };
+    } else if (index.dirtyRoots.size) {
+      items = window.rescanDirty(index);
+    } else {
+      items = index.items;
+      index.lastScan = { mode: "cached", rescanned: 0 };
+    }
+  }
+
+  index.items = items;
+  index.url = location.href;
+  index.dirtyRoots.clear();
+  index.viewportDirty = false;
+  return items;
+};
+
+// Interactive-looking elements (by tag/role only, no style checks)
+window.outlineSelector =
+  "a[href], button, input, select, textarea, [onclick], [role=button], [role=link], [role=tab], [role=menuitem]";
+// Headings and landmarks that say what's off-screen
+window.landmarkSelector =
+  "h1, h2, h3, nav, main, form, [role=navigation], [role=main], [role=search], section[aria-label]";
+
+// Compact description of what's above and below the viewport, for viewport-first mode:
+// {above: {count, landmarks}, below: {count, landmarks}}, landmarks closest to the viewport first
+window.pageOutline = (maxLandmarks = 5) => {
+  var [, vh] = window.viewportSize();
+  var outline = {
+    above: { count: 0, landmarks: [] },
+    below: { count: 0, landmarks: [] },
+  };
+  const side = (element) => {
+    var bb = element.getBoundingClientRect();
+    if (bb.width === 0 && bb.height === 0) return null; // not rendered
+    return bb.bottom <= 0 ? "above" : bb.top >= vh ? "below" : null;
+  };
+  for (const element of document.querySelectorAll(window.outlineSelector)) {
+    var where = side(element);
+    if (where) outline[where].count++;
+  }
+  for (const element of document.querySelectorAll(window.landmarkSelector)) {
+    var where = side(element);
+    if (!where) continue;
+    var text = (
+      element.getAttribute("aria-label") ||
+      (/^H\d$/.test(element.tagName) ? element.textContent : "")
+    )
+      .trim()
+      .replace(/\s+/g, " ")
+      .slice(0, 60);
+    var name = element.tagName.toLowerCase();
+    outline[where].landmarks.push(text ? `${name}: ${text}` : name);
+  }
+  // document order puts the closest "above" landmarks last
+  outline.above.landmarks = outline.above.landmarks.reverse().slice(0, maxLandmarks);
+  outline.below.landmarks = outline.below.landmarks.slice(0, maxLandmarks);
+  return outline;
+};
+
+// Draws a numbered, dashed box over each rect ({left, top, width, height}, viewport coordinates),
+// numbered in order. Removed by unmarkPage.
+window.drawLabels = (rects) => {
   // Function to generate random colors
   function getRandomColor() {
     var letters = "0123456789ABCDEF";
@@ -132,58 +476,84 @@ window.markPage = () => {
   }
 
   // Lets create a floating border on top of these elements that will always be visible
-  // For each item, in the rects, we make a div, style it to be fixed on the screen with a border, set zindex
-  items.forEach(function (item, index) {
-    item.rects.forEach((bbox) => {
-      newElement = document.createElement("div");
-      var borderColor = getRandomColor();
-      newElement.style.outline = `2px dashed ${borderColor}`;
-      newElement.style.position = "fixed";
-      newElement.style.left = bbox.left + "px";
-      newElement.style.top = bbox.top + "px";
-      newElement.style.width = bbox.width + "px";
-      newElement.style.height = bbox.height + "px";
-      newElement.style.pointerEvents = "none";
-      newElement.style.boxSizing = "border-box";
-      newElement.style.zIndex = 2147483647; // move to foreground basically
-      // newElement.style.background = `${borderColor}80`;
-
-      // Add floating label at the corner
-      var label = document.createElement("span");
-      label.textContent = index;
-      label.style.position = "absolute";
-      // These we can tweak if we want
-      label.style.top = "-15px";
-      label.style.left = "0px";
-      label.style.background = borderColor;
-      // label.style.fontWeight = "bold";
-      // label.style.background = "black";
-      label.style.color = "white";
-      label.style.opacity = "0.6";
-      label.style.padding = "2px 2px";
-      label.style.fontSize = "12px";
-      label.style.borderRadius = "2px";
-      // label.style.visibility = 'hidden';
-      newElement.appendChild(label);
-
-      document.body.appendChild(newElement);
-      window.labels.push(newElement);
-      // item.element.setAttribute("-ai-label", label.textContent);
-    });
+  // For each rect, we make a div, style it to be fixed on the screen with a border, set zindex
+  rects.forEach((bbox, index) => {
+    newElement = document.createElement("div");
+    newElement.__markLabel = true; // ignored by window.markObserver
+    var borderColor = getRandomColor();
+    newElement.style.outline = `2px dashed ${borderColor}`;
+    newElement.style.position = "fixed";
+    newElement.style.left = bbox.left + "px";
+    newElement.style.top = bbox.top + "px";
+    newElement.style.width = bbox.width + "px";
+    newElement.style.height = bbox.height + "px";
+    newElement.style.pointerEvents = "none";
+    newElement.style.boxSizing = "border-box";
+    newElement.style.zIndex = 2147483647; // move to foreground basically
+    // newElement.style.background = `${borderColor}80`;
+
+    // Add floating label at the corner
+    var label = document.createElement("span");
+    label.textContent = index;
+    label.style.position = "absolute";
+    // These we can tweak if we want
+    label.style.top = "-15px";
+    label.style.left = "0px";
+    label.style.background = borderColor;
+    // label.style.fontWeight = "bold";
+    // label.style.background = "black";
+    label.style.color = "white";
+    label.style.opacity = "0.6";
+    label.style.padding = "2px 2px";
+    label.style.fontSize = "12px";
+    label.style.borderRadius = "2px";
+    // label.style.visibility = 'hidden';
+    newElement.appendChild(label);
+
+    document.body.appendChild(newElement);
+    window.labels.push(newElement);
   });
+};
+
+// options.incremental: rescan only what changed since the last call
+// options.viewport: viewport-first mode, only mark elements that are mostly in view and unobscured,
+// and describe the rest of the page with pageOutline()
+// Returns {items, outline}, outline is null unless options.viewport
+window.markPage = (options = {}) => {
+  window.unmarkPage();
+
+  var items = window.updateItems(
+    options.incremental ?? false,
+    options.viewport ?? false
+  );
+
+  // one label per rect, numbered like the returned coordinates
+  window.drawLabels(items.flatMap((item) => item.rects));
 
   // flat is like map() followed by a flat() call(flatten by 1 level)
-  const coordinates = items.flatMap((item) =>
-    item.rects.map(({ left, top, width, height }) => ({
+  // Only plain data is returned, elements are looked up by id when an action needs them
+  const coordinates = items.flatMap((item) => {
+    const id = window.getMarkId(item.element);
+    return item.rects.map(({ left, top, width, height }) => ({
       // x: (left + left + width) / 2,
       // y: (top + top + height) / 2,
+      left: Math.round(left),
+      top: Math.round(top),
+      width: Math.round(width),
+      height: Math.round(height),
       type: item.type,
       text: item.text,
-      element: item.element, // new
+      id: id,
       ariaLabel: item.ariaLabel,
-    }))
-  );
+    }));
+  });
+
+  // drop the records for the labels/ids we just added
+  window.recordMutations(window.markObserver.takeRecords());
 
   // (x, y) of the center point of the element, type/text/aria-label
-  return coordinates;
+  return {
+    items: coordinates,
+    outline: options.viewport ? window.pageOutline() : null,
+  };
 };
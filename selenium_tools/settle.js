@@ -0,0 +1,47 @@
+// Tracks in-flight fetch/XHR requests and the time of the last DOM mutation, for wait_for_settle.
+// Safe to run before the document exists (e.g. from Page.addScriptToEvaluateOnNewDocument), and only once per document.
+(function () {
+  if (window.__llmwebSettle) return;
+  const state = { pending: new Map(), nextId: 0, lastMutation: performance.now() };
+  window.__llmwebSettle = state;
+
+  const begin = () => {
+    const id = state.nextId++;
+    state.pending.set(id, performance.now());
+    return id;
+  };
+  const end = (id) => state.pending.delete(id);
+
+  if (window.fetch) {
+    const fetch = window.fetch;
+    window.fetch = function () {
+      const id = begin();
+      return fetch.apply(this, arguments).finally(() => end(id));
+    };
+  }
+
+  const send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.send = function () {
+    const id = begin();
+    this.addEventListener("loadend", () => end(id));
+    return send.apply(this, arguments);
+  };
+
+  new MutationObserver(() => {
+    state.lastMutation = performance.now();
+  }).observe(document, { childList: true, subtree: true, attributes: true, characterData: true });
+
+  // requests older than maxRequestMs (long polling, streaming, analytics) don't hold the page up
+  window.llmwebSettleStatus = function (maxRequestMs) {
+    const now = performance.now();
+    let pending = 0;
+    for (const start of state.pending.values()) {
+      if (now - start < maxRequestMs) pending++;
+    }
+    return {
+      ready: document.readyState === "complete",
+      pending: pending,
+      quietMs: now - state.lastMutation,
+    };
+  };
+})();
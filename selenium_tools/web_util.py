@@ -1,24 +1,190 @@
+import io
 import os
+import json
+import time
 import platform
 import base64
+import hashlib
 from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+from util.tracing import span
+
+try:
+    from PIL import Image
+except ImportError:  # only needed for non-Chromium drivers
+    Image = None
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 with open(os.path.join(script_dir, 'mark_page.js')) as f:
     mark_page_script = f.read()
 
+# OpenAI fits "detail": "low" images into 512x512, anything bigger is thrown away server-side
+LOW_DETAIL_SIZE = 512
+JPEG_QUALITY = 70
+
+# window.__markPageVersion is set when the script is installed, so we only send the full
+# source once per document (or when mark_page.js changes), not on every call
+MARK_PAGE_VERSION = hashlib.sha1(mark_page_script.encode('utf-8')).hexdigest()[:12]
+_install_script = f'{mark_page_script}\nwindow.__markPageVersion = "{MARK_PAGE_VERSION}";'
+_mark_page_call = """
+if (window.__markPageVersion !== arguments[0]) return null;
+return window.markPage({incremental: arguments[1], viewport: arguments[2]});
+"""
+_unmark_page_call = """
+if (window.__markPageVersion === arguments[0]) window.unmarkPage();
+"""
+
+with open(os.path.join(script_dir, 'settle.js')) as f:
+    settle_script = f.read()
+
+with open(os.path.join(script_dir, 'actions.js')) as f:
+    actions_script = f.read()
+
+# wait_for_settle: the page counts as settled once it's loaded, has no recent fetch/XHR in flight,
+# hasn't mutated for SETTLE_QUIET_MS, and has painted a frame
+SETTLE_TIMEOUT = 5
+SETTLE_QUIET_MS = 300
+SETTLE_MAX_REQUEST_MS = 3000
+# polls in the page, so the whole wait is a single round-trip
+_settle_call = """
+const [timeoutMs, quietMs, maxRequestMs, done] = arguments;
+if (!window.llmwebSettleStatus) return done(null);
+const start = performance.now();
+const finish = (settled) => done({...window.llmwebSettleStatus(maxRequestMs), settled: settled,
+                                  waitedMs: Math.round(performance.now() - start)});
+const check = () => {
+  const status = window.llmwebSettleStatus(maxRequestMs);
+  if (status.ready && status.pending === 0 && status.quietMs >= quietMs) {
+    // wait for a frame to be painted, rAF doesn't fire in hidden tabs so don't rely on it
+    let called = false;
+    const once = () => { if (!called) { called = true; finish(true); } };
+    requestAnimationFrame(() => requestAnimationFrame(once));
+    setTimeout(once, 100);
+  } else if (performance.now() - start >= timeoutMs) {
+    finish(false);
+  } else {
+    setTimeout(check, 50);
+  }
+};
+check();
+"""
+
 def init_mark_page(driver):
-    driver.execute_script(mark_page_script)
+    driver.execute_script(_install_script)
 
-def mark_page(driver):
-    init_mark_page(driver)
-    out = driver.execute_script("return window.markPage();")
-    return out
+def mark_page(driver, incremental=True):
+    """
+    Marks interactive elements on the page.
+
+    With incremental=True, only the parts of the page that changed since the last call
+    (tracked by a MutationObserver in mark_page.js) are rescanned. Navigation always
+    triggers a full scan.
+    """
+    return mark_page_with_outline(driver, incremental, viewport=False)[0]
+
+def mark_page_with_outline(driver, incremental=True, viewport=True):
+    """
+    Like mark_page, returns (elements, outline).
+
+    With viewport=True (viewport-first mode), only elements that are mostly in view and not covered by
+    something else are marked, and outline describes the rest of the page:
+    {'above': {'count', 'landmarks'}, 'below': {'count', 'landmarks'}}. Otherwise outline is None.
+    """
+    with span('mark_page', incremental=incremental, viewport=viewport) as s:
+        out = driver.execute_script(_mark_page_call, MARK_PAGE_VERSION, incremental, viewport)
+        if out is None:
+            # new document, install the script and try again
+            s.set(installed=True)
+            init_mark_page(driver)
+            out = driver.execute_script(_mark_page_call, MARK_PAGE_VERSION, incremental, viewport)
+        s.set(n_elements=len(out['items']))
+    return out['items'], out['outline']
 
 def unmark_page(driver):
-    init_mark_page(driver)
-    driver.execute_script("return window.unmarkPage();")
+    # if the script isn't installed on this document, there are no labels to remove
+    driver.execute_script(_unmark_page_call, MARK_PAGE_VERSION)
+
+def get_marked_element(driver, item):
+    """
+    Resolves an item returned by mark_page to a WebElement, or None if it's no longer on the page
+    """
+    try:
+        return driver.find_element(By.CSS_SELECTOR, f'[data-llmweb-id="{item["id"]}"]')
+    except NoSuchElementException:
+        return None
+
+def init_settle(driver):
+    """
+    Installs settle.js on the current document. On Chromium it's also registered for every new document,
+    so requests made while a page loads are counted too.
+    """
+    if hasattr(driver, 'execute_cdp_cmd') and not getattr(driver, '_settle_registered', False):
+        driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': settle_script})
+        driver._settle_registered = True
+    driver.execute_script(settle_script)
+
+def wait_for_settle(driver, timeout=SETTLE_TIMEOUT, quiet_ms=SETTLE_QUIET_MS, max_request_ms=SETTLE_MAX_REQUEST_MS):
+    """
+    Waits until the page has loaded, its network requests are done and the DOM has stopped changing,
+    or until timeout seconds have passed. Returns True if the page settled.
+    """
+    with span('wait_for_settle') as s:
+        deadline = time.perf_counter() + timeout
+        while (remaining := deadline - time.perf_counter()) > 0:
+            try:
+                out = driver.execute_async_script(_settle_call, remaining * 1000, quiet_ms, max_request_ms)
+                if out is None:
+                    # a new document, which can itself be navigated away from before settle.js is installed
+                    init_settle(driver)
+                    continue
+            except WebDriverException:
+                # navigated away while waiting, look at the new document
+                time.sleep(0.05)
+                continue
+            s.set(**out)
+            return out['settled']
+        s.set(settled=False)
+        return False
+
+def run_actions(driver, ops):
+    """
+    Runs click/type/scroll ops on marked elements in one round-trip, see actions.js.
+    ops: [{'op': 'click'|'type'|'scroll', 'id': data-llmweb-id or None (window, for scroll), 'content', 'dx', 'dy'}]
+    Returns a result per op run: {'ok', 'error', 'native', 'navigates'}. It stops after the first op that fails,
+    needs a native WebDriver action ('native'), or may have navigated away.
+    """
+    with span('run_actions', n_ops=len(ops)) as s:
+        results = driver.execute_script(actions_script, ops)
+        s.set(n_run=len(results))
+    return results
+
+def list_tabs(driver):
+    """
+    [{'handle', 'title', 'url'}] for every open tab, without switching to them: titles and URLs come from CDP's
+    target list in one call (window handles are target ids in chromedriver). Other drivers only get the handles.
+    """
+    with span('list_tabs') as s:
+        handles = driver.window_handles
+        try:
+            targets = {t['targetId']: t for t in driver.execute_cdp_cmd('Target.getTargets', {})['targetInfos']}
+        except (AttributeError, WebDriverException):
+            targets = {}
+        s.set(n_tabs=len(handles), cdp=bool(targets))
+    return [{'handle': h, 'title': targets.get(h, {}).get('title', ''), 'url': targets.get(h, {}).get('url', '')}
+            for h in handles]
+
+def page_text(driver):
+    """
+    Title, URL and visible text of the current page
+    """
+    with span('page_text') as s:
+        out = driver.execute_script(
+            "return {title: document.title, url: location.href, text: document.body ? document.body.innerText : ''};")
+        s.set(chars=len(out['text']))
+    return out
 
 def type_text(element, text):
     select_all = (Keys.META + 'a') if platform.system() == "Darwin" else (Keys.LEFT_CONTROL + 'a') # TODO configure for other systems
@@ -33,16 +199,60 @@ def scroll_window(driver, element=None, amountRight=0, amountDown=0):
     else:
         driver.execute_script(f"arguments[0].scrollBy({amountRight}, {amountDown})", element)
 
-def _image_to_base64(image_path):
-    with open(image_path, 'rb') as f:
-        image_data = f.read()
-        encoded = base64.b64encode(image_data).decode('utf-8')
-    return encoded
-
-def take_screenshot(driver, remove=True):
-    save_path = os.path.join(script_dir, 'tmp.png')
-    driver.save_screenshot(save_path)
-    out = _image_to_base64(save_path)
-    if remove:
-        os.remove(save_path)
-    return out
+def take_screenshot(driver, max_size=LOW_DETAIL_SIZE, quality=JPEG_QUALITY):
+    """
+    Screenshot of the viewport as a base64 encoded JPEG, downscaled so the longest side is max_size.
+    Everything stays in memory.
+    """
+    with span('take_screenshot') as s:
+        img = _capture_screenshot(driver, max_size, quality)
+        s.set(bytes=len(img) * 3 // 4)
+    return img
+
+def _capture_screenshot(driver, max_size, quality):
+    if hasattr(driver, 'execute_cdp_cmd'):
+        # Chromium: let the browser scale and encode, only the small JPEG crosses the wire
+        viewport = driver.execute_cdp_cmd('Page.getLayoutMetrics', {})['cssVisualViewport']
+        width, height = viewport['clientWidth'], viewport['clientHeight']
+        clip = {'x': viewport['pageX'], 'y': viewport['pageY'], 'width': width, 'height': height,
+                'scale': min(1, max_size / max(width, height, 1))}
+        out = driver.execute_cdp_cmd('Page.captureScreenshot',
+                                     {'format': 'jpeg', 'quality': quality, 'clip': clip})
+        return out['data']
+
+    png = driver.get_screenshot_as_png()
+    if Image is None:
+        # no way to re-encode, send the PNG as is
+        return base64.b64encode(png).decode('utf-8')
+    img = Image.open(io.BytesIO(png)).convert('RGB')
+    img.thumbnail((max_size, max_size))
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+def image_hash(img, hash_size=8):
+    """
+    Perceptual (difference) hash of a base64 encoded image, as an int.
+    Screenshots of the same page differ in only a few bits, see hash_distance.
+    Without Pillow, falls back to an exact hash of the image bytes.
+    """
+    data = base64.b64decode(img)
+    if Image is None:
+        return int(hashlib.sha1(data).hexdigest()[:16], 16)
+    pixels = list(Image.open(io.BytesIO(data)).convert('L').resize((hash_size + 1, hash_size)).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row * (hash_size + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return bits
+
+def hash_distance(a, b):
+    return bin(a ^ b).count('1')
+
+def elements_digest(elements):
+    """
+    Digest of the elements returned by mark_page, ignoring ids
+    """
+    key = json.dumps([(e.get('type'), e.get('text'), e.get('ariaLabel')) for e in elements])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,69 @@
+from util.action_dag import build_dag, waves, run_dag, uses_dag, SKIPPED
+
+
+def run(actions, fail=()):
+    calls = []
+
+    def execute(action, tab):
+        calls.append((action['command'], tab))
+        return (action['command'] not in fail), action['command']
+    return run_dag(actions, execute), calls
+
+
+def test_plain_list_runs_in_order():
+    actions = [{'command': 'type', 'idx': 1, 'content': 'x'}, {'command': 'click', 'idx': 2},
+               {'command': 'scroll', 'idx': 'WINDOW', 'dir': 'down'}]
+    assert not uses_dag(actions)
+    deps, tabs, errors = build_dag(actions)
+    assert waves(deps) == [[0], [1], [2]]
+    assert tabs == ['main'] * 3 and errors == []
+
+
+def test_fan_out_opens_tabs_in_one_wave():
+    actions = [{'command': 'open', 'idx': 1, 'tab': 'r1'}, {'command': 'open', 'idx': 2, 'tab': 'r2'},
+               {'command': 'open', 'idx': 3, 'tab': 'r3'},
+               {'command': 'extract', 'tab': 'r1'}, {'command': 'extract', 'tab': 'r2'},
+               {'command': 'extract', 'tab': 'r3'}, {'command': 'finish'}]
+    assert uses_dag(actions)
+    deps, tabs, _ = build_dag(actions)
+    assert waves(deps) == [[0, 1, 2], [3, 4, 5], [6]]
+    # open reads its link from the observed tab
+    assert tabs == ['main', 'main', 'main', 'r1', 'r2', 'r3', 'main']
+
+
+def test_failure_only_skips_its_dependents():
+    actions = [{'command': 'open', 'idx': 1, 'tab': 'r1'}, {'command': 'open', 'idx': 2, 'tab': 'r2'},
+               {'command': 'click', 'idx': 0, 'tab': 'r1'}, {'command': 'extract', 'tab': 'r1'},
+               {'command': 'extract', 'tab': 'r2', 'query': 'price'}]
+    fail = {'click'}
+    results, calls = run(actions, fail)
+    assert results == [(True, 'open'), (True, 'open'), (False, 'click'), (False, SKIPPED), (True, 'extract')]
+    assert ('extract', 'r2') in calls and ('extract', 'r1') not in calls
+
+
+def test_explicit_deps_and_fences():
+    actions = [{'command': 'extract', 'tab': 'a'}, {'command': 'extract', 'tab': 'b'},
+               {'command': 'click', 'idx': 1, 'deps': [1]}, {'command': 'switch', 'tab': 'b'},
+               {'command': 'click', 'idx': 0, 'tab': 'a'}]
+    deps, _, _ = build_dag(actions)
+    assert deps[2] == {1}
+    assert deps[3] == {0, 1, 2}
+    assert 3 in deps[4]
+    assert waves(deps) == [[0, 1], [2], [3], [4]]
+
+
+def test_bad_deps_fail_the_plan():
+    results, calls = run([{'command': 'click', 'idx': 1}, {'command': 'click', 'idx': 2, 'deps': [5]}])
+    assert calls == []
+    assert results[0][0] is False and '"deps" must list indices of earlier actions, got 5.' in results[0][1]
+    assert results[1] == (False, SKIPPED)
+
+
+def test_done_actions_are_not_run_again():
+    actions = [{'command': 'click', 'idx': 1}, {'command': 'open', 'idx': 2, 'tab': 'r1'},
+               {'command': 'extract', 'tab': 'r1'}]
+    calls = []
+    results = run_dag(actions, lambda action, tab: calls.append(action['command']) or (True, 'ok'),
+                      done=[(True, 'streamed')])
+    assert calls == ['open', 'extract']
+    assert results[0] == (True, 'streamed')
@@ -0,0 +1,49 @@
+from util.bbox_format import serialize_bboxes, format_outline
+
+
+def bbox(type, text='', top=0, id=None, **kwargs):
+    return {'type': type, 'text': text, 'top': top, 'height': 10, 'id': id, **kwargs}
+
+
+def test_collapses_duplicates_and_textless_elements():
+    bboxes = [bbox('a', 'Add to cart', id=1), bbox('button', ''), bbox('a', 'add to  cart', id=2),
+              bbox('button', '', top=5), bbox('input', '', id=3), bbox('input', '', id=4),
+              bbox('a', 'Add to cart', id=1)]
+    text, stats = serialize_bboxes(bboxes, token_budget=None)
+    assert text.splitlines()[2:] == ['0 (<a>): Add to cart (also 2)', '1 (<button>): (no text) (also 3)',
+                                     '4 (<input>): ', '5 (<input>): ']
+    assert stats['n_empty'] == 2
+    assert stats['n_collapsed'] == 3
+    assert stats['n_shown'] == 4
+
+
+def test_long_text_is_truncated_and_aria_label_wins():
+    text, _ = serialize_bboxes([bbox('a', 'x' * 200), bbox('button', 'ignored', ariaLabel='Close')],
+                               max_text_chars=10, token_budget=None)
+    assert '0 (<a>): xxxxxxx...' in text
+    assert '1 (<button>): Close' in text
+
+
+def test_budget_keeps_task_relevant_elements_with_their_idx():
+    bboxes = [bbox('a', f'Unrelated link number {i}', top=i) for i in range(40)]
+    bboxes.append(bbox('a', 'Blue widget', top=1000))
+    text, stats = serialize_bboxes(bboxes, task='price of the blue widget', token_budget=60)
+    assert '40 (<a>): Blue widget' in text
+    assert stats['n_omitted'] > 0
+    assert f"({stats['n_omitted']} less relevant elements not listed" in text
+    assert stats['tokens'] <= 60
+    assert stats['tokens_saved'] == stats['tokens_full'] - stats['tokens']
+
+
+def test_no_bboxes():
+    text, stats = serialize_bboxes([])
+    assert text == '\nBounding Boxes: None\n'
+    assert stats['tokens_saved'] == 0
+
+
+def test_format_outline():
+    assert format_outline(None) == ''
+    assert format_outline({'above': {'count': 0}, 'below': {'count': 0}}) == ''
+    assert format_outline({'above': {'count': 2}, 'below': {'count': 5, 'landmarks': ['Footer']}}) == \
+        'Off-screen, not labelled: 2 interactive elements above, 5 interactive elements below (Footer). ' \
+        'Scroll to reach them.\n'
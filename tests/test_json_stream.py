@@ -0,0 +1,60 @@
+from util.json_stream import ActionStream
+
+REPLY = '{"thought": "go", "action": [{"command": "click", "idx": 1}, {"command": "type", "idx": 2, "content": "a}"}]}'
+
+
+def feed_all(text, size):
+    parser = ActionStream()
+    events = []
+    for i in range(0, len(text), size):
+        events += parser.feed(text[i:i + size])
+    return parser, events
+
+
+def test_actions_come_out_as_they_close():
+    parser = ActionStream()
+    first = '{"thought": "go", "action": [{"command": "click", "idx": 1}'
+    assert parser.feed(first) == [('field', 'thought', 'go'), ('action', 'action', {'command': 'click', 'idx': 1})]
+    assert parser.feed(REPLY[len(first):]) == [('action', 'action', {'command': 'type', 'idx': 2, 'content': 'a}'})]
+    assert parser.result() == {'thought': 'go', 'action': [{'command': 'click', 'idx': 1},
+                                                           {'command': 'type', 'idx': 2, 'content': 'a}'}]}
+
+
+def test_any_chunking_gives_the_same_events():
+    expected = feed_all(REPLY, len(REPLY))[1]
+    for size in (1, 2, 3, 7):
+        parser, events = feed_all('```json\n' + REPLY + '\n```', size)
+        assert events == expected
+        assert parser.result()['action'][1]['content'] == 'a}'
+
+
+def test_braces_in_leading_prose_are_skipped():
+    text = 'Sure {ok}. "Quoted" it\'s fine. ' + REPLY
+    for size in (1, 5, len(text)):
+        parser, events = feed_all(text, size)
+        assert [e[0] for e in events] == ['field', 'action', 'action']
+        assert parser.result()['thought'] == 'go'
+
+
+def test_object_without_the_list_key_is_dropped():
+    parser, events = feed_all('For example {"thought": "example"} or {} and then ' + REPLY, 4)
+    assert [e for e in events if e[0] == 'action'] == [('action', 'action', {'command': 'click', 'idx': 1}),
+                                                       ('action', 'action', {'command': 'type', 'idx': 2,
+                                                                             'content': 'a}'})]
+    assert parser.fields == {'thought': 'go'}
+    assert parser.result()['thought'] == 'go'
+
+
+def test_waits_for_the_character_after_a_brace():
+    parser = ActionStream()
+    assert parser.feed('Here: {') == []
+    assert parser.feed('"action": [') == []
+    assert parser.feed('{"command": "finish"}]}') == [('action', 'action', {'command': 'finish'})]
+    assert parser.result() == {'action': [{'command': 'finish'}]}
+
+
+def test_invalid_action_and_unclosed_reply():
+    parser = ActionStream()
+    events = parser.feed('{"action": [{\'command\': \'click\'}, {"command": "finish"}')
+    assert events == [('invalid', 'action', "{'command': 'click'}"), ('action', 'action', {'command': 'finish'})]
+    assert parser.result() is None
@@ -0,0 +1,72 @@
+import pytest
+from langchain_core.messages.human import HumanMessage
+from langchain_core.messages.system import SystemMessage
+
+from util.llm_cache import LLMCache, CacheMissError, prompt_key
+
+USAGE = {'input_tokens': 10, 'output_tokens': 2, 'total_tokens': 12}
+
+
+def prompt(text, image='data:image/jpeg;base64,AAAA'):
+    return [SystemMessage('system'),
+            HumanMessage([{'type': 'text', 'text': text}, {'type': 'image_url', 'image_url': {'url': image}}])]
+
+
+def test_prompt_key():
+    assert prompt_key(prompt('a'), 'm') == prompt_key(prompt('a'), 'm')
+    assert prompt_key(prompt('a'), 'm') != prompt_key(prompt('a'), 'other')
+    assert prompt_key(prompt('a'), 'm') != prompt_key(prompt('a', image='data:image/jpeg;base64,BBBB'), 'm')
+
+
+def test_screenshots_are_not_stored(tmp_path):
+    cache = LLMCache(mode='record', path=str(tmp_path / 'cache.sqlite'))
+    cache.put(prompt('a'), 'm', 'reply', USAGE)
+    rows = cache._db.execute('SELECT response FROM responses').fetchall()
+    assert rows and 'AAAA' not in rows[0][0]
+
+
+def test_record_then_replay(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    recorder = LLMCache(mode='record', path=path)
+    assert recorder.get(prompt('a'), 'm') is None
+    recorder.put(prompt('a'), 'm', 'reply a', USAGE)
+    assert recorder.get(prompt('a'), 'm') == {'content': 'reply a', 'usage_metadata': USAGE}
+    assert (recorder.hits, recorder.misses) == (1, 1)
+
+    replayer = LLMCache(mode='replay', path=path)
+    assert replayer.get(prompt('a'), 'm')['content'] == 'reply a'
+    with pytest.raises(CacheMissError):
+        replayer.get(prompt('b'), 'm')
+
+
+def test_replay_session_falls_back_in_order(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    recorder = LLMCache(mode='record', path=path, session='run')
+    for i in range(3):
+        recorder.put(prompt(f'step {i}'), 'm', f'reply {i}', USAGE)
+
+    replayer = LLMCache(mode='replay', path=path, session='run')
+    # the screenshot changed, so only the session order can match it
+    assert replayer.get(prompt('step 0', image='data:new'), 'm')['content'] == 'reply 0'
+    # an exact hit moves the cursor past its row
+    assert replayer.get(prompt('step 1'), 'm')['content'] == 'reply 1'
+    assert replayer.get(prompt('step 2', image='data:new'), 'm')['content'] == 'reply 2'
+    with pytest.raises(CacheMissError):
+        replayer.get(prompt('step 3', image='data:new'), 'm')
+
+
+def test_memory_lru_is_bounded(tmp_path):
+    cache = LLMCache(mode='record', path=str(tmp_path / 'cache.sqlite'), max_memory_items=2)
+    for i in range(3):
+        cache.put(prompt(str(i)), 'm', str(i), USAGE)
+    assert len(cache._memory) == 2
+    # evicted from memory, still in SQLite
+    assert cache.get(prompt('0'), 'm')['content'] == '0'
+
+
+def test_passthrough_and_bad_mode(tmp_path):
+    cache = LLMCache(mode='passthrough')
+    cache.put(prompt('a'), 'm', 'reply', USAGE)
+    assert cache.get(prompt('a'), 'm') is None
+    with pytest.raises(ValueError):
+        LLMCache(mode='nope', path=str(tmp_path / 'cache.sqlite'))
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.messages.human import HumanMessage
+
+from util.agent import LMModel
+
+USAGE = {'input_tokens': 10, 'output_tokens': 2, 'total_tokens': 12}
+
+
+def make_model(monkeypatch, chunks, reply='{"action": []}'):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    model = LMModel(model_name='test-stream-model', cache=None)
+    model.cache = None
+    calls = SimpleNamespace(invoke=0)
+
+    def invoke(messages):
+        calls.invoke += 1
+        return AIMessage(reply, usage_metadata=USAGE)
+    model.model = SimpleNamespace(stream=lambda messages, stream_usage: iter(chunks), invoke=invoke)
+    return model, calls
+
+
+def test_stream_yields_chunks_and_settles(monkeypatch):
+    chunks = [AIMessageChunk('{"action": '), AIMessageChunk('[]}', usage_metadata=USAGE)]
+    model, calls = make_model(monkeypatch, chunks)
+    tokens = model.limiter._tokens
+    assert ''.join(model.stream([HumanMessage('hi')])) == '{"action": []}'
+    assert calls.invoke == 0
+    assert model.metadata['total_tokens'] == 12
+    assert model.limiter._tokens >= tokens - 12
+
+
+def test_empty_stream_falls_back_to_invoke(monkeypatch):
+    model, calls = make_model(monkeypatch, [])
+    tokens = model.limiter._tokens
+    assert list(model.stream([HumanMessage('hi')])) == ['{"action": []}']
+    assert calls.invoke == 1
+    assert model.metadata['total_tokens'] == 12
+    # the stream's reservation was given back, only the real call is billed
+    assert model.limiter._tokens >= tokens - 12
+
+
+def test_default_model_keeps_custom_shared_limits(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    custom = LMModel(model_name='test-quota-model', requests_per_minute=30, tokens_per_minute=40_000)
+    default = LMModel(model_name='test-quota-model')
+    assert default.limiter is custom.limiter
+    assert (custom.limiter.rpm, custom.limiter.tpm) == (30, 40_000)
@@ -0,0 +1,59 @@
+from util.memory import Memory
+from util.rate_limiter import count_tokens
+
+
+def test_recent_window_and_extractive_summary():
+    memory = Memory(window=2, max_summary_tokens=20)
+    for i in range(10):
+        memory.add_step(f'thought number {i} ' + 'x' * 20, [])
+    assert [i for i, _ in memory.recent] == [8, 9]
+    assert memory.summary[0].startswith('0 - thought number 0')
+    assert memory.summary[-1].startswith('7 - ')
+    assert len(memory.summary) == 2
+    assert memory.n_elided == 6
+    rendered = memory.render()
+    assert '... (6 steps omitted)' in rendered
+    assert '9 - thought number 9' in rendered
+
+
+def test_prompt_stops_growing():
+    memory = Memory(window=3, max_summary_tokens=50)
+    sizes = []
+    for i in range(30):
+        memory.add_step(f'step {i} ' + 'y' * 100, [({'command': 'click', 'idx': i}, 'ok')], url=f'http://site/{i}')
+        sizes.append(count_tokens(memory.render()))
+    assert max(sizes[10:]) - min(sizes[10:]) < 10
+
+
+def test_urls_and_failures_are_capped_and_counted():
+    memory = Memory(max_urls=2, max_failures=2)
+    for url in ('http://a', 'http://b', 'http://a', 'http://c'):
+        memory.add_step(None, [], url=url)
+    assert list(memory.visited) == ['http://a', 'http://c']
+    for _ in range(2):
+        memory.add_step(None, [], failed=[({'command': 'click', 'idx': 3}, 'not clickable')])
+    rendered = memory.render()
+    assert "{'command': 'click', 'idx': 3} - not clickable (x2)" in rendered
+    assert 'No Commands Executed' in rendered
+
+
+def test_extract_results_get_a_bigger_cap():
+    memory = Memory(max_thought_chars=20, max_extract_chars=100)
+    memory.add_step('t', [({'command': 'extract'}, 'a' * 90), ({'command': 'click', 'idx': 1}, 'b' * 90)])
+    (_, extracted), (_, clicked) = memory.last_results
+    assert extracted == 'a' * 90
+    assert clicked == 'b' * 17 + '...'
+
+
+def test_summarizer_rewrites_the_summary():
+    calls = []
+
+    def summarizer(messages):
+        calls.append(messages)
+        return 'short notes'
+
+    memory = Memory(window=1, max_summary_tokens=5, summarizer=summarizer)
+    for i in range(3):
+        memory.add_step(f'a long thought about step {i}', [])
+    assert memory.summary == ['short notes']
+    assert calls
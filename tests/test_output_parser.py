@@ -0,0 +1,98 @@
+from util.output_parser import extract_json, parse, parse_with_repair
+
+SCHEMA = {'fields': {'thought': str, 'action': list},
+          'required': ['action'],
+          'commands': {'click': {'idx': int},
+                       'type': {'idx': int, 'content': str},
+                       'finish': {}}}
+
+
+def test_plain_object():
+    assert parse('{"thought": "x", "action": []}', SCHEMA) == ({'thought': 'x', 'action': []}, None)
+
+
+def test_fenced_reply_with_prose():
+    text = 'Here you go:\n```json\n{"thought": "x", "action": [{"command": "finish"}]}\n```\nDone.'
+    data, error = parse(text, SCHEMA)
+    assert error is None
+    assert data['action'] == [{'command': 'finish'}]
+
+
+def test_fences_inside_strings_are_kept():
+    text = ('{"thought": "type ```json here```", '
+            '"action": [{"command": "type", "idx": 2, "content": "```python\\nprint(1)\\n```"}]}')
+    data, error = parse(text, SCHEMA)
+    assert error is None
+    assert data['thought'] == 'type ```json here```'
+    assert data['action'][0]['content'] == '```python\nprint(1)\n```'
+
+
+def test_fenced_reply_keeps_fences_inside_strings():
+    text = '```json\n{"thought": "use ``` to quote", "action": []}\n```'
+    assert parse(text, SCHEMA)[0]['thought'] == 'use ``` to quote'
+
+
+def test_empty_object_in_prose_is_skipped():
+    data, repaired = extract_json('An empty object {} then {"thought": "x", "action": []}')
+    assert data == {'thought': 'x', 'action': []}
+    assert not repaired
+
+
+def test_first_object_that_validates_wins():
+    text = 'For example {"command": "click"} is an action. {"thought": "x", "action": [{"command": "finish"}]}'
+    data, error = parse(text, SCHEMA)
+    assert error is None
+    assert data['thought'] == 'x'
+
+
+def test_falls_back_to_first_object_when_none_validate():
+    data, error = parse('{"thought": "a"} {"thought": "b"}', SCHEMA)
+    assert data == {'thought': 'a'}
+    assert 'Missing the "action" key.' in error
+
+
+def test_repairs_trailing_commas_and_python_literals():
+    data, repaired = extract_json("{'thought': 'it, }', 'done': True, 'action': [None,],}")
+    assert repaired
+    assert data == {'thought': 'it, }', 'done': True, 'action': [None]}
+
+
+def test_trailing_comma_inside_string_is_kept():
+    data, _ = extract_json('{"thought": "a,]", "action": [1,],}')
+    assert data == {'thought': 'a,]', 'action': [1]}
+
+
+def test_unclosed_and_missing_objects():
+    assert parse('{"thought": "x"', SCHEMA)[0] is None
+    assert 'not closed' in parse('{"thought": "x"', SCHEMA)[1]
+    assert parse('no json here', SCHEMA) == (None, 'No JSON object found. Reply with a single JSON object.')
+    assert parse(None, SCHEMA) == (None, 'Empty reply.')
+
+
+def test_coercion():
+    text = '{"action": {"command": "click", "idx": "3"}}'
+    assert parse(text, SCHEMA) == ({'action': [{'command': 'click', 'idx': 3}]}, None)
+    schema = {'fields': {'progress': int}, 'ranges': {'progress': (0, 100)}}
+    assert parse('{"progress": "80%"}', schema) == ({'progress': 80}, None)
+    assert 'between 0 and 100' in parse('{"progress": 120}', schema)[1]
+
+
+def test_command_errors():
+    _, error = parse('{"action": [{"command": "hover"}, {"command": "type", "idx": 1}]}', SCHEMA)
+    assert 'unknown command "hover"' in error
+    assert 'action[1] (type) is missing the "content" key.' in error
+
+
+def test_parse_with_repair_reprompts_once():
+    prompts = []
+
+    def model(messages):
+        prompts.append(messages)
+        return '{"action": []}'
+
+    stats = {}
+    data, text, error = parse_with_repair(model, '{"thought": "x"}', SCHEMA, stats)
+    assert (data, text, error) == ({'action': []}, '{"action": []}', None)
+    assert len(prompts) == 1
+    assert 'Missing the "action" key.' in prompts[0][1].content
+    assert stats == {'reprompted': 1}
@@ -0,0 +1,72 @@
+import asyncio
+
+from langchain_core.messages.human import HumanMessage
+from langchain_core.messages.system import SystemMessage
+
+from util.rate_limiter import RateLimiter, estimate_tokens, count_tokens
+from util.rate_limiter import IMAGE_TOKENS, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+
+
+def test_estimate_tokens():
+    messages = [SystemMessage('x' * 400),
+                HumanMessage([{'type': 'text', 'text': 'y' * 40},
+                              {'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,...'}}])]
+    assert count_tokens('x' * 400) == 100
+    assert estimate_tokens(messages) == 100 + 10 + IMAGE_TOKENS
+    assert estimate_tokens(messages, image_tokens=0) == 110
+
+
+def test_reserve_and_settle():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    assert limiter._try_acquire(600) == 0
+    # 400 tokens left, the next 600 have to wait for the bucket to refill
+    assert limiter._try_acquire(600) > 0
+    # the call only used 100, the other 500 go back
+    limiter.settle(600, 100)
+    assert limiter._try_acquire(600) == 0
+
+
+def test_requests_bucket():
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=10 ** 6)
+    assert limiter._try_acquire(1) == 0
+    assert limiter._try_acquire(1) == 0
+    wait = limiter._try_acquire(1)
+    assert 0 < wait <= 30
+
+
+def test_oversized_call_still_gets_through():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100)
+    assert limiter._try_acquire(10 ** 6) == 0
+
+
+def test_settle_never_overfills():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100)
+    limiter.settle(1000, 0)
+    assert limiter._tokens == 100
+
+
+def test_shared_limiter_takes_the_latest_limits():
+    first = RateLimiter.shared('test-shared-model', requests_per_minute=100, tokens_per_minute=5000)
+    second = RateLimiter.shared('test-shared-model', requests_per_minute=10, tokens_per_minute=1000)
+    assert first is second
+    assert (first.rpm, first.tpm) == (10, 1000)
+    assert first._tokens <= 1000
+
+
+def test_aacquire():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    asyncio.run(limiter.aacquire(500))
+    assert limiter._tokens < 501
+
+
+def test_shared_limiter_keeps_limits_that_are_not_given():
+    limiter = RateLimiter.shared('test-partial-model', requests_per_minute=20, tokens_per_minute=3000)
+    assert RateLimiter.shared('test-partial-model') is limiter
+    assert (limiter.rpm, limiter.tpm) == (20, 3000)
+    RateLimiter.shared('test-partial-model', tokens_per_minute=2000)
+    assert (limiter.rpm, limiter.tpm) == (20, 2000)
+
+
+def test_new_shared_limiter_starts_with_the_defaults():
+    limiter = RateLimiter.shared('test-default-model')
+    assert (limiter.rpm, limiter.tpm) == (REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
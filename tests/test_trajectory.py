@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+from util.trajectory import TrajectoryStore, TrajectorySession, task_template
+
+SEARCH = [{'type': 'input', 'text': '', 'ariaLabel': 'Search'}, {'type': 'button', 'text': 'Go'}]
+RESULTS = [{'type': 'a', 'text': 'Home'}, {'type': 'a', 'text': 'Blue widget $42'}, {'type': 'a', 'text': 'Next'}]
+
+
+def make_state(url, elements):
+    return SimpleNamespace(driver=SimpleNamespace(current_url=url), focus='main',
+                           tabs={'main': SimpleNamespace(elements=elements)}, last_observation=None)
+
+
+def store(tmp_path):
+    return TrajectoryStore(mode='replay', path=str(tmp_path / 'trajectories.sqlite'))
+
+
+def record_run(session):
+    session.observe('agent', make_state('http://shop/search', SEARCH))
+    session.record('agent', {'thought': 'search', 'action': [{'command': 'type', 'idx': 0, 'content': 'blue widget'}]},
+                   [(True, None)])
+    session.observe('agent', make_state('http://shop/results', RESULTS))
+    session.record('agent', {'thought': 'open', 'action': [{'command': 'click', 'idx': 1}]}, [(True, None)])
+
+
+def test_task_template():
+    assert task_template('Price of "blue widget" under 50') == ('price of <<slot0>> under <<slot1>>',
+                                                               ['blue widget', '50'])
+    assert task_template("price of 'red keyboard' under 20")[0] == 'price of <<slot0>> under <<slot1>>'
+
+
+def test_only_successful_runs_are_saved(tmp_path):
+    trajectories = store(tmp_path)
+    session = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    record_run(session)
+    session.finish('$42', success=False)
+    assert trajectories.latest('compiler1', 'price of "blue widget"') is None
+    session.finish('$42', success=True)
+    assert len(trajectories.latest('compiler1', 'price of "red keyboard"')['steps']) == 2
+
+
+def test_replay_fills_slots_and_remaps_idx(tmp_path):
+    trajectories = store(tmp_path)
+    session = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    record_run(session)
+    session.finish('$42', success=True)
+
+    replay = TrajectorySession('compiler1', 'price of "red keyboard"', trajectories)
+    output = replay.observe('agent', make_state('http://shop/search', SEARCH))
+    assert output['action'] == [{'command': 'type', 'idx': 0, 'content': 'red keyboard'}]
+    replay.record('agent', output, [(True, None)])
+    # a banner pushed the result down, and the result's text has the slot in it
+    shifted = [{'type': 'div', 'text': 'Sale'}] + RESULTS
+    shifted[2] = {'type': 'a', 'text': 'Red keyboard $42'}
+    output = replay.observe('agent', make_state('http://shop/results', shifted))
+    assert output['action'] == [{'command': 'click', 'idx': 2}]
+    assert not replay.diverged
+
+
+def test_replay_stops_at_the_first_mismatch(tmp_path):
+    trajectories = store(tmp_path)
+    session = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    record_run(session)
+    session.finish('$42', success=True)
+
+    replay = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    assert replay.observe('agent', make_state('http://shop/other', SEARCH)) is None
+    assert replay.diverged and 'expected http://shop/search' in replay.divergence
+    assert replay.observe('agent', make_state('http://shop/search', SEARCH)) is None
+
+
+def test_failed_action_stops_the_replay(tmp_path):
+    trajectories = store(tmp_path)
+    session = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    record_run(session)
+    session.finish('$42', success=True)
+
+    replay = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    output = replay.observe('agent', make_state('http://shop/search', SEARCH))
+    replay.record('agent', output, [(False, 'not found')])
+    assert replay.diverged
+    assert replay.observe('agent', make_state('http://shop/results', RESULTS)) is None
+
+
+def test_fully_replayed_run_is_not_saved_again(tmp_path):
+    trajectories = store(tmp_path)
+    session = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    record_run(session)
+    session.finish('$42', success=True)
+
+    replay = TrajectorySession('compiler1', 'price of "blue widget"', trajectories)
+    for url, elements in (('http://shop/search', SEARCH), ('http://shop/results', RESULTS)):
+        replay.record('agent', replay.observe('agent', make_state(url, elements)), [(True, None)])
+    replay.finish('$42', success=True)
+    n = trajectories._db.execute('SELECT COUNT(*) FROM trajectories').fetchone()[0]
+    assert n == 1
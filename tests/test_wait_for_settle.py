@@ -0,0 +1,36 @@
+from selenium.common.exceptions import WebDriverException
+
+from selenium_tools.web_util import wait_for_settle
+
+SETTLED = {'settled': True, 'waited_ms': 10}
+
+
+class FakeDriver:
+    """
+    A page that navigates away while settle.js is being installed on it the first time
+    """
+
+    def __init__(self, execute_script_errors=1, async_results=(None, None, SETTLED)):
+        self.execute_script_errors = execute_script_errors
+        self.async_results = list(async_results)
+        self.installs = 0
+
+    def execute_async_script(self, script, *args):
+        return self.async_results.pop(0)
+
+    def execute_script(self, script, *args):
+        if self.execute_script_errors:
+            self.execute_script_errors -= 1
+            raise WebDriverException('javascript error: document unloaded')
+        self.installs += 1
+
+
+def test_navigation_while_installing_is_absorbed():
+    driver = FakeDriver()
+    assert wait_for_settle(driver, timeout=5) is True
+    assert driver.installs == 1
+
+
+def test_gives_up_at_the_deadline():
+    driver = FakeDriver(execute_script_errors=10 ** 6, async_results=[None] * 10 ** 6)
+    assert wait_for_settle(driver, timeout=0.2) is False
@@ -0,0 +1,123 @@
+from util.tracing import span
+
+"""
+Runs a plan's action list as a dependency graph instead of strictly in order, the LLMCompiler part of the project.
+
+Actions can be annotated with:
+- "tab": the tab they run in, the observed one unless given. "open" creates the tab it names.
+- "deps": indices of earlier actions they need, e.g. {"command": "extract", "tab": "r2", "deps": [3]}
+
+On top of the explicit deps, each tab is kept consistent: an action that changes a page (click, open...) waits for
+everything before it in that tab, an action that only reads it (extract, and open reading its link) waits for the
+last change. So a plain list runs in order, like before, while independent branches don't wait on each other.
+switch/close/restart are fences, everything before them runs first and everything after runs after them. switch only
+changes the tab the next step looks at: actions without a "tab" still run in the observed one, their idx come from it.
+
+Actions run in waves of everything that's ready, in plan order. Within a wave, opening tabs doesn't wait for the
+page to load, so "open 3 results, then extract from each" loads the 3 pages at the same time. An action whose
+dependency failed is skipped, the other branches keep going. Everything joins back before the next LLM call.
+"""
+
+MAIN_TAB = 'main'  # name of the first tab
+# commands that read a page without changing it
+READ_COMMANDS = ('extract',)
+# commands that wait for every earlier action, wherever it runs
+BARRIER_COMMANDS = ('answer', 'finish', 'askuser')
+# barriers that every later action waits for too
+FENCE_COMMANDS = ('switch', 'close', 'restart')
+SKIPPED = 'Execution halted before reaching this'
+
+
+def uses_dag(actions):
+    """
+    Whether a plan needs the graph at all, plain lists keep the old sequential path
+    """
+    return any(isinstance(a, dict) and ('deps' in a or 'tab' in a or a.get('command') in ('open', 'extract'))
+               for a in actions)
+
+
+def tab_of(action, current=MAIN_TAB):
+    """
+    The tab an action runs in, current is the observed one
+    """
+    if not isinstance(action, dict) or action.get('command') in ('open',) + FENCE_COMMANDS:
+        return current  # open reads the link from the observed page
+    tab = action.get('tab')
+    return tab if isinstance(tab, str) and tab else current
+
+
+def build_dag(actions, current=MAIN_TAB):
+    """
+    Returns (deps, tabs, errors): deps[i] is the set of indices action i waits for, always earlier ones,
+    and tabs[i] the tab it runs in. current: the observed tab
+    """
+    deps, tabs, errors = [], [], []
+    last_write, reads_since = {}, {}  # tab -> index of its last change, tab -> reads since then
+    fence = None
+    for i, action in enumerate(actions):
+        d = set() if fence is None else {fence}
+        explicit = action.get('deps', []) if isinstance(action, dict) else []
+        for j in explicit if isinstance(explicit, list) else [explicit]:
+            if isinstance(j, bool) or not isinstance(j, int) or not 0 <= j < i:
+                errors.append(f'action[{i}]: "deps" must list indices of earlier actions, got {j}.')
+            else:
+                d.add(j)
+
+        command = action.get('command') if isinstance(action, dict) else None
+        if command in BARRIER_COMMANDS + FENCE_COMMANDS:
+            d.update(range(i))
+        tab = tab_of(action, current)
+        if tab in last_write:
+            d.add(last_write[tab])
+        if command in READ_COMMANDS or command == 'open':
+            reads_since.setdefault(tab, []).append(i)
+        else:
+            d.update(reads_since.pop(tab, []))
+            last_write[tab] = i
+        if command == 'open':
+            # the tab it creates (or reuses) changes
+            target = action.get('tab')
+            d.update(reads_since.pop(target, []))
+            if target in last_write:
+                d.add(last_write[target])
+            last_write[target] = i
+        if command in FENCE_COMMANDS:
+            fence = i
+        deps.append(d)
+        tabs.append(tab)
+    return deps, tabs, errors
+
+
+def waves(deps):
+    """
+    Groups of action indices that can run together, in order
+    """
+    wave_of = []
+    for d in deps:
+        wave_of.append(1 + max((wave_of[j] for j in d), default=-1))
+    return [[i for i, w in enumerate(wave_of) if w == n] for n in range(max(wave_of, default=-1) + 1)]
+
+
+def run_dag(actions, execute, done=(), current=MAIN_TAB):
+    """
+    execute(action, tab) -> (exit_state, response). Returns [(exit_state, response)] for every action, in plan order.
+    Actions that depend on a failed (or skipped) one aren't run, and get (False, SKIPPED).
+    done: results of the first actions, if they already ran (e.g. while the plan was streaming in)
+    current: the observed tab, where actions without a "tab" run
+    """
+    deps, tabs, errors = build_dag(actions, current)
+    results = list(done) + [None] * (len(actions) - len(done))
+    if errors and len(done) < len(actions):
+        # a bad graph isn't worth guessing at
+        return results[:len(done)] + [(False, ' '.join(errors))] + [(False, SKIPPED)] * (len(actions) - len(done) - 1)
+    groups = [[i for i in group if i >= len(done)] for group in waves(deps)]
+    groups = [group for group in groups if group]
+    with span('action_dag', n_actions=len(actions), n_waves=len(groups)):
+        for n, group in enumerate(groups):
+            with span('action_wave', wave=n, actions=group):
+                for i in group:
+                    if any(not results[j][0] for j in deps[i]):
+                        results[i] = (False, SKIPPED)
+                    else:
+                        results[i] = execute(actions[i], tabs[i])
+    return results
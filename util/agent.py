@@ -1,41 +1,327 @@
-import re
-import json
 import os
 from dotenv import load_dotenv
 
 from langchain_openai.chat_models.base import ChatOpenAI
-from selenium_tools.web_util import mark_page, scroll_window, take_screenshot, type_text
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from util.llm_cache import LLMCache
+from util.rate_limiter import RateLimiter, estimate_tokens
+from util.tracing import span
+from util.bbox_format import BboxStats, words
+from util.action_dag import run_dag, MAIN_TAB
+from util.output_parser import parse
+from selenium.common.exceptions import WebDriverException
+from selenium_tools.web_util import mark_page_with_outline, scroll_window, take_screenshot, type_text, get_marked_element, run_actions
+from selenium_tools.ax_tree import ax_mark_page, tag_element
+from selenium_tools.web_util import image_hash, hash_distance, elements_digest, wait_for_settle, page_text, list_tabs
 
 
 import time
+import random
+import asyncio
+import threading
+from collections import deque
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(script_dir, '..', '.env'))
 
+PAGE_HASH_THRESHOLD = 5  # screenshots whose hashes differ in at most this many bits count as the same page
+RETRY_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+BACKOFF_BASE = 1  # seconds, doubled after every failed attempt
+BACKOFF_MAX = 30
+# the wait command: at least WAIT_MIN_SECONDS, then until the page settles, up to WAIT_TIMEOUT
+WAIT_MIN_SECONDS = 1
+WAIT_TIMEOUT = 5
+# commands that run in the page through run_actions, consecutive ones share a single round-trip
+BATCH_COMMANDS = ('click', 'type', 'scroll')
+SCROLL_AMOUNT = 400
+# characters of page text the extract command returns
+EXTRACT_MAX_CHARS = 1200
+# tabs observed besides the current one, the most recently opened first
+MAX_OBSERVED_TABS = 4
+# where State gets the elements to label: mark_page.js, or the accessibility tree over CDP (selenium_tools/ax_tree.py)
+OBSERVATION_BACKENDS = ('markpage', 'axtree')
+STUCK_HINT = 'The page has not changed in the last {n} observations. Your previous actions are not working, try something different.'
+
+
+class Tab:
+    """
+    A browser tab, and what was seen in it at its last observation
+    """
+
+    def __init__(self, name, handle):
+        self.name = name
+        self.handle = handle  # WebDriver window handle, the CDP target id on Chrome
+        self.title = ''
+        self.url = ''
+        self.img = None  # b64 encoded screenshot, only taken while it's the current tab
+        self.elements = []  # plain element data returned from mark_page, resolved lazily
+        self.outline = None  # off-screen summary from mark_page_with_outline, None unless viewport_first
+
 
 class State:
     """
     Webdriver state info, and tools to use
+
+    Every tab has its own Tab (marked elements, screenshot). self.focus is the tab the agent is looking at, where
+    commands without a "tab" run. Other tabs are observed too (labels only), so the agent can act on any of them.
     """
 
-    def __init__(self, driver, start_site):
+    def __init__(self, driver, start_site, history_size=10, stuck_threshold=3, interactive=True, viewport_first=False,
+                 backend='markpage'):
+        """
+        interactive: False if there's no human to answer askuser, e.g. in batch runs
+        viewport_first: only label what's in view, and summarize the rest of the page in self.outline. Off-screen
+        elements then have no idx until the agent scrolls to them
+        backend: one of OBSERVATION_BACKENDS
+        """
+        if backend not in OBSERVATION_BACKENDS:
+            raise ValueError(f'backend must be one of {OBSERVATION_BACKENDS}, got {backend}')
         self.driver = driver
         self.start_site = start_site
+        self.interactive = interactive
+        self.viewport_first = viewport_first
+        self.backend = backend
         self.driver.get(start_site)
+        self.tabs = {MAIN_TAB: Tab(MAIN_TAB, self.driver.current_window_handle)}  # name -> Tab, in opening order
+        self.focus = MAIN_TAB  # the observed tab
+        self.current = MAIN_TAB  # the tab the driver is on
+
+        # rolling history of observation fingerprints, to tell if actions are doing anything. Marked and unmarked
+        # observations are kept apart, so the Validator's screenshots don't push the Executor's out of is_stuck's reach
+        history_size = max(history_size, 2 * stuck_threshold + 1)
+        self.observations = {True: deque(maxlen=history_size), False: deque(maxlen=history_size)}
+        self.last_observation = None
+        self.stuck_threshold = stuck_threshold
+
+        self.img_bytes = 0  # encoded size of the last screenshot
+        self.total_img_bytes = 0
+        self.bbox_stats = BboxStats()  # prompt tokens spent/saved on self.elements
+
+    # what was seen in the current tab
+    @property
+    def elements(self):
+        return self.tabs[self.current].elements
+
+    @elements.setter
+    def elements(self, value):
+        self.tabs[self.current].elements = value
+
+    @property
+    def outline(self):
+        return self.tabs[self.current].outline
+
+    @outline.setter
+    def outline(self, value):
+        self.tabs[self.current].outline = value
 
-        self.img = None  # b64 encoded screenshot of the page
-        self.elements = []  # elements returned from mark_page
+    @property
+    def img(self):
+        return self.tabs[self.current].img
+
+    @img.setter
+    def img(self, value):
+        self.tabs[self.current].img = value
 
     def prep_browser_variables(self, **kwargs):
-        self.elements = mark_page(self.driver)
-        self.img = take_screenshot(self.driver, remove=False)
+        self.observe_tabs()
+        # don't look at a half-loaded page
+        wait_for_settle(self.driver)
+        self.elements, self.outline = self.mark_page()
+        self._take_screenshot()
+        self._record_observation()
+
+    def mark_page(self):
+        """
+        Labels the current tab with the configured backend, returns (elements, outline)
+        """
+        if self.backend == 'axtree':
+            return ax_mark_page(self.driver, viewport=self.viewport_first)
+        return mark_page_with_outline(self.driver, viewport=self.viewport_first)
+
+    def sync_tabs(self):
+        """
+        Picks up tabs the pages opened themselves (target=_blank links, popups) and forgets closed ones.
+        If the focused tab closed itself, the focus moves to the first remaining one.
+        Titles and URLs for every tab come from one CDP call, without switching to them.
+        """
+        open_tabs = {t['handle']: t for t in list_tabs(self.driver)}
+        for name, tab in list(self.tabs.items()):
+            if tab.handle not in open_tabs and (name != self.focus or open_tabs):
+                del self.tabs[name]
+        known = {tab.handle for tab in self.tabs.values()}
+        for handle in open_tabs:
+            if handle not in known:
+                name = f'tab{len(self.tabs) + 1}'
+                while name in self.tabs:
+                    name += '_'
+                self.tabs[name] = Tab(name, handle)
+        if self.focus not in self.tabs:
+            # the driver still points at the closed window, switch_tab can't tell which one it is
+            self.focus = self.current = next(iter(self.tabs))
+            self.driver.switch_to.window(self.tabs[self.focus].handle)
+        for tab in self.tabs.values():
+            info = open_tabs.get(tab.handle, {})
+            tab.title, tab.url = info.get('title', tab.title), info.get('url', tab.url)
+
+    def other_tabs(self):
+        """
+        The open tabs besides the focused one, most recently opened first
+        """
+        return [tab for name, tab in reversed(self.tabs.items()) if name != self.focus]
+
+    def observe_tabs(self):
+        """
+        Marks the other open tabs (up to MAX_OBSERVED_TABS), then comes back to the focused one.
+        They were loading side by side, so the settle waits mostly overlap.
+        """
+        self.sync_tabs()
+        others = self.other_tabs()
+        with span('observe_tabs', n_tabs=len(others)):
+            for tab in others[:MAX_OBSERVED_TABS]:
+                try:
+                    self.switch_tab(tab.name)
+                    wait_for_settle(self.driver)
+                    tab.elements, tab.outline = self.mark_page()
+                except WebDriverException:
+                    tab.elements, tab.outline = [], None
+            for tab in others[MAX_OBSERVED_TABS:]:
+                tab.elements, tab.outline = [], None
+            self.switch_tab(self.focus)
+
+    def _take_screenshot(self):
+        self.img = take_screenshot(self.driver)
+        self.img_bytes = len(self.img) * 3 // 4
+        self.total_img_bytes += self.img_bytes
+
+    def _record_observation(self, marked=True):
+        """
+        Fingerprint the current screenshot/elements. Marked and unmarked screenshots are
+        tracked separately since the labels change the image.
+        """
+        self.last_observation = {'img_hash': image_hash(self.img),
+                                 'elements': elements_digest(self.elements),
+                                 'marked': marked}
+        self.observations[marked].append(self.last_observation)
+
+    def unchanged_count(self, marked=True):
+        """
+        Number of observations in a row before the latest one that look the same as it
+        """
+        observations = list(self.observations[marked])
+        if not observations:
+            return 0
+        latest = observations[-1]
+        n = 0
+        for o in reversed(observations[:-1]):
+            if o['elements'] != latest['elements'] or hash_distance(o['img_hash'], latest['img_hash']) > PAGE_HASH_THRESHOLD:
+                break
+            n += 1
+        return n
+
+    def page_changed(self, marked=True):
+        return self.unchanged_count(marked) == 0
+
+    def stuck_hint(self, marked=True):
+        """
+        Hint to add to the prompt if the page hasn't changed in a while, otherwise ''
+        """
+        n = self.unchanged_count(marked)
+        return STUCK_HINT.format(n=n + 1) if n >= self.stuck_threshold else ''
+
+    def is_stuck(self, marked=True):
+        """
+        The hint didn't help either, time to restart
+        """
+        return self.unchanged_count(marked) >= 2 * self.stuck_threshold
+
+    def _element_id(self, i):
+        """
+        data-llmweb-id of the ith element, tagging it first if it came from the accessibility tree. None if it's gone
+        """
+        item = self.elements[i]
+        if item.get('backendNodeId') is not None and not tag_element(self.driver, item):
+            return None
+        return item['id']
 
     def _get_ith_element(self, i):
         if i >= len(self.elements):
             return False, f'Index out of bounds, only {len(self.elements)} available'
-        return True, self.elements[i]['element']
+        element = get_marked_element(self.driver, self.elements[i]) if self._element_id(i) is not None else None
+        if element is None:
+            return False, 'Element is no longer on the page.'
+        return True, element
+
+    def _compile(self, args):
+        """
+        Turns a click/type/scroll command into a run_actions op. Returns (op, None) or (None, error)
+        """
+        command, idx = args.get('command'), args.get('idx', None)
+        op = {'op': command, 'id': None, 'content': args.get('content', None), 'dx': 0, 'dy': 0}
+        if command == 'scroll':
+            dir = args.get('dir', None)
+            if dir not in ['up', 'down']:
+                return None, 'idx is none, or dir is not one of (up, down)'
+            op['dy'] = -SCROLL_AMOUNT if dir == 'up' else SCROLL_AMOUNT
+            if not isinstance(idx, int):
+                return op, None
+        elif command == 'type' and (idx is None or op['content'] is None):
+            return None, 'Invalid arguments to command.'
+        elif idx is None:
+            return None, 'No idx provided.'
+        if idx >= len(self.elements):
+            return None, f'Index out of bounds, only {len(self.elements)} available'
+        op['id'] = self._element_id(idx)
+        if op['id'] is None:
+            return None, 'Element is no longer on the page.'
+        return op, None
+
+    def execute_batch(self, commands):
+        """
+        Runs click/type/scroll commands in the page, in as few round-trips as possible (one unless a command
+        navigates or needs a native WebDriver action). Returns [(exit_state, response)] for the commands that ran,
+        stopping at the first failure, or after a command that navigated: the idx of the rest refer to the old page,
+        so they are left unrun.
+        """
+        native = {'click': self._native_click, 'type': self._native_type, 'scroll': self._native_scroll}
+        results = []
+        while len(results) < len(commands):
+            remaining = commands[len(results):]
+            ops, error = [], None
+            for args in remaining:
+                op, error = self._compile(args)
+                if op is None:
+                    break
+                ops.append(op)
+            try:
+                ran = run_actions(self.driver, ops) if ops else []
+            except WebDriverException:
+                # something in the page got in the way, do the first one the slow way
+                ran = [{'ok': False, 'native': True}]
+            for args, out in zip(remaining, ran):
+                if out.get('native'):
+                    results.append(native[args['command']](args))
+                else:
+                    results.append((True, None) if out['ok'] else (False, out.get('error')))
+            if results and not results[-1][0]:
+                return results
+            if ran and ran[-1].get('navigates') and len(results) < len(commands):
+                wait_for_settle(self.driver)
+                return results
+            if len(ran) == len(ops) and error is not None:
+                results.append((False, error))
+                return results
+        return results
 
     def click(self, args):
+        return self.execute_batch([{**args, 'command': 'click'}])[0]
+
+    def type(self, args):
+        return self.execute_batch([{**args, 'command': 'type'}])[0]
+
+    def scroll(self, args):
+        return self.execute_batch([{**args, 'command': 'scroll'}])[0]
+
+    def _native_click(self, args):
         idx = args.get('idx', None)
         if idx is None:
             return False, 'No idx provided.'
@@ -49,7 +335,7 @@ class State:
         except:
             return False, 'Failed to click.'
 
-    def type(self, args):
+    def _native_type(self, args):
         idx = args.get('idx', None)
         content = args.get('content', None)
         if idx is None or content is None:
@@ -65,7 +351,7 @@ class State:
         except:
             return False, 'Failed to type.'
 
-    def scroll(self, args):
+    def _native_scroll(self, args):
         idx = args.get('idx', None)
         dir = args.get('dir', None)
         if dir not in ['up', 'down']:
@@ -76,7 +362,7 @@ class State:
         if not idx_exists:
             return False, element
 
-        amountDown = -400 if dir == 'up' else 400
+        amountDown = -SCROLL_AMOUNT if dir == 'up' else SCROLL_AMOUNT
         try:
             scroll_window(self.driver, element, amountDown=amountDown)
             return True, None
@@ -84,7 +370,8 @@ class State:
             return False, 'Failed to scroll'
 
     def wait(self, args):
-        time.sleep(5)
+        time.sleep(WAIT_MIN_SECONDS)
+        wait_for_settle(self.driver, timeout=WAIT_TIMEOUT)
         return True, None
 
     def ask_user(self, args):
@@ -94,6 +381,8 @@ class State:
         question = args.get('question', None)
         if question is None:
             return False, 'Question was not provided. Make sure to include "question" key.'
+        if not self.interactive:
+            return False, 'No user is available. Continue on your own.'
         answer = input(f'ANSWER THIS: {question} ?> ')
         return True, answer
 
@@ -102,41 +391,335 @@ class State:
         return True, None
 
     def restart(self, args):
+        self.close_tabs()
         self.driver.get(self.start_site)
+        for observations in self.observations.values():
+            observations.clear()
         return True, None
 
+    def switch_tab(self, name):
+        """
+        Points the driver at a tab, by name. Returns (True, None) or (False, error)
+        """
+        tab = self.tabs.get(name)
+        if tab is None:
+            return False, f'There is no tab named {name}, the open tabs are {", ".join(self.tabs)}.'
+        if self.driver.current_window_handle != tab.handle:
+            self.driver.switch_to.window(tab.handle)
+        self.current = name
+        return True, None
+
+    def focus_tab(self, args):
+        """
+        The switch command: look at another tab from the next observation on
+        """
+        name = args.get('tab', None)
+        ok, error = self.switch_tab(name)
+        if ok:
+            self.focus = name
+        return ok, error
+
+    def close_tab(self, args):
+        """
+        The close command. Closing the focused tab moves the focus to the first remaining one.
+        """
+        name = args.get('tab', None)
+        if name not in self.tabs:
+            return False, f'There is no tab named {name}, the open tabs are {", ".join(self.tabs)}.'
+        if len(self.tabs) == 1:
+            return False, 'That is the only tab left.'
+        self.switch_tab(name)
+        self.driver.close()
+        del self.tabs[name]
+        if self.focus == name:
+            self.focus = next(iter(self.tabs))
+        self.switch_tab(self.focus)
+        return True, None
+
+    def close_tabs(self):
+        """
+        Closes every tab but the first, and focuses it
+        """
+        first = next(iter(self.tabs))
+        for name, tab in list(self.tabs.items())[1:]:
+            try:
+                self.driver.switch_to.window(tab.handle)
+                self.driver.close()
+            except WebDriverException:
+                pass  # already gone
+            del self.tabs[name]
+        self.focus = first
+        self.driver.switch_to.window(self.tabs[first].handle)
+        self.current = first
+
+    def open_tab(self, args):
+        """
+        Opens the link at idx in a background tab named args['tab'] (or loads it in that tab, if it's already open).
+        Doesn't wait for it to load, so several can load at once.
+        """
+        idx, name = args.get('idx', None), args.get('tab', None)
+        if idx is None or not isinstance(name, str) or not name or name == self.current:
+            return False, 'open needs an idx, and a new name for the tab in the "tab" key.'
+        idx_exists, element = self._get_ith_element(idx)
+        if not idx_exists:
+            return False, element
+        href = element.get_attribute('href')
+        if not href or href.startswith('javascript:'):
+            return False, 'Element is not a link, click it instead.'
+        if name in self.tabs:
+            previous = self.current
+            ok, error = self.switch_tab(name)
+            if not ok:
+                return False, error
+            try:
+                self.driver.execute_script("window.location.href = arguments[0];", href)
+            finally:
+                # it stays a background tab
+                self.switch_tab(previous)
+            return True, None
+        before = set(self.driver.window_handles)
+        self.driver.execute_script("window.open(arguments[0], '_blank');", href)
+        new = set(self.driver.window_handles) - before
+        if not new:
+            return False, 'The browser did not open the tab.'
+        self.tabs[name] = Tab(name, new.pop())
+        return True, None
+
+    def extract(self, args):
+        """
+        Text of the current tab's page once it has loaded, only the parts about args['query'] if given
+        """
+        wait_for_settle(self.driver)
+        page = page_text(self.driver)
+        text = relevant_text(page['text'], args.get('query', None))
+        return True, f"{page['title']} ({page['url']}):\n{text}"
+
+    def run_plan(self, actions, execute, done=()):
+        """
+        Runs actions annotated with deps/tab as a graph (see util/action_dag.py), each in its tab, with that
+        tab's labels. execute(action) -> (exit_state, response). Returns [(exit_state, response)] per action,
+        in plan order.
+        done: results of the first actions, if they already ran
+        """
+        def in_tab(action, tab):
+            ok, error = self.switch_tab(tab)
+            return execute(action) if ok else (False, error)
+        try:
+            return run_dag(actions, in_tab, done, self.focus)
+        finally:
+            self.switch_tab(self.focus)
+
 
 class LMModel:
     """
     LMM Model, tracks usage metadata
+
+    Responses go through an LLMCache if one is given (or configured with LLM_CACHE_MODE, see util/llm_cache.py).
+    Cache hits don't count towards metadata, since they aren't billed. metadata['cached_tokens'] counts the input
+    tokens the provider served from its prompt cache (billed at a discount, see util/prompt_layout.py).
+
+    Calls are paced by a RateLimiter shared by every LMModel with the same model name, and retried with
+    exponential backoff on rate limits, timeouts and server errors. Use acall() from async code, and stream() to
+    act on the response while it arrives.
     """
 
-    def __init__(self):
-        self.model = ChatOpenAI(model="gpt-4o-mini",
-                                temperature=0)
+    def __init__(self, model_name="gpt-4o-mini", cache=None, timeout=60, max_retries=5,
+                 requests_per_minute=None, tokens_per_minute=None):
+        """
+        requests_per_minute, tokens_per_minute: the API quota for this model name, shared with every other LMModel
+        using it. None keeps the limits already set (by default 500 requests and 200k tokens per minute)
+        """
+        self.model_name = model_name
+        # retries are handled here, so the limiter sees every attempt
+        self.model = ChatOpenAI(model=model_name,
+                                temperature=0,
+                                timeout=timeout,
+                                max_retries=0)
+        self.cache = cache if cache is not None else LLMCache.from_env()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = RateLimiter.shared(model_name, requests_per_minute, tokens_per_minute)
         self.metadata = {'input_tokens': 0,
-                         'output_tokens': 0, 'total_tokens': 0}
+                         'output_tokens': 0, 'total_tokens': 0, 'cached_tokens': 0}
+        self._metadata_lock = threading.Lock()
+
+    @staticmethod
+    def cached_tokens(metadata):
+        return (metadata.get('input_token_details') or {}).get('cache_read') or 0
 
     def _update_metadata(self, metadata):
-        for key in self.metadata:
-            # error if any keys don't exist
-            self.metadata[key] += metadata[key]
+        with self._metadata_lock:
+            for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+                # error if any keys don't exist
+                self.metadata[key] += metadata[key]
+            self.metadata['cached_tokens'] += self.cached_tokens(metadata)
 
-    def __call__(self, prompt):
-        output = self.model.invoke(prompt)
+    def _backoff(self, attempt):
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+
+    def _prepare(self, prompt):
+        """
+        Returns (messages, cached content or None)
+        """
+        messages = prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt
+        if self.cache is not None:
+            cached = self.cache.get(messages, self.model_name)
+            if cached is not None:
+                return messages, cached['content']
+        return messages, None
+
+    def _finish(self, messages, output, reserved):
+        self.limiter.settle(reserved, output.usage_metadata['total_tokens'])
         self._update_metadata(output.usage_metadata)
+        if self.cache is not None:
+            self.cache.put(messages, self.model_name, output.content, output.usage_metadata)
         return output.content
 
+    def _trace(self, s, output=None, content=None, attempts=0):
+        s.set(cached=output is None, attempts=attempts,
+              output_chars=len(content if content is not None else output.content))
+        if output is not None:
+            s.set(input_tokens=output.usage_metadata['input_tokens'],
+                  output_tokens=output.usage_metadata['output_tokens'],
+                  cached_tokens=self.cached_tokens(output.usage_metadata))
+
+    def __call__(self, prompt):
+        with span('llm', model=self.model_name) as s:
+            messages, content = self._prepare(prompt)
+            if content is not None:
+                self._trace(s, content=content)
+                return content
+
+            reserved = estimate_tokens(messages)
+            for attempt in range(self.max_retries + 1):
+                self.limiter.acquire(reserved)
+                try:
+                    output = self.model.invoke(messages)
+                    break
+                except RETRY_ERRORS:
+                    self.limiter.settle(reserved, 0)
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self._backoff(attempt))
+                except BaseException:
+                    # not retried, give the reservation back
+                    self.limiter.settle(reserved, 0)
+                    raise
+            self._trace(s, output=output, attempts=attempt + 1)
+            return self._finish(messages, output, reserved)
+
+    async def acall(self, prompt):
+        with span('llm', model=self.model_name) as s:
+            messages, content = self._prepare(prompt)
+            if content is not None:
+                self._trace(s, content=content)
+                return content
+
+            reserved = estimate_tokens(messages)
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.aacquire(reserved)
+                try:
+                    output = await asyncio.wait_for(self.model.ainvoke(messages), self.timeout)
+                    break
+                except (*RETRY_ERRORS, asyncio.TimeoutError):
+                    self.limiter.settle(reserved, 0)
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self._backoff(attempt))
+                except BaseException:
+                    self.limiter.settle(reserved, 0)
+                    raise
+            self._trace(s, output=output, attempts=attempt + 1)
+            return self._finish(messages, output, reserved)
+
+    def stream(self, prompt):
+        """
+        Yields the response text chunk by chunk. A cached response comes back as a single chunk.
+        Errors are only retried before the first chunk arrives, since what was yielded can't be taken back.
+        If the provider sends no chunks at all, the response is requested again without streaming.
+        """
+        with span('llm', model=self.model_name, stream=True) as s:
+            messages, content = self._prepare(prompt)
+            if content is not None:
+                self._trace(s, content=content)
+                yield content
+                return
+
+            reserved = estimate_tokens(messages)
+            for attempt in range(self.max_retries + 1):
+                self.limiter.acquire(reserved)
+                output = None
+                start = time.perf_counter()
+                try:
+                    for chunk in self.model.stream(messages, stream_usage=True):
+                        if output is None:
+                            s.set(first_chunk_seconds=time.perf_counter() - start)
+                        output = chunk if output is None else output + chunk
+                        if chunk.content:
+                            yield chunk.content
+                    break
+                except RETRY_ERRORS:
+                    self.limiter.settle(reserved, 0)
+                    if output is not None or attempt == self.max_retries:
+                        raise
+                    time.sleep(self._backoff(attempt))
+                except BaseException:
+                    # including the caller closing the stream early
+                    self.limiter.settle(reserved, 0)
+                    raise
+            if output is None:
+                # the provider sent no chunks at all, give the reservation back and ask again without streaming
+                self.limiter.settle(reserved, 0)
+                s.set(empty_stream=True, attempts=attempt + 1)
+                yield self(messages)
+                return
+            self._trace(s, output=output, attempts=attempt + 1)
+            self._finish(messages, output, reserved)
+
+
+def command_groups(commands):
+    """
+    Splits a list of commands into groups to execute: runs of consecutive click/type/scroll commands
+    (for State.execute_batch), and every other command on its own. Yields (batched, [commands])
+    """
+    group = []
+    for command in commands:
+        if isinstance(command, dict) and command.get('command') in BATCH_COMMANDS:
+            group.append(command)
+            continue
+        if group:
+            yield True, group
+            group = []
+        yield False, [command]
+    if group:
+        yield True, group
+
+
+def relevant_text(text, query=None, max_chars=EXTRACT_MAX_CHARS):
+    """
+    The non-empty lines of text, in page order, within max_chars. With a query, the lines sharing the most words with
+    it are kept first.
+    """
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    order = range(len(lines))
+    if query:
+        query_words = words(query)
+        order = sorted(order, key=lambda i: (-len(query_words & words(lines[i])), i))
+    keep, n = [], 0
+    for i in order:
+        if n + len(lines[i]) + 1 > max_chars:
+            if not query:
+                break
+            continue
+        keep.append(i)
+        n += len(lines[i]) + 1
+    return '\n'.join(lines[i] for i in sorted(keep))
+
 
 def parse_output(text: str):
     """
     Parses text, extracting a JSON object from the text and returning
-    the relevant list, if possible
+    the relevant list, if possible. See util/output_parser.py for schema checks and repairs.
     """
-    try:
-        pattern = r'\{.*\}'
-        match = re.search(pattern, text, re.DOTALL)
-        output = json.loads(match.group())
-        return output
-    except:
-        return None
\ No newline at end of file
+    return parse(text)[0]
\ No newline at end of file
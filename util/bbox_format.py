@@ -0,0 +1,184 @@
+import re
+import threading
+
+from util.rate_limiter import count_tokens
+
+"""
+Serializes the bounding boxes returned by mark_page for the prompt, within a token budget.
+
+- each element's text is whitespace-collapsed and truncated to MAX_TEXT_CHARS
+- elements with the same type and text are collapsed into one line: "3 (<a>): Add to cart (also 17, 42)"
+- so are elements with no text (icon buttons, videos, iframes...), one line per type: "5 (<button>): (no text)",
+  except form fields, which are listed one by one (something has to be typed into them)
+- if it still doesn't fit, elements are ranked by how many words they share with the task, then by how high up
+  the viewport they are, and the lowest ranked are left out, starting with the ones without text
+
+Lines keep the original index, so the model's idx still points at state.elements[idx].
+"""
+
+BBOX_TOKEN_BUDGET = 1500
+# per background tab, see format_tabs
+TAB_BBOX_TOKEN_BUDGET = 300
+MAX_TEXT_CHARS = 80
+EMPTY_LABEL = '(no text)'
+OMITTED_NOTE = '({} less relevant elements not listed, but still labelled on the screenshot)\n'
+# kept even when they have no text, tags from mark_page and roles from the accessibility tree
+FORM_TYPES = {'input', 'textarea', 'select', 'textbox', 'searchbox', 'combobox', 'listbox', 'spinbutton'}
+STOPWORDS = {'a', 'an', 'the', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'at', 'by', 'with', 'from', 'is', 'it',
+             'me', 'my', 'i', 'you', 'your', 'this', 'that', 'what', 'tell', 'find', 'go', 'get', 'tip', 'none'}
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def words(text):
+    return {w for w in WORD_PATTERN.findall(text.lower()) if w not in STOPWORDS and len(w) > 1}
+
+
+def _raw_text(bbox):
+    text = bbox.get('ariaLabel') or ""
+    if not text.strip():
+        text = bbox.get('text') or ""
+    return text
+
+
+def _label(bbox, max_text_chars):
+    text = ' '.join(_raw_text(bbox).split())
+    if len(text) > max_text_chars:
+        text = text[:max_text_chars - 3].rstrip() + '...'
+    return text
+
+
+def serialize_bboxes(bboxes, task='', token_budget=BBOX_TOKEN_BUDGET, max_text_chars=MAX_TEXT_CHARS):
+    """
+    bboxes: should be returned by mark_page
+    Returns (formatted string, stats dict). token_budget=None disables the budget.
+    """
+    # what dumping every element verbatim would have cost
+    tokens_full = count_tokens(''.join(f'{i} (<{b.get("type")}>): {_raw_text(b)}\n' for i, b in enumerate(bboxes)))
+    stats = {'n_bboxes': len(bboxes), 'n_shown': 0, 'n_empty': 0, 'n_collapsed': 0, 'n_omitted': 0}
+    if not bboxes:
+        text = '\nBounding Boxes: None\n'
+        return text, {**stats, 'tokens': count_tokens(text), 'tokens_full': count_tokens(text), 'tokens_saved': 0}
+
+    # one entry per distinct (type, text): [idx, type, label, other idxs, top]
+    entries = {}
+    ids = {}
+    for i, bbox in enumerate(bboxes):
+        label = _label(bbox, max_text_chars)
+        if label:
+            key = (bbox.get('type'), label.lower())
+        elif bbox.get('type') in FORM_TYPES:
+            key = ('id', bbox.get('id', i))
+        else:
+            stats['n_empty'] += 1
+            key, label = ('empty', bbox.get('type')), EMPTY_LABEL
+        entry = entries.get(key)
+        if entry is None:
+            entries[key] = [i, bbox.get('type'), label, [], bbox.get('top', 0)]
+            ids[key] = {bbox.get('id')}
+            continue
+        stats['n_collapsed'] += 1
+        # another rect of an element already listed adds nothing, a different element is worth pointing at
+        if bbox.get('id') is None or bbox.get('id') not in ids[key]:
+            ids[key].add(bbox.get('id'))
+            entry[3].append(i)
+
+    lines = {}
+    for idx, type, label, others, _ in entries.values():
+        also = f" (also {', '.join(map(str, others))})" if others else ''
+        lines[idx] = f'{idx} (<{type}>): {label}{also}\n'
+
+    header = '\nBounding Boxes:\n'
+    shown = set(lines)
+    if token_budget is not None and count_tokens(header + ''.join(lines.values())) > token_budget:
+        task_words = words(task or '')
+        viewport_height = max((b.get('top', 0) + b.get('height', 0) for b in bboxes), default=0) or 1
+
+        def score(entry):
+            idx, type, label, _, top = entry
+            relevance = len(task_words & words(label))
+            position = 1 - min(max(top, 0) / viewport_height, 1)
+            if label == EMPTY_LABEL:
+                return position - 1
+            return relevance + 0.5 * position + (0.5 if type in FORM_TYPES else 0)
+
+        shown = set()
+        # leave room for the "omitted" note
+        used = count_tokens(header + OMITTED_NOTE.format(len(lines)))
+        for entry in sorted(entries.values(), key=lambda e: (-score(e), e[0])):
+            cost = count_tokens(lines[entry[0]]) + 1
+            if used + cost > token_budget:
+                continue
+            shown.add(entry[0])
+            used += cost
+
+    text = header + ''.join(lines[idx] for idx in sorted(shown))
+    stats['n_shown'] = len(shown)
+    stats['n_omitted'] = len(lines) - len(shown)
+    if stats['n_omitted']:
+        text += OMITTED_NOTE.format(stats['n_omitted'])
+
+    tokens = count_tokens(text)
+    return text, {**stats, 'tokens': tokens, 'tokens_full': tokens_full, 'tokens_saved': max(tokens_full - tokens, 0)}
+
+
+def format_bboxes(bboxes, task='', token_budget=BBOX_TOKEN_BUDGET):
+    return serialize_bboxes(bboxes, task, token_budget)[0]
+
+
+def format_outline(outline):
+    """
+    One line about what's off-screen, from mark_page_with_outline's outline. '' if there's nothing (or no outline).
+    """
+    if not outline:
+        return ''
+    parts = []
+    for where in ('above', 'below'):
+        side = outline.get(where) or {}
+        if not side.get('count') and not side.get('landmarks'):
+            continue
+        part = f"{side.get('count', 0)} interactive elements {where}"
+        if side.get('landmarks'):
+            part += f" ({'; '.join(side['landmarks'])})"
+        parts.append(part)
+    if not parts:
+        return ''
+    return f"Off-screen, not labelled: {', '.join(parts)}. Scroll to reach them.\n"
+
+
+def format_tabs(tabs, task='', token_budget=TAB_BBOX_TOKEN_BUDGET):
+    """
+    The other open tabs (util.agent.Tab), each with its own labelled elements, indented under it
+    """
+    if not tabs:
+        return ''
+    text = '\nOther open tabs. To act in one, add "tab": its name to the command, with an idx listed under it:\n'
+    for tab in tabs:
+        text += f'[{tab.name}] {tab.title} ({tab.url})\n'
+        if tab.elements:
+            listed = serialize_bboxes(tab.elements, task, token_budget)[0].split('\n', 2)[2]
+            text += ''.join(f'  {line}\n' for line in listed.splitlines())
+    return text
+
+
+class BboxStats:
+    """
+    Tokens spent/saved on bounding boxes, per iteration (last) and in total
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.iterations = 0
+        self.tokens = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, stats):
+        with self._lock:
+            self.last = stats
+            self.iterations += 1
+            self.tokens += stats['tokens']
+            self.tokens_saved += stats['tokens_saved']
+
+    def __str__(self):
+        return (f"{self.last.get('tokens', 0)} tokens for {self.last.get('n_shown', 0)}/{self.last.get('n_bboxes', 0)} "
+                f"bounding boxes, saved {self.last.get('tokens_saved', 0)}")
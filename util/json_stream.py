@@ -0,0 +1,154 @@
+import json
+
+from util.output_parser import OBJECT_START_PATTERN
+
+"""
+Incremental parser for the agents' JSON replies, fed chunk by chunk as the LLM streams them:
+
+parser = ActionStream()
+for chunk in model.stream(prompt):
+    for kind, key, value in parser.feed(chunk):
+        ...  # ('field', 'thought', '...') or ('action', 'action', {...})
+data = parser.result()
+
+Each object in the top-level "action" list is emitted as soon as its closing brace arrives, and every top-level
+string field (thought, page...) as soon as it's complete. Text around the JSON (prose, code fences) is skipped:
+like util.output_parser, only a { followed by a quote starts the object, and an object without the list key
+(e.g. an example in the prose) is dropped and the search goes on after it.
+An action that isn't valid JSON on its own (e.g. single quotes) comes out as ('invalid', 'action', its text), so
+the caller knows the actions after it aren't the next ones of the plan.
+"""
+
+
+class ActionStream:
+    def __init__(self, list_key='action'):
+        self.list_key = list_key
+        self.text = ''
+        self._pos = 0
+        self._stack = []  # open '{' / '['
+        self._in_string = False
+        self._escape = False
+        self._token_start = None  # start of the value/object being tracked
+        self._key = None  # last key read in the top-level object
+        self._expect_key = False
+        self._in_list = False  # inside the top-level list_key array
+        self._start = None  # where the top-level object starts
+        self._seen_list = False
+        self._done = False
+        self.actions = []
+        self.fields = {}
+
+    def feed(self, chunk):
+        """
+        Returns [(kind, key, value)] for everything completed by this chunk
+        """
+        self.text += chunk
+        events = []
+        while self._pos < len(self.text) and not self._done:
+            if not self._stack and self.text[self._pos] == '{' and not self.text[self._pos + 1:].strip():
+                # can't tell yet whether this { starts the object, wait for what comes after it
+                break
+            event = self._step(self.text[self._pos], self._pos)
+            self._pos += 1
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _step(self, c, i):
+        depth = len(self._stack)
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == '\\':
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+                if depth == 1:
+                    return self._end_top_level_string(i)
+            return None
+
+        if depth == 0:
+            # quotes in the prose don't start strings, same as util.output_parser
+            if c == '{' and OBJECT_START_PATTERN.match(self.text, i):
+                self._stack.append(c)
+                self._start = i
+                self._expect_key = True
+            return None
+        if c == '"':
+            self._in_string = True
+            if depth == 1:
+                self._token_start = i
+            return None
+
+        if c in '{[':
+            if depth == 1 and c == '[' and self._key == self.list_key:
+                self._in_list = True
+            elif depth == 2 and c == '{' and self._in_list:
+                self._token_start = i
+            self._stack.append(c)
+            return None
+        if c in '}]':
+            self._stack.pop()
+            if not self._stack:
+                if self._seen_list:
+                    self._done = True
+                else:
+                    self._reset()
+            elif len(self._stack) == 1 and c == ']':
+                self._in_list = False
+            elif len(self._stack) == 2 and c == '}' and self._in_list and self._token_start is not None:
+                return self._end_action(i)
+            return None
+
+        if depth == 1:
+            if c == ',':
+                self._expect_key = True
+            elif c == ':':
+                self._expect_key = False
+        return None
+
+    def _reset(self):
+        """
+        Forget an object that turned out not to be the reply
+        """
+        self._start = None
+        self._token_start = None
+        self._key = None
+        self._seen_list = False
+        self._expect_key = False
+        self.fields = {}
+
+    def _end_top_level_string(self, i):
+        literal = self.text[self._token_start:i + 1]
+        self._token_start = None
+        try:
+            value = json.loads(literal)
+        except ValueError:
+            return None
+        if self._expect_key:
+            self._key = value
+            self._seen_list = self._seen_list or value == self.list_key
+            return None
+        self.fields[self._key] = value
+        return 'field', self._key, value
+
+    def _end_action(self, i):
+        literal = self.text[self._token_start:i + 1]
+        self._token_start = None
+        try:
+            action = json.loads(literal)
+        except ValueError:
+            return 'invalid', self.list_key, literal
+        self.actions.append(action)
+        return 'action', self.list_key, action
+
+    def result(self):
+        """
+        The whole object once the stream is over, or None if it never closed
+        """
+        if not self._done:
+            return None
+        try:
+            return json.loads(self.text[self._start:self._pos])
+        except ValueError:
+            return None
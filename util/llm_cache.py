@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+"""
+Content-addressed cache for LLM responses, used by LMModel.
+
+Keys are a hash of the model name + serialized prompt messages. Image payloads are replaced by their
+hash, so the cache never stores screenshots. Responses live in an in-memory LRU, backed by SQLite.
+
+Modes:
+- passthrough: no caching, every call goes to the API
+- record: identical prompts are served from the cache, misses go to the API and are stored
+- replay: never call the API. Misses fall back to the next response recorded in the same session
+  (screenshots of a live page rarely match byte for byte), or raise CacheMissError
+"""
+
+MODES = ('passthrough', 'record', 'replay')
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.llm_cache.sqlite')
+
+
+class CacheMissError(Exception):
+    pass
+
+
+def _hash(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def _serialize_content(content):
+    if isinstance(content, str):
+        return content
+    parts = []
+    for part in content:
+        if isinstance(part, dict) and part.get('type') == 'image_url':
+            image_url = part['image_url'] if isinstance(part['image_url'], dict) else {'url': part['image_url']}
+            part = {**part, 'image_url': {**image_url, 'url': f"sha256:{_hash(image_url['url'])}"}}
+        parts.append(part)
+    return parts
+
+
+def prompt_key(messages, model_name):
+    """
+    messages: list of langchain messages, e.g. prompt.to_messages()
+    """
+    data = {'model': model_name,
+            'messages': [{'type': m.type, 'content': _serialize_content(m.content)} for m in messages]}
+    return _hash(json.dumps(data, sort_keys=True))
+
+
+class LLMCache:
+    def __init__(self, mode='record', path=DEFAULT_PATH, max_memory_items=256, session=None):
+        """
+        session: name recorded with each response. In replay mode, responses from this session are
+        served in order when a prompt doesn't match exactly.
+        """
+        if mode not in MODES:
+            raise ValueError(f'Cache mode must be one of {MODES}, got {mode}')
+        self.mode = mode
+        self.max_memory_items = max_memory_items
+        self.session = session
+        self.hits, self.misses = 0, 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._replay_pos = 0  # last rowid served sequentially in replay mode
+        self._db = None
+        if mode != 'passthrough':
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                             '(key TEXT PRIMARY KEY, model TEXT, session TEXT, response TEXT, created REAL)')
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """
+        LLM_CACHE_MODE, LLM_CACHE_PATH and LLM_CACHE_SESSION configure the cache. None if passthrough.
+        """
+        mode = os.getenv('LLM_CACHE_MODE', 'passthrough')
+        if mode == 'passthrough':
+            return None
+        return cls(mode=mode, path=os.getenv('LLM_CACHE_PATH', DEFAULT_PATH),
+                   session=os.getenv('LLM_CACHE_SESSION'))
+
+    def _remember(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, messages, model_name):
+        """
+        Returns the cached response dict({content, usage_metadata}), or None on a miss
+        In replay mode, raises CacheMissError if nothing can be served.
+        """
+        if self.mode == 'passthrough':
+            return None
+        key = prompt_key(messages, model_name)
+        with self._lock:
+            entry = self._memory.get(key)  # (response, rowid)
+            if entry is None:
+                row = self._db.execute('SELECT response, rowid FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is None and self.mode == 'replay' and self.session is not None:
+                    row = self._db.execute('SELECT response, rowid FROM responses WHERE session = ? AND rowid > ? '
+                                           'ORDER BY rowid LIMIT 1', (self.session, self._replay_pos)).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+                    self._remember(key, entry)
+            else:
+                self._memory.move_to_end(key)
+            response = entry[0] if entry is not None else None
+            if entry is not None and self.mode == 'replay':
+                # exact hits consume their row too, so the sequential fallback doesn't serve it again
+                self._replay_pos = max(self._replay_pos, entry[1])
+
+            if response is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise CacheMissError(f'No recorded response for prompt {key[:12]}')
+            else:
+                self.hits += 1
+            return response
+
+    def put(self, messages, model_name, content, usage_metadata):
+        if self.mode != 'record':
+            return
+        key = prompt_key(messages, model_name)
+        response = {'content': content, 'usage_metadata': dict(usage_metadata or {})}
+        with self._lock:
+            cursor = self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                      (key, model_name, self.session, json.dumps(response), time.time()))
+            self._db.commit()
+            self._remember(key, (response, cursor.lastrowid))
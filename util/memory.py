@@ -0,0 +1,117 @@
+from collections import deque, OrderedDict
+
+from util.tracing import span
+from util.rate_limiter import count_tokens
+from langchain_core.messages.system import SystemMessage
+from langchain_core.messages.human import HumanMessage
+
+"""
+Bounded memory of an agent's past steps, rendered into the prompt as past_observation_summary.
+
+The last `window` thoughts are kept verbatim. Older ones are folded into a summary capped at max_summary_tokens:
+by default the first step (usually the plan) and the most recent ones are kept and the middle is dropped,
+or, if a summarizer model is given, the summary is rewritten by it whenever it goes over the cap.
+Visited URLs and failed actions are kept separately (the most recent max_urls/max_failures), so the model can
+still tell it's going in circles after the steps themselves are gone.
+
+Every part is capped, so the prompt stops growing after `window` steps.
+"""
+
+SUMMARIZER_PROMPT_STR = """
+You compress the notes of a web browsing agent. Rewrite the notes below in under {words} words.
+Keep what was tried, what worked, and what didn't. Reply with the notes only.
+"""
+
+
+def _truncate(text, max_chars):
+    text = ' '.join(str(text).split())
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + '...'
+
+
+class Memory:
+    def __init__(self, window=4, max_summary_tokens=300, max_thought_chars=300, max_urls=8, max_failures=8,
+                 summarizer=None, max_extract_chars=1500):
+        """
+        summarizer: optional LMModel (ideally a cheap one) used to rewrite the summary when it's over its cap
+        max_extract_chars: cap for the page text returned by extract commands, which is what the step was for
+        """
+        self.window = window
+        self.max_summary_tokens = max_summary_tokens
+        self.max_thought_chars = max_thought_chars
+        self.max_urls = max_urls
+        self.max_failures = max_failures
+        self.summarizer = summarizer
+        self.max_extract_chars = max_extract_chars
+
+        self.n_steps = 0
+        self.recent = deque()  # (step number, thought)
+        self.summary = []  # lines
+        self.n_elided = 0  # steps dropped from the summary
+        self.visited = OrderedDict()  # url -> visits, most recent last
+        self.failures = OrderedDict()  # action -> [error, count], most recent last
+        self.last_results = []
+
+    def _result_chars(self, command):
+        extract = isinstance(command, dict) and command.get('command') == 'extract'
+        return self.max_extract_chars if extract else self.max_thought_chars
+
+    def add_step(self, thought, command_results, failed=(), url=None):
+        """
+        thought: the model's thought for this step, or None
+        command_results: [(command, result)] of this step
+        failed: [(command, error)] for the commands that failed
+        url: the page the step ended on
+        """
+        if thought:
+            self.recent.append((self.n_steps, _truncate(thought, self.max_thought_chars)))
+            self.n_steps += 1
+        self.last_results = [(command, _truncate(res, self._result_chars(command))) for command, res in command_results]
+
+        if url:
+            self.visited[url] = self.visited.pop(url, 0) + 1
+            while len(self.visited) > self.max_urls:
+                self.visited.popitem(last=False)
+        for command, error in failed:
+            key = _truncate(command, 200)
+            count = self.failures.pop(key, [None, 0])[1]
+            self.failures[key] = [_truncate(error, 200), count + 1]
+            while len(self.failures) > self.max_failures:
+                self.failures.popitem(last=False)
+
+        while len(self.recent) > self.window:
+            i, old = self.recent.popleft()
+            self.summary.append(f'{i} - {old}')
+        self._compact()
+
+    def _compact(self):
+        if count_tokens('\n'.join(self.summary)) <= self.max_summary_tokens:
+            return
+        if self.summarizer is not None:
+            with span('summarize_memory', lines=len(self.summary)):
+                words = self.max_summary_tokens // 2
+                messages = [SystemMessage(SUMMARIZER_PROMPT_STR.strip().format(words=words)),
+                            HumanMessage('\n'.join(self.summary))]
+                self.summary = [_truncate(self.summarizer(messages), self.max_summary_tokens * 4)]
+            return
+        # keep the first step and the latest ones
+        while len(self.summary) > 2 and count_tokens('\n'.join(self.summary)) > self.max_summary_tokens:
+            del self.summary[1]
+            self.n_elided += 1
+
+    def render(self):
+        parts = []
+        if self.summary:
+            lines = list(self.summary)
+            if self.n_elided:
+                lines.insert(1, f'... ({self.n_elided} steps omitted)')
+            parts.append('Summary of earlier steps:\n' + '\n'.join(lines))
+        if self.visited:
+            parts.append('Visited pages:\n' + '\n'.join(f'{_truncate(url, 120)}' + (f' (x{n})' if n > 1 else '')
+                                                        for url, n in self.visited.items()))
+        if self.failures:
+            parts.append('Failed actions, do not repeat them:\n' + '\n'.join(
+                f'{command} - {error}' + (f' (x{n})' if n > 1 else '') for command, (error, n) in self.failures.items()))
+        steps = '\n'.join(f'{i} - {thought}' for i, thought in self.recent)
+        results = '\n'.join(f'{c} - {res}' for c, res in self.last_results)
+        parts.append(f'Previous Steps:\n{steps}\nActions from last step:\n{results if results else "No Commands Executed"}')
+        return '\n'.join(parts)
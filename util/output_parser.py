@@ -0,0 +1,267 @@
+import re
+import ast
+import json
+
+from util.tracing import span
+from langchain_core.messages.system import SystemMessage
+from langchain_core.messages.human import HumanMessage
+
+"""
+Parses the agents' JSON replies.
+
+- finds the outermost balanced {...} in the text, ignoring braces inside strings, code fences and prose around it
+- fixes trailing commas, single quotes and Python literals (True/None) before giving up
+- checks the result against a schema, coercing what's unambiguous ("3" -> 3, "80%" -> 80, one action -> [action])
+
+parse(text, schema) returns (data, error). error is None, or a precise message that can be sent back to the model
+with repair_prompt() for a cheap, text-only retry.
+
+A schema is a dict:
+{'fields': {name: type}, 'required': [names], 'ranges': {name: (min, max)},
+ 'commands': {command: {arg: type or set of allowed values}}}  # checks each object in data['action']
+"""
+
+REPAIR_PROMPT_STR = """
+Your previous reply could not be used. Fix it so it is a single valid JSON object that follows the format you were
+given, keeping its content the same. Reply with the JSON only.
+"""
+
+# only lines that are nothing but a fence, so ``` inside a string value is kept
+FENCE_PATTERN = re.compile(r'^[ \t]*```(?:json)?[ \t]*$', re.MULTILINE)
+# strings come first in each alternation, so what's inside them is left alone
+STRING = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+TRAILING_COMMA_PATTERN = re.compile(rf'{STRING}|,\s*([}}\]])')
+LITERAL_PATTERN = re.compile(rf'{STRING}|\b(true|false|null)\b')
+PYTHON_LITERALS = {'true': 'True', 'false': 'False', 'null': 'None'}
+OBJECT_START_PATTERN = re.compile(r'\{\s*["\'}]')
+
+
+def _balanced_objects(text):
+    """
+    Yields every top-level balanced {...} substring, in order. Only a { followed by a quote (or }) starts one,
+    so braces in the prose around the JSON are skipped.
+    """
+    depth, start, quote, escape = 0, None, None, False
+    for i, c in enumerate(text):
+        if quote:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == quote:
+                quote = None
+        elif c in '"\'' and depth > 0:
+            # an apostrophe in prose between keys/values would be rare, in strings it's handled above
+            quote = c
+        elif c == '{':
+            if depth == 0:
+                if not OBJECT_START_PATTERN.match(text, i):
+                    continue
+                start = i
+            depth += 1
+        elif c == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1]
+
+
+def _loads(candidate):
+    """
+    Returns (object, repaired) or raises ValueError
+    """
+    try:
+        return json.loads(candidate), False
+    except ValueError:
+        pass
+    fixed = TRAILING_COMMA_PATTERN.sub(lambda m: m.group(1) or m.group(0), candidate)
+    try:
+        return json.loads(fixed), True
+    except ValueError:
+        pass
+    # single quotes, True/False/None
+    python = LITERAL_PATTERN.sub(lambda m: PYTHON_LITERALS[m.group(1)] if m.group(1) else m.group(0), fixed)
+    try:
+        return ast.literal_eval(python), True
+    except (ValueError, SyntaxError):
+        raise ValueError('not valid JSON')
+
+
+def extract_json(text, schema=None):
+    """
+    Returns (dict, repaired), or (None, error message).
+    The first object that passes the schema wins, so a stray {} or {"..."} in the prose before the reply isn't
+    picked up. If none passes, the first non-empty one is returned (then the first one) for validate() to report on.
+    """
+    text = FENCE_PATTERN.sub('', text)
+    candidates = list(_balanced_objects(text))
+    if not candidates:
+        if '{' in text:
+            return None, 'The JSON object is not closed, every { needs a matching }.'
+        return None, 'No JSON object found. Reply with a single JSON object.'
+    parsed = []
+    for candidate in candidates:
+        try:
+            data, repaired = _loads(candidate)
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        if schema is not None and not validate(data, schema)[1]:
+            return data, repaired
+        parsed.append((data, repaired))
+    if parsed:
+        return next((p for p in parsed if p[0]), parsed[0])
+    return None, f'Invalid JSON: {candidates[0][:200]}'
+
+
+def _coerce(value, expected):
+    """
+    Returns (value, ok)
+    """
+    if isinstance(expected, set):
+        return value, value in expected
+    if expected is int:
+        if isinstance(value, bool):
+            return value, False
+        if isinstance(value, (int, float)):
+            return int(value), True
+        if isinstance(value, str) and re.fullmatch(r'\s*-?\d+(\.\d+)?\s*%?\s*', value):
+            return int(float(value.strip().rstrip('%'))), True
+        return value, False
+    if expected is list:
+        if isinstance(value, list):
+            return value, True
+        return ([value], True) if isinstance(value, dict) else (value, False)
+    if expected is str:
+        if isinstance(value, str):
+            return value, True
+        return (str(value), True) if isinstance(value, (int, float)) else (value, False)
+    if isinstance(expected, tuple):
+        for option in expected:
+            coerced, ok = _coerce(value, option)
+            if ok:
+                return coerced, True
+        return value, False
+    return value, isinstance(value, expected)
+
+
+def _type_name(expected):
+    if isinstance(expected, set):
+        return f'one of {sorted(expected)}'
+    if isinstance(expected, tuple):
+        return ' or '.join(_type_name(e) for e in expected)
+    return {int: 'an integer', str: 'a string', list: 'a list', dict: 'an object'}.get(expected, expected.__name__)
+
+
+def validate(data, schema):
+    """
+    Returns (coerced data, [errors])
+    """
+    data = dict(data)
+    errors = []
+    for name in schema.get('required', []):
+        if name not in data:
+            errors.append(f'Missing the "{name}" key.')
+    for name, expected in schema.get('fields', {}).items():
+        if name not in data:
+            continue
+        data[name], ok = _coerce(data[name], expected)
+        if not ok:
+            errors.append(f'"{name}" must be {_type_name(expected)}, got {json.dumps(data[name])[:80]}.')
+        elif name in schema.get('ranges', {}):
+            low, high = schema['ranges'][name]
+            if not low <= data[name] <= high:
+                errors.append(f'"{name}" must be between {low} and {high}, got {data[name]}.')
+
+    commands = schema.get('commands')
+    if commands is not None and isinstance(data.get('action'), list):
+        actions = []
+        for i, action in enumerate(data['action']):
+            if not isinstance(action, dict):
+                errors.append(f'action[{i}] must be an object with a "command" key.')
+                continue
+            action = dict(action)
+            command = action.get('command')
+            if command not in commands:
+                errors.append(f'action[{i}]: unknown command {json.dumps(command)}, use one of {sorted(commands)}.')
+            else:
+                for arg, expected in commands[command].items():
+                    if arg not in action:
+                        errors.append(f'action[{i}] ({command}) is missing the "{arg}" key.')
+                        continue
+                    action[arg], ok = _coerce(action[arg], expected)
+                    if not ok:
+                        errors.append(f'action[{i}] ({command}): "{arg}" must be {_type_name(expected)}, '
+                                      f'got {json.dumps(action[arg])[:80]}.')
+            actions.append(action)
+        data['action'] = actions
+    return data, errors
+
+
+def parse(text, schema=None):
+    """
+    Returns (data, error). data is None if the reply can't be used at all.
+    If data fails the schema, it's still returned (coerced) along with the error.
+    """
+    with span('parse_output', chars=len(text or '')) as s:
+        if not isinstance(text, str):
+            s.set(failed=True)
+            return None, 'Empty reply.'
+        data, repaired = extract_json(text, schema)
+        if data is None:
+            s.set(failed=True)
+            return None, repaired
+        s.set(repaired=repaired)
+        if schema is None:
+            return data, None
+        data, errors = validate(data, schema)
+        if errors:
+            s.set(failed=True, errors=len(errors))
+            return data, ' '.join(errors)
+        return data, None
+
+
+def describe_schema(schema):
+    """
+    The schema in words, so a text-only re-prompt knows what the reply should look like
+    """
+    required = schema.get('required', [])
+    lines = ['Keys:']
+    for name, expected in schema.get('fields', {}).items():
+        line = f'- "{name}": {_type_name(expected)}'
+        if name in schema.get('ranges', {}):
+            line += ' between {} and {}'.format(*schema['ranges'][name])
+        lines.append(line + (' (required)' if name in required else ''))
+    commands = schema.get('commands')
+    if commands:
+        lines.append('Each object in "action" has a "command" key, one of:')
+        for command, args in commands.items():
+            described = ', '.join(f'"{arg}": {_type_name(expected)}' for arg, expected in args.items())
+            lines.append(f'- {command}' + (f' with {described}' if described else ''))
+    return '\n'.join(lines)
+
+
+def repair_prompt(text, error, schema=None):
+    """
+    Text-only follow-up asking the model to fix its reply, much cheaper than redoing the observation
+    """
+    expected = f'\n\nExpected format:\n{describe_schema(schema)}' if schema else ''
+    return [SystemMessage(REPAIR_PROMPT_STR.strip()),
+            HumanMessage(f'Your reply:\n{text}\n\nProblems:\n{error}{expected}')]
+
+
+def parse_with_repair(model, text, schema, stats=None, max_repairs=1):
+    """
+    Parses text, asking the model to fix it up to max_repairs times.
+    Returns (data or None, final text, error or None). stats counts ok/reprompted/failed replies.
+    """
+    data, error = parse(text, schema)
+    attempt = 0
+    while error is not None and attempt < max_repairs:
+        attempt += 1
+        text = model(repair_prompt(text, error, schema))
+        data, error = parse(text, schema)
+    if stats is not None:
+        outcome = 'failed' if error is not None else 'reprompted' if attempt else 'ok'
+        stats[outcome] = stats.get(outcome, 0) + 1
+    return (data if error is None else None), text, error
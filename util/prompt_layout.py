@@ -0,0 +1,56 @@
+import hashlib
+from functools import lru_cache
+
+from util.rate_limiter import estimate_tokens
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.messages.system import SystemMessage
+from langchain_core.messages.human import HumanMessage
+
+"""
+Builds the agents' prompts stable-to-volatile, so providers that cache prompt prefixes (OpenAI does it automatically
+for prompts over 1024 tokens) can reuse as much of every call as possible:
+
+system prompt (with the command spec) -> task -> memory -> bounding boxes -> screenshot
+
+The system + task prefix is rendered once per (system prompt, task) and reused. prefix_hash identifies it, so the
+trace shows when it changes (e.g. a new task). Anything that changes within a task, like the Validator's tip to the
+Executor, goes after it with the volatile parts.
+"""
+
+IMAGE_DETAIL = 'low'
+
+
+def prefix_hash(messages):
+    digest = hashlib.sha256()
+    for m in messages:
+        digest.update(m.type.encode('utf-8'))
+        digest.update(str(m.content).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+@lru_cache(maxsize=64)
+def stable_prefix(system, task):
+    """
+    Returns ((system message, task message), prefix hash, prefix tokens), computed once per system prompt and task
+    """
+    messages = (SystemMessage(system), HumanMessage(f"TASK: {task}"))
+    return messages, prefix_hash(messages), estimate_tokens(messages)
+
+
+def image_message(img, detail=IMAGE_DETAIL):
+    return HumanMessage([{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}", "detail": detail}}])
+
+
+def build_prompt(system, task, volatile=(), img=None, s=None):
+    """
+    system, task, then each non-empty string in volatile (least to most volatile), then the screenshot.
+    s: optional span to record prefix_hash/prefix_tokens on
+    """
+    prefix, digest, tokens = stable_prefix(system, task)
+    messages = list(prefix) + [HumanMessage(text) for text in volatile if text]
+    if img is not None:
+        messages.append(image_message(img))
+    if s is not None:
+        s.set(prefix_hash=digest, prefix_tokens=tokens)
+    return ChatPromptValue(messages=messages)
@@ -0,0 +1,123 @@
+import time
+import asyncio
+import threading
+
+"""
+Token-bucket rate limiter shared by every LMModel using the same API quota.
+
+Two buckets are kept: requests/min and tokens/min. Callers reserve an estimate of the tokens a call will use
+before sending it, then settle the difference once the real usage is known.
+"""
+
+# gpt-4o-mini bills a low detail image as 2833 input tokens
+IMAGE_TOKENS = 2833
+# limits a shared limiter starts with, unless given
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200_000
+
+
+def count_tokens(text):
+    """
+    Rough token count of a string: ~4 characters per token
+    """
+    return len(text) // 4
+
+
+def estimate_tokens(messages, image_tokens=IMAGE_TOKENS):
+    """
+    Rough input token count for a list of langchain messages: ~4 characters per token, plus a flat cost per image
+    """
+    n = 0
+    for m in messages:
+        if isinstance(m.content, str):
+            n += count_tokens(m.content)
+            continue
+        for part in m.content:
+            if isinstance(part, dict) and part.get('type') == 'image_url':
+                n += image_tokens
+            else:
+                n += count_tokens(part.get('text', '') if isinstance(part, dict) else str(part))
+    return n
+
+
+class RateLimiter:
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, requests_per_minute=None, tokens_per_minute=None):
+        """
+        One limiter per key (e.g. model name), shared across instances, threads and tasks in this process.
+        The limits given last apply to all of them. A limit left as None keeps the current one (the default one for
+        a new limiter).
+        """
+        with cls._shared_lock:
+            limiter = cls._shared.get(key)
+            if limiter is None:
+                limiter = cls._shared[key] = cls(
+                    REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute,
+                    TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute)
+                return limiter
+        limiter.set_limits(requests_per_minute, tokens_per_minute)
+        return limiter
+
+    def set_limits(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        None keeps the current limit
+        """
+        if requests_per_minute is None and tokens_per_minute is None:
+            return
+        with self._lock:
+            self._refill()
+            requests_per_minute = self.rpm if requests_per_minute is None else requests_per_minute
+            tokens_per_minute = self.tpm if tokens_per_minute is None else tokens_per_minute
+            self.rpm = requests_per_minute
+            self.tpm = tokens_per_minute
+            self._requests = min(self._requests, requests_per_minute)
+            self._tokens = min(self._tokens, tokens_per_minute)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _try_acquire(self, tokens):
+        """
+        Reserve 1 request and the given tokens. Returns 0 if reserved, otherwise seconds to wait before retrying
+        """
+        # a single call bigger than the whole bucket would never get through otherwise
+        tokens = min(tokens, self.tpm)
+        with self._lock:
+            self._refill()
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return 0
+            wait_requests = (1 - self._requests) * 60 / self.rpm
+            wait_tokens = (tokens - self._tokens) * 60 / self.tpm
+            return max(wait_requests, wait_tokens, 0.01)
+
+    def acquire(self, tokens):
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, reserved, actual):
+        """
+        Correct a reservation once the real token usage is known
+        """
+        with self._lock:
+            self._tokens = min(self.tpm, self._tokens + reserved - actual)
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import atexit
+import threading
+
+"""
+Lightweight tracing. Wrap a phase in a span, and attach sizes/tokens to it:
+
+with span('mark_page') as s:
+    out = mark_page(driver)
+    s.set(n_elements=len(out))
+
+Tracing is off unless enable() is called, or LLMWEB_TRACE=<path prefix> is set (exports <prefix>.jsonl and
+<prefix>.trace.json on exit). When off, span() returns a shared no-op object, so it costs next to nothing.
+The .trace.json file is in Chrome trace-event format: open it in chrome://tracing or https://ui.perfetto.dev
+"""
+
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = None
+        self.duration_ns = None
+        self.parent = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ns = time.perf_counter_ns() - self.start_ns
+        self.tracer._stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer._record(self)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin_ns = time.perf_counter_ns()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, span):
+        event = {'name': span.name, 'parent': span.parent,
+                 'start_us': (span.start_ns - self._origin_ns) / 1000, 'duration_us': span.duration_ns / 1000,
+                 'thread': threading.get_ident(), 'attrs': span.attrs}
+        with self._lock:
+            self.events.append(event)
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, name, attrs)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def export_jsonl(self, path):
+        with self._lock, open(path, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event, default=str) + '\n')
+
+    def export_chrome_trace(self, path):
+        with self._lock:
+            trace_events = [{'name': e['name'], 'ph': 'X', 'ts': e['start_us'], 'dur': e['duration_us'],
+                             'pid': os.getpid(), 'tid': e['thread'], 'args': e['attrs']} for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def summary(self):
+        """
+        {span name: {count, total_ms}}
+        """
+        out = {}
+        with self._lock:
+            for e in self.events:
+                s = out.setdefault(e['name'], {'count': 0, 'total_ms': 0.0})
+                s['count'] += 1
+                s['total_ms'] += e['duration_us'] / 1000
+        return out
+
+
+tracer = Tracer()
+span = tracer.span
+
+if os.getenv('LLMWEB_TRACE'):
+    _prefix = os.getenv('LLMWEB_TRACE')
+    tracer.enable()
+    atexit.register(lambda: (tracer.export_jsonl(f'{_prefix}.jsonl'), tracer.export_chrome_trace(f'{_prefix}.trace.json')))
@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+from util.tracing import span
+from util.agent import PAGE_HASH_THRESHOLD
+from util.action_dag import tab_of
+from selenium_tools.web_util import hash_distance
+
+"""
+Records what the agents do on each iteration, and replays it on later runs of the same kind of task without the LLM.
+
+A task's template is its text with quoted strings and numbers replaced by slots, so
+'price of "blue widget"' and 'price of "red keyboard"' share trajectories. Slot values are templated out of typed
+content and element fingerprints too. Each step records:
+- the URL, and a fingerprint of the page: a short hash per labelled element (type, text, aria label)
+- the Agent/Executor's thought and actions, with the fingerprint of each action's target, or the Validator's reply
+  (its text templated too)
+- whether each action succeeded
+
+Replay follows the latest successful trajectory for the task's template. A recorded step is only reused if the page
+still matches: same host and path, at least PAGE_MATCH of the recorded elements, and every target found again by
+its fingerprint (its idx is remapped if the page shifted). Once it has run, every action that succeeded when it was
+recorded must succeed again. The Validator judges from the screenshot, so its replies also need a screenshot that
+looks the same (see PAGE_HASH_THRESHOLD). Answers are only replayed for the exact same task, on the same page. At the first
+mismatch the replay stops for good and the LLM takes over, with the replayed steps already in its memory.
+
+Modes (TRAJECTORY_MODE):
+- off: nothing is recorded or replayed
+- record: successful runs are saved
+- replay: successful runs are saved, and replayed as far as they still match
+"""
+
+MODES = ('off', 'record', 'replay')
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.trajectories.sqlite')
+# share of a recorded page's elements that must still be there
+PAGE_MATCH = 0.6
+# commands whose content depends on what was read from the page
+ANSWER_COMMANDS = ('answer',)
+SLOT_PATTERN = re.compile(r'"([^"]+)"|(?<!\w)\'([^\']+)\'(?!\w)|(?<![\w.])(\d+(?:[.,]\d+)*)(?![\w])')
+SLOT_MARKER = '<<slot{}>>'
+
+
+def task_template(task):
+    """
+    Returns (template, slot values): the task, lowercased, with quoted strings and numbers replaced by slots
+    """
+    slots = []
+
+    def slot(match):
+        slots.append(next(g for g in match.groups() if g is not None))
+        return SLOT_MARKER.format(len(slots) - 1)
+    template = SLOT_PATTERN.sub(slot, ' '.join(task.split()))
+    return template.lower(), slots
+
+
+def _to_slots(text, slots):
+    for i, value in enumerate(slots):
+        text = re.sub(rf'(?<!\w){re.escape(value)}(?!\w)', SLOT_MARKER.format(i), text, flags=re.IGNORECASE)
+    return text
+
+
+def _from_slots(text, slots):
+    for i, value in enumerate(slots):
+        text = text.replace(SLOT_MARKER.format(i), value)
+    return text
+
+
+def _action_slots(action, convert, slots):
+    # only the string fields, e.g. typed content or the Validator's feedback, never the command or idx
+    return {k: convert(v, slots) if isinstance(v, str) and k != 'command' else v for k, v in action.items()}
+
+
+def element_fingerprint(element, slots=()):
+    key = ' '.join(f"{element.get('type', '')}|{element.get('text', '')}|{element.get('ariaLabel', '')}".lower().split())
+    return hashlib.sha1(_to_slots(key, slots).encode('utf-8')).hexdigest()[:10]
+
+
+def url_key(url):
+    parts = urlsplit(url or '')
+    return parts.netloc.lower() + parts.path.rstrip('/')
+
+
+class TrajectoryStore:
+    def __init__(self, mode='replay', path=DEFAULT_PATH):
+        if mode not in MODES:
+            raise ValueError(f'Trajectory mode must be one of {MODES}, got {mode}')
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._db = None
+        if mode != 'off':
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS trajectories '
+                             '(agent TEXT, template TEXT, task TEXT, answer TEXT, steps TEXT, created REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS by_template ON trajectories (agent, template)')
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """
+        TRAJECTORY_MODE and TRAJECTORY_PATH configure the store. None if off.
+        """
+        mode = os.getenv('TRAJECTORY_MODE', 'off')
+        if mode == 'off':
+            return None
+        return cls(mode=mode, path=os.getenv('TRAJECTORY_PATH', DEFAULT_PATH))
+
+    def save(self, agent, task, answer, steps):
+        if self.mode == 'off':
+            return
+        with self._lock:
+            self._db.execute('INSERT INTO trajectories VALUES (?, ?, ?, ?, ?, ?)',
+                             (agent, task_template(task)[0], task, answer, json.dumps(steps), time.time()))
+            self._db.commit()
+
+    def latest(self, agent, task):
+        """
+        The most recent trajectory recorded for the task's template, as {task, answer, steps}, or None
+        """
+        if self.mode != 'replay':
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT task, answer, steps FROM trajectories WHERE agent = ? AND template = ? '
+                                   'ORDER BY rowid DESC LIMIT 1', (agent, task_template(task)[0])).fetchone()
+        if row is None:
+            return None
+        return {'task': row[0], 'answer': row[1], 'steps': json.loads(row[2])}
+
+
+class TrajectorySession:
+    """
+    One run of an agent on a task: records its steps, and serves the recorded ones while they still match.
+
+    Each LLM step is bracketed by observe(kind, state), right after the observation, and record(kind, output),
+    once its actions have run. kind is 'agent', 'executor' or 'validator', each follows its own recorded steps.
+    """
+
+    def __init__(self, agent, task, store=None):
+        self.agent = agent
+        self.task = task
+        self.store = store
+        self.slots = task_template(task)[1]
+        recorded = store.latest(agent, task) if store is not None else None
+        self.recorded = recorded['steps'] if recorded else []
+        self.recorded_task = recorded['task'] if recorded else None
+        self.diverged = not self.recorded
+        self.divergence = None  # why the replay stopped
+        self.steps = []  # this run's
+        self.replayed = 0
+        self._cursor = {}  # kind -> recorded steps of that kind already served
+        self._pending = {}  # kind -> (page, recorded step or None)
+        self._lock = threading.Lock()  # the pipelined Validator records from its own thread
+
+    def _page(self, state):
+        tabs = {name: [element_fingerprint(e, self.slots) for e in tab.elements] for name, tab in state.tabs.items()}
+        return {'url': state.driver.current_url, 'focus': state.focus, 'elements': tabs.get(state.focus, []),
+                'img_hash': state.last_observation['img_hash'] if state.last_observation else None, 'tabs': tabs}
+
+    def _diverge(self, reason):
+        self.diverged = True
+        self.divergence = reason
+        return None
+
+    def _page_problem(self, step, page):
+        if url_key(step['url']) != url_key(page['url']):
+            return f"expected {step['url']}, on {page['url']}"
+        recorded = set(step['elements'])
+        if recorded and len(recorded & set(page['elements'])) < PAGE_MATCH * len(recorded):
+            return f"the page at {page['url']} has changed"
+        return None
+
+    def _same_image(self, step, page):
+        return step['img_hash'] is not None and page['img_hash'] is not None and \
+            hash_distance(step['img_hash'], page['img_hash']) <= PAGE_HASH_THRESHOLD
+
+    def _same_answer_page(self, step, page):
+        if self.task != self.recorded_task:
+            return False
+        if step['kind'] == 'validator':
+            return self._same_image(step, page)
+        return step['elements'] == page['elements']
+
+    def _find(self, target, elements, idx):
+        """
+        Index of the element with the target's fingerprint, the closest to where it was if there are several
+        """
+        matches = [i for i, fingerprint in enumerate(elements) if fingerprint == target]
+        return min(matches, key=lambda i: abs(i - idx)) if matches else None
+
+    def _match(self, kind, page):
+        """
+        Returns (recorded step, output to use) for the next recorded step of this kind, or None if it doesn't match
+        """
+        steps = [step for step in self.recorded if step['kind'] == kind]
+        n = self._cursor.get(kind, 0)
+        if n >= len(steps):
+            return self._diverge(f'no recorded {kind} step left')
+        step = steps[n]
+        if problem := self._page_problem(step, page):
+            return self._diverge(problem)
+        if kind == 'validator':
+            if not self._same_image(step, page):
+                return self._diverge(f"the page at {page['url']} doesn't look the same")
+            output = _action_slots(step['output'], _from_slots, self.slots)
+            if output.get('answer') and not self._same_answer_page(step, page):
+                return self._diverge('the answer has to be read again')
+        else:
+            actions = []
+            for action, target in zip(step['actions'], step['targets']):
+                action = _action_slots(action, _from_slots, self.slots)
+                if action.get('command') in ANSWER_COMMANDS and not self._same_answer_page(step, page):
+                    return self._diverge('the answer has to be read again')
+                if target is not None:
+                    tab = tab_of(action, page['focus'])
+                    idx = self._find(target, page['tabs'].get(tab, []), action['idx'])
+                    if idx is None:
+                        return self._diverge(f"the target of {action['command']} {action['idx']} is gone")
+                    action = {**action, 'idx': idx}
+                actions.append(action)
+            output = {'thought': step['thought'], 'action': actions}
+        self._cursor[kind] = n + 1
+        return step, output
+
+    def observe(self, kind, state):
+        """
+        Call right after the observation an LLM call would be based on. Returns the recorded output to use instead,
+        with idx remapped to the current page, or None to ask the LLM.
+        """
+        page = self._page(state)
+        with self._lock, span('trajectory_match', kind=kind) as s:
+            match = None if self.diverged else self._match(kind, page)
+            self._pending[kind] = (page, match[0] if match else None)
+            s.set(replayed=match is not None, divergence=self.divergence)
+        return match[1] if match else None
+
+    def _target(self, action, page):
+        """
+        Fingerprint of the element an action's idx points to, None if it has no target on an observed page
+        """
+        idx = action.get('idx') if isinstance(action, dict) else None
+        if isinstance(idx, bool) or not isinstance(idx, int):
+            return None
+        elements = page['tabs'].get(tab_of(action, page['focus']), [])
+        return elements[idx] if 0 <= idx < len(elements) else None
+
+    def record(self, kind, output, outcomes=()):
+        """
+        output: the parsed reply (or replayed output) the step went with
+        outcomes: [(exit_state, response)] per action, for the Agent/Executor
+        """
+        with self._lock:
+            page, replayed = self._pending.pop(kind, (None, None))
+            if page is None or not isinstance(output, dict):
+                return
+            if replayed is not None:
+                self.replayed += 1
+                failed = [i for i, (was_ok, (ok, _)) in enumerate(zip(replayed.get('outcomes', []), outcomes))
+                          if was_ok and not ok]
+                if failed:
+                    self._diverge(f'action {failed[0]} failed this time')
+            step = {'kind': kind, 'url': page['url'], 'elements': page['elements'], 'img_hash': page['img_hash']}
+            if kind == 'validator':
+                step['output'] = _action_slots(output, _to_slots, self.slots)
+            else:
+                actions = output.get('action', [])
+                step.update(thought=output.get('thought'),
+                            actions=[_action_slots(a, _to_slots, self.slots) if isinstance(a, dict) else a
+                                     for a in actions],
+                            targets=[self._target(a, page) for a in actions],
+                            outcomes=[bool(ok) for ok, _ in outcomes])
+            self.steps.append(step)
+
+    def finish(self, answer, success):
+        """
+        Saves the run if it was successful, i.e. its answer was checked by the caller (a benchmark's expected answer,
+        or the user). A run that was replayed from start to end adds nothing.
+        """
+        if self.store is None or not success or not answer or not self.steps or self.replayed == len(self.steps):
+            return
+        self.store.save(self.agent, self.task, answer, self.steps)
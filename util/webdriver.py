@@ -1,34 +1,56 @@
 import os
+import sys
+import queue
+import shutil
+import socket
+import threading
 import subprocess
-import psutil
-import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
 
 DEBUG_PORT = 9222
-CHROME_PATH = os.path.join(r"C:\Program Files (x86)\Google\Chrome\Application", 'chrome.exe') # TODO optimize for other systems
-assert os.path.exists(CHROME_PATH), 'Chrome path incorrect. Change util/webdriver.py'
+WINDOW_SIZE = '1280,800'
+CHROME_PATHS = {
+    'win32': [os.path.join(r"C:\Program Files (x86)\Google\Chrome\Application", 'chrome.exe'),
+              os.path.join(r"C:\Program Files\Google\Chrome\Application", 'chrome.exe')],
+    'darwin': ['/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'],
+}
+LINUX_CHROME_NAMES = ['google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser']
 
-def is_chrome_running():
-    # Check if any Chrome processes are running
-    for process in psutil.process_iter(['pid', 'name']):
-        if 'chrome' in process.info['name'].lower():  # Adjust 'chrome' if necessary for your OS
-            return True
-    return False
+
+def find_chrome():
+    """
+    Path to a Chrome/Chromium binary for this OS. CHROME_PATH overrides it.
+    """
+    if os.getenv('CHROME_PATH'):
+        return os.getenv('CHROME_PATH')
+    for path in CHROME_PATHS.get(sys.platform, []):
+        if os.path.exists(path):
+            return path
+    for name in LINUX_CHROME_NAMES:
+        if path := shutil.which(name):
+            return path
+    raise FileNotFoundError('Chrome not found. Set CHROME_PATH or change util/webdriver.py')
+
+
+def is_port_open(port, host='localhost'):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.5)
+        return s.connect_ex((host, port)) == 0
 
 # https://stackoverflow.com/questions/67738780/python-selenium-detach-option-not-working
 # https://www.headspin.io/blog/ultimate-guide-chrome-remote-debugging
 def chrome_remote_debug_webdriver():
-    # Typically before starting this process, you must close chrome completely
-    # TODO better way to do this?
-    if is_chrome_running():
-        raise PermissionError('Chrome detected. Please close all instances of Chrome to attach webdriver')
-    print('Starting Chrome...')
-    # f"--user-data-dir={os.path.join(os.getcwd(), 'tmp', 'chromeProfile')}"
-    command = f'"{CHROME_PATH}" -remote-debugging-port={DEBUG_PORT}'
-    subprocess.Popen(command)
-    print('Chrome running in background. Connecting Selenium...')
+    # If a Chrome is already listening on the debug port, attach to it instead of starting another one
+    if not is_port_open(DEBUG_PORT):
+        print('Starting Chrome...')
+        # f"--user-data-dir={os.path.join(os.getcwd(), 'tmp', 'chromeProfile')}"
+        subprocess.Popen([find_chrome(), f'--remote-debugging-port={DEBUG_PORT}'])
+        print('Chrome running in background. Connecting Selenium...')
     chrome_options = Options()
     chrome_options.page_load_strategy = 'eager'
     chrome_options.add_experimental_option('debuggerAddress', f'localhost:{DEBUG_PORT}')
@@ -36,11 +58,140 @@ def chrome_remote_debug_webdriver():
     print('Done')
     return driver
 
-def chrome_new_webdriver():
+def chrome_new_webdriver(headless=False):
     chrome_options = Options()
     # chrome_options.add_argument('--start-maximized')
     chrome_options.page_load_strategy = 'eager' # https://www.selenium.dev/documentation/webdriver/drivers/options/
     chrome_options.add_argument('--log-level=3') # 2=ERROR 3=FATAL
-    chrome_options.add_experimental_option("detach", True)
+    if headless:
+        chrome_options.add_argument('--headless=new')
+        chrome_options.add_argument(f'--window-size={WINDOW_SIZE}')
+        # needed to run as root/in containers on Linux
+        chrome_options.add_argument('--no-sandbox')
+        chrome_options.add_argument('--disable-dev-shm-usage')
+        chrome_options.add_argument('--disable-gpu')
+        try:
+            chrome_options.binary_location = find_chrome()
+        except FileNotFoundError:
+            pass  # let selenium manager find/download one
+    else:
+        chrome_options.add_experimental_option("detach", True)
     driver = webdriver.Chrome(options=chrome_options)
     return driver
+
+
+class BrowserPool:
+    """
+    A fixed number of headless browsers, launched ahead of time and reused across tasks.
+
+    with pool.checkout(start_site) as driver:
+        ...
+
+    Every browser gets its own temporary profile (chromedriver's default). When a driver comes back, extra tabs
+    are closed, cookies and cache are cleared along with storage for every origin the task visited or got cookies
+    from, and it's left on about:blank.
+    """
+
+    def __init__(self, size=4, headless=True, start_site=None, driver_factory=None):
+        self.size = size
+        self.start_site = start_site
+        self._driver_factory = driver_factory or (lambda: chrome_new_webdriver(headless=headless))
+        self._idle = queue.Queue()
+        self._all = []
+        self._lock = threading.Lock()
+        # launch in parallel, cold starts take a few seconds each
+        with ThreadPoolExecutor(max_workers=size) as pool:
+            for driver in pool.map(lambda _: self._driver_factory(), range(size)):
+                self._add(driver)
+
+    def _add(self, driver):
+        with self._lock:
+            self._all.append(driver)
+        self._idle.put(driver)
+
+    def _replace(self, driver):
+        with self._lock:
+            if driver in self._all:
+                self._all.remove(driver)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        self._add(self._driver_factory())
+
+    def _visited_origins(self, driver, handles):
+        """
+        Origins in the open tabs' histories, and those of every cookie (which covers iframes and closed tabs)
+        """
+        urls = []
+        for handle in handles:
+            driver.switch_to.window(handle)
+            urls += [e['url'] for e in driver.execute_cdp_cmd('Page.getNavigationHistory', {})['entries']]
+        origins = {'/'.join(url.split('/')[:3]) for url in urls if url.startswith('http')}
+        for cookie in driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']:
+            domain = cookie['domain'].lstrip('.')
+            origins.update({f'https://{domain}', f'http://{domain}'})
+        return origins
+
+    def _reset(self, driver):
+        """
+        Close extra tabs and clear everything the last task left behind
+        """
+        handles = driver.window_handles
+        cdp = hasattr(driver, 'execute_cdp_cmd')
+        origins = self._visited_origins(driver, handles) if cdp else set()
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        if cdp:
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+            for origin in origins:
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+        else:
+            driver.delete_all_cookies()
+        driver.get('about:blank')
+
+    def acquire(self, start_site=None, timeout=None):
+        driver = self._idle.get(timeout=timeout)
+        start_site = start_site or self.start_site
+        if start_site is not None:
+            try:
+                driver.get(start_site)
+            except Exception:
+                # back to the pool, or replaced if the browser is gone
+                self.release(driver)
+                raise
+        return driver
+
+    def release(self, driver):
+        try:
+            self._reset(driver)
+            self._idle.put(driver)
+        except WebDriverException:
+            # browser crashed/hung, start a new one so the pool keeps its size
+            self._replace(driver)
+
+    @contextmanager
+    def checkout(self, start_site=None, timeout=None):
+        driver = self.acquire(start_site, timeout=timeout)
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def close(self):
+        with self._lock:
+            drivers, self._all = self._all, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except WebDriverException:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()